@@ -0,0 +1,918 @@
+import asyncio
+import concurrent.futures
+import json
+import pathlib
+import time
+import traceback
+
+from catalog import CATALOG_ALGORITHM
+from compression import ChunkDecompressor, check_chunk_header
+from delta import COPY, END, LITERAL, MAX_LITERAL_SIZE
+from integrity import HashingWriter, StreamHasher
+from parallel_transfer import STREAM_ATTACH_TIMEOUT, TRANSFER_ID_SIZE, ParallelTransfer, RangeWriter
+from protocol import EVENTS_HELLO, HELLO_MAGIC, MAX_CONTROL_SIZE, PROTOCOL_VERSION, RELAY_HELLO, SESSION_HELLO_VERSION, STREAM_HELLO, FrameCodec, hello_size, unpack_hello
+from recv_buffer import MAX_EXACT_SIZE
+from relay import RELAY_VERSION
+from server import BATCH_PENDING_WRITES, BATCH_WRITER_THREADS, Server
+from tuning import ConnectionTuner
+
+
+class AsyncServer(Server):
+    """
+    Server engine that receives from any number of senders at once on a single asyncio event loop.
+
+    It speaks the same wire protocol as Server. Socket I/O stays on the event loop while
+    every disk operation runs in a thread pool, so a slow disk never holds up other connections.
+    """
+
+    def __init__(self, server_ip: str = None, port: int = 5555, max_connections: int = 128, disk_threads: int = BATCH_WRITER_THREADS, **kwargs):
+        """
+        :param max_connections: Backlog of the listening socket.
+        :param disk_threads: Threads that run file writes off the event loop.
+        """
+
+        super().__init__(server_ip=server_ip, port=port, max_connections=max_connections, **kwargs)
+        self.disk_executor = concurrent.futures.ThreadPoolExecutor(max_workers=disk_threads)
+        self.client_dict_lock = asyncio.Lock()
+        self.async_transfers_condition = asyncio.Condition()
+        self.pipe_output_lock = asyncio.Lock()
+        self.loop = None
+
+
+    async def serve(self):
+        """Accept connections on the listening socket created by Server until cancelled."""
+
+        self.loop = asyncio.get_running_loop()
+        self.server.setblocking(False)
+        async with await asyncio.start_server(self.handle_client_async, sock=self.server) as server:
+            await server.serve_forever()
+
+
+    async def _run_on_disk(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.disk_executor, function, *args)
+
+
+    async def _throttle(self, delay: float):
+        """Wait out the delay a rate limited transfer returned from TransferMetrics.add without blocking the loop."""
+
+        if delay:
+            await asyncio.sleep(delay)
+
+
+    async def _read_exact(self, reader: asyncio.StreamReader, length: int, max_length: int = MAX_EXACT_SIZE) -> bytes:
+        """
+        :return: <length> bytes, or fewer only if the client disconnected.
+        :raises ValueError: If <length> is above <max_length>, as RecvBuffer.recv_exact does.
+        """
+
+        if length > max_length:
+            raise ValueError(f"Frame of {length} bytes is larger than the {max_length} bytes accepted")
+        try:
+            return await reader.readexactly(length)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+
+    async def _read_into_file(self, reader: asyncio.StreamReader, file, length: int, metrics=None, tuner=None) -> int:
+        """
+        Receive <length> bytes and write them to <file> in blocks of <buffer_size> bytes.
+
+        Each block is written on the disk executor while the next one is received.
+
+        :param metrics: TransferMetrics credited with every block; time spent waiting for data counts
+                        as socket time and time spent waiting for an earlier write as disk time.
+        :param tuner: ConnectionTuner of the connection, which sizes the blocks once it has measured it.
+        :return: Number of bytes received.
+        """
+
+        block_size = self.buffer_size
+        block = bytearray()
+        received = 0
+        reads = 0
+        socket_time = 0.0
+        pending_write = None
+        while received < length:
+            start = time.perf_counter()
+            chunk = await reader.read(min(block_size, length - received))
+            socket_time += time.perf_counter() - start
+            reads += 1
+            if not chunk:
+                break
+            block += chunk
+            received += len(chunk)
+            if len(block) >= block_size or received == length:
+                start = time.perf_counter()
+                if pending_write:
+                    await pending_write
+                pending_write = asyncio.ensure_future(self._run_on_disk(file.write, block))
+                if metrics:
+                    await self._throttle(metrics.add(len(block), reads + 1, socket_time, time.perf_counter() - start, wait=False))
+                    if tuner:
+                        block_size = tuner.update(metrics)
+                block = bytearray()
+                reads = 0
+                socket_time = 0.0
+
+        if pending_write:
+            await pending_write
+        # Keep whatever arrived before the client disconnected
+        if block:
+            await self._run_on_disk(file.write, block)
+            if metrics:
+                await self._throttle(metrics.add(len(block), reads + 1, socket_time, wait=False))
+        return received
+
+
+    async def _read_field(self, reader: asyncio.StreamReader, length: int) -> bytes:
+        data = await self._read_exact(reader, length)
+        if len(data) < length:
+            raise ConnectionError("Disconnected in the middle of a frame")
+        return data
+
+
+    async def _read_header_async(self, reader: asyncio.StreamReader, codec: FrameCodec):
+        """:return: (data type, data length), or (None, 0) if the client disconnected."""
+
+        header = await self._read_exact(reader, codec.header_size)
+        if len(header) < codec.header_size:
+            return None, 0
+        return codec.unpack_header(header)
+
+
+    async def _read_int_async(self, reader: asyncio.StreamReader, codec: FrameCodec) -> int:
+        return codec.unpack_int(await self._read_field(reader, codec.int_size))
+
+
+    async def _read_name_async(self, reader: asyncio.StreamReader, codec: FrameCodec) -> str:
+        name_length = codec.unpack_name_length(await self._read_field(reader, codec.name_length_size))
+        return (await self._read_field(reader, name_length)).decode("utf-8")
+
+
+    async def send_data_async(self, writer: asyncio.StreamWriter, data):
+        """Send a reply as a length header followed by the data."""
+
+        try:
+            encoded_data = data if isinstance(data, bytes) else data.encode("utf-8")
+            writer.writelines([self._codec(writer).pack_int(len(encoded_data)), encoded_data])
+            await writer.drain()
+        except (ConnectionError, OSError):
+            print("Server Data Sending Socket Error: ", traceback.format_exc())
+
+
+    async def _negotiate_protocol_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, hello: bytes):
+        """Complete and answer a client's protocol hello, as Server._negotiate_protocol does; return its session or None."""
+
+        if len(hello) < hello_size(hello):
+            hello += await reader.readexactly(hello_size(hello) - len(hello))
+        requested_version, session = unpack_hello(hello)
+        version = max(1, min(requested_version, PROTOCOL_VERSION))
+        if version < SESSION_HELLO_VERSION:
+            session = None
+        if session is None:
+            await self.send_data_async(writer, str(version))
+        self.codecs[writer] = FrameCodec(version, self.data_header_size, self.filename_header_size)
+        return session
+
+
+    async def _answer_session_async(self, writer: asyncio.StreamWriter, reply: dict):
+        """Send a session reply framed as v1, as Server._answer_session does."""
+
+        encoded_reply = json.dumps(reply).encode("utf-8")
+        writer.writelines([self.default_codec.pack_int(len(encoded_reply)), encoded_reply])
+        await writer.drain()
+
+
+    async def _answer_channel_async(self, writer: asyncio.StreamWriter, session: dict, status: str):
+        """Accept or refuse a STREAM or EVENTS connection, as Server._answer_channel does."""
+
+        if session is None:
+            await self.send_data_async(writer, status)
+        else:
+            await self._answer_session_async(writer, {**self._session_reply(writer, session), 'status': status})
+
+
+    async def notify_async(self, writer: asyncio.StreamWriter, data):
+        """Push a notification over the client's event channel, or its main connection if it has none."""
+
+        await self.send_data_async(self.event_channels.get(writer, writer), data)
+
+
+    async def handle_events_async(self, reader, writer, token: str, session: dict = None):
+        """Register an event channel, as Server.handle_events does."""
+
+        main_writer = self.event_tokens.pop(token, None)
+        if not main_writer:
+            await self._answer_channel_async(writer, session, 'Unknown Token')
+            return
+        await self._answer_channel_async(writer, session, 'OK')
+        self.event_channels[main_writer] = writer
+        try:
+            # Nothing is expected from the client, this only returns once the channel is closed
+            while await reader.read(2048):
+                pass
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if self.event_channels.get(main_writer) is writer:
+                self.event_channels.pop(main_writer)
+            self.codecs.pop(writer, None)
+
+
+    async def handle_relay_async(self, reader, writer, session: dict = None):
+        """Pass uploads on to a subscriber as Server.handle_relay does, sending its frames from the event loop."""
+
+        status = 'OK'
+        if not self.relay.policy:
+            status = 'Relay Disabled'
+        elif self._codec(writer).version < RELAY_VERSION:
+            status = 'Relay Needs Protocol v7'
+        await self._answer_channel_async(writer, session, status)
+        if status != 'OK':
+            return
+        addr = writer.get_extra_info('peername')
+        print(f"Relay subscriber connected: {addr}")
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        # Frames are queued from the disk executor's threads
+        outlet = self.relay.subscribe(writer.get_extra_info('socket'), self._codec(writer),
+                                      on_ready=lambda: loop.call_soon_threadsafe(ready.set))
+        sender = asyncio.ensure_future(self._serve_outlet_async(outlet, writer, ready))
+        try:
+            # Nothing is expected from the subscriber, this only returns once the connection is closed
+            while await reader.read(2048):
+                pass
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.relay.unsubscribe(outlet)
+            await sender
+            self.codecs.pop(writer, None)
+            print(f"Relay subscriber disconnected: {addr}")
+
+
+    async def _serve_outlet_async(self, outlet, writer: asyncio.StreamWriter, ready: asyncio.Event):
+        try:
+            while True:
+                # Cleared before looking, so frames queued in between still wake the loop up
+                ready.clear()
+                buffers = outlet.take()
+                if buffers is None:
+                    return
+                if not buffers:
+                    await ready.wait()
+                    continue
+                writer.writelines(buffers)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            # The subscriber went away
+            outlet.close()
+
+
+    async def _handle_channel_async(self, reader, writer, hello: str, session: dict = None) -> bool:
+        """Serve a STREAM, EVENTS or RELAY connection or pass it to the worker process that owns it, as Server._handle_channel does."""
+
+        if not hello.startswith((STREAM_HELLO, EVENTS_HELLO, RELAY_HELLO)):
+            return False
+        if hello.startswith(RELAY_HELLO):
+            await self.handle_relay_async(reader, writer, session)
+            return True
+        if self.router and self.router.hand_off(writer.get_extra_info('socket'), hello, session, self._codec(writer).version):
+            # The caller closes this end, the other worker keeps its own descriptor of the connection
+            return True
+        if hello.startswith(STREAM_HELLO):
+            await self.handle_stream_async(reader, writer, hello[len(STREAM_HELLO):].strip(), session)
+        else:
+            await self.handle_events_async(reader, writer, hello[len(EVENTS_HELLO):].strip(), session)
+        return True
+
+
+    def adopt_channel(self, conn, hello: str, session: dict, version: int):
+        """Serve a connection handed over by another worker process on the event loop; called from the router's thread."""
+
+        asyncio.run_coroutine_threadsafe(self._adopt_channel_async(conn, hello, session, version), self.loop)
+
+
+    async def _adopt_channel_async(self, conn, hello: str, session: dict, version: int):
+        reader, writer = await asyncio.open_connection(sock=conn)
+        self.codecs[writer] = FrameCodec(version, self.data_header_size, self.filename_header_size)
+        self.tuners[writer] = ConnectionTuner(conn, 'receive', self.buffer_size, enabled=self.autotune)
+        try:
+            await self._handle_channel_async(reader, writer, hello, session)
+        except Exception:
+            print("Handed over connection Error:", traceback.format_exc())
+        finally:
+            self.codecs.pop(writer, None)
+            self.tuners.pop(writer, None)
+            writer.close()
+
+
+    async def handle_client_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info('peername')
+        print("Connected to:", addr)
+        username = None
+        self.tuners[writer] = ConnectionTuner(writer.get_extra_info('socket'), 'receive', self.buffer_size, enabled=self.autotune)
+        try:
+            # Validate Username provided by client by checking if it already exists in client_dict
+            while not username:
+                selected_username = await reader.read(2048)
+                if not selected_username:
+                    return
+                session = None
+                # v2 clients agree on the protocol version before sending their username, v5 clients send it along
+                if selected_username.startswith(HELLO_MAGIC):
+                    session = await self._negotiate_protocol_async(reader, writer, selected_username)
+                    if session is None:
+                        continue
+                    selected_username = str(session.get('channel') or session.get('username', ''))
+                else:
+                    selected_username = selected_username.decode('utf-8')
+                # Stream connections of a parallel transfer don't take part in the username handshake
+                if await self._handle_channel_async(reader, writer, selected_username, session):
+                    return
+                print(f"Selected Username: {selected_username}")
+                async with self.client_dict_lock:
+                    if not self.client_dict.get(selected_username):
+                        self.client_dict[selected_username] = writer
+                        username = selected_username
+                if session is None:
+                    await self.send_data_async(writer, username or 'Username already taken')
+                else:
+                    await self._answer_session_async(
+                        writer, self._session_reply(writer, session, username, None if username else 'Username already taken'))
+            print("client_dict: ", self.client_dict)
+
+            while True:
+                data_type, data = await self.receive_data_async(reader, writer)
+                if not data:
+                    break
+                if data_type != 'POLL':
+                    print(f"Data from {username}:", data.decode("utf-8"))
+        except Exception:
+            print(f"Error while serving {username or addr}:", traceback.format_exc())
+        finally:
+            if username:
+                async with self.client_dict_lock:
+                    self.client_dict.pop(username, None)
+                print("client dict: ", self.client_dict)
+            await self._abort_parallel_transfers_async(writer)
+            event_writer = self.event_channels.pop(writer, None)
+            if event_writer:
+                event_writer.close()
+            self.codecs.pop(writer, None)
+            self.tuners.pop(writer, None)
+            writer.close()
+            print(f"Lost Connection with {username if username else addr}")
+
+
+    async def receive_data_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Receive one frame from the client.
+
+        :return: (data type, data to report). Data is empty once the connection can't be used anymore.
+        """
+
+        codec = self._codec(writer)
+        try:
+            data_type, data_length = await self._read_header_async(reader, codec)
+            if data_type is None:
+                print("Client Disconected")
+                return None, b""
+        except ConnectionResetError:
+            return None, b""
+        except Exception:
+            print("Error in receiving Headers: ", traceback.format_exc())
+            return None, b""
+
+        handlers = {
+            'File': self._receive_file_async,
+            'Verified': self._receive_verified_async,
+            'Compressed': self._receive_compressed_async,
+            'Parallel': self._receive_parallel_async,
+            'Batch': self._receive_batch_async,
+            'Events': self._receive_events_request_async,
+            'Resume': self._receive_resume_request_async,
+            'ResumeData': self._receive_resume_data_async,
+            'Delta': self._receive_delta_request_async,
+            'DeltaData': self._receive_delta_data_async,
+            'Offer': self._receive_offer_async,
+            'Stats': self._receive_stats_request_async,
+            'Udp': self._receive_udp_async,
+            'Pipe': self._receive_pipe_async,
+            'Text': self._receive_text_async,
+            'POLL': self._receive_text_async,
+        }
+        if data_type not in handlers:
+            # The rest of the stream can't be parsed without knowing the frame layout
+            print(f"Unsupported Data Type: {data_type}")
+            return data_type, b""
+        return data_type, await handlers[data_type](reader, writer, codec, data_type, data_length)
+
+
+    async def _receive_file_async(self, reader, writer, codec, data_type, data_length):
+        try:
+            filename = await self._read_name_async(reader, codec)
+            disk_writer = await self._run_on_disk(self._open_disk_writer, filename, data_length)
+            try:
+                with self.metrics.start(filename, 'receive', data_length) as transfer:
+                    received = await self._read_into_file(reader, self.relay.tee(disk_writer, transfer), data_length, transfer, self.tuners.get(writer))
+                if received == data_length:
+                    await self._run_on_disk(self._finish_disk_writer, disk_writer)
+            finally:
+                await self._run_on_disk(self._abort_disk_writer, disk_writer)
+            if received < data_length:
+                print("Client Disconnected")
+                return b""
+        except Exception:
+            print("File Download Error:", traceback.format_exc())
+            await self.notify_async(writer, 'Error Receiving File')
+            return b""
+        await self.notify_async(writer, 'File Downloaded')
+        return b'File Saved'
+
+
+    async def _receive_verified_async(self, reader, writer, codec, data_type, data_length):
+        """Receive a file and its digest trailer as Server.receive_data does, hashing on a helper thread."""
+
+        hasher = None
+        try:
+            filename = await self._read_name_async(reader, codec)
+            algorithm = await self._read_name_async(reader, codec)
+            hasher = StreamHasher(algorithm)
+            disk_writer = await self._run_on_disk(self._open_disk_writer, filename, data_length)
+            filepath = disk_writer.filepath
+            try:
+                with self.metrics.start(filename, 'receive', data_length) as transfer:
+                    received = await self._read_into_file(reader, self.relay.tee(HashingWriter(disk_writer, hasher), transfer), data_length,
+                                                          transfer, self.tuners.get(writer))
+                    digest = await self._run_on_disk(hasher.hexdigest)
+                    if received < data_length:
+                        print("Client Disconnected")
+                        return b""
+                    trailer_type, trailer_length = await self._read_header_async(reader, codec)
+                    if trailer_type != 'Digest':
+                        raise ValueError(f"Expected a 'Digest' trailer, got {trailer_type}")
+                    expected_digest = (await self._read_field(reader, trailer_length)).decode("utf-8")
+                    # A file that doesn't match never appears under its final name
+                    if digest == expected_digest:
+                        await self._run_on_disk(self._finish_disk_writer, disk_writer,
+                                                digest if algorithm == CATALOG_ALGORITHM else None)
+                    else:
+                        transfer.finish('failed')
+            finally:
+                await self._run_on_disk(self._abort_disk_writer, disk_writer)
+        except Exception:
+            print("Verified File Download Error:", traceback.format_exc())
+            if hasher:
+                # Stops the hashing thread
+                await self._run_on_disk(hasher.hexdigest)
+            await self.notify_async(writer, 'Error Receiving File')
+            return b""
+        if not await self._run_on_disk(self._verify_digest, filepath, digest, expected_digest):
+            await self.notify_async(writer, 'File Verification Failed')
+            return b'File Discarded'
+        await self.notify_async(writer, 'File Verified')
+        return b'File Saved'
+
+
+    async def _receive_compressed_async(self, reader, writer, codec, data_type, data_length):
+        """Receive a compressed file as Server.receive_data does, decompressing on the disk executor."""
+
+        try:
+            filename = await self._read_name_async(reader, codec)
+            method = await self._read_name_async(reader, codec)
+            disk_writer = await self._run_on_disk(self._open_disk_writer, filename, data_length)
+            pending_write = None
+            try:
+                decompressor = ChunkDecompressor(disk_writer, method)
+                received = 0
+                with self.metrics.start(filename, 'receive', data_length) as transfer:
+                    while received < data_length:
+                        start = time.perf_counter()
+                        raw_length = await self._read_int_async(reader, codec)
+                        payload_length = await self._read_int_async(reader, codec)
+                        check_chunk_header(raw_length, payload_length)
+                        payload = await self._read_field(reader, payload_length)
+                        socket_time = time.perf_counter() - start
+                        if pending_write:
+                            await pending_write
+                        pending_write = asyncio.ensure_future(self._run_on_disk(decompressor.write_chunk, raw_length, payload))
+                        received += raw_length
+                        await self._throttle(transfer.add(raw_length, socket_time=socket_time,
+                                                          disk_time=time.perf_counter() - start - socket_time, wait=False))
+                    if pending_write:
+                        await pending_write
+                await self._run_on_disk(self._finish_disk_writer, disk_writer)
+            finally:
+                # Don't close the file under a write that is still running
+                if pending_write:
+                    await asyncio.gather(pending_write, return_exceptions=True)
+                await self._run_on_disk(self._abort_disk_writer, disk_writer)
+            print(f"Compression {decompressor.stats}")
+        except Exception:
+            print("Compressed File Download Error:", traceback.format_exc())
+            await self.notify_async(writer, 'Error Receiving File')
+            return b""
+        await self.notify_async(writer, 'File Downloaded')
+        return b'File Saved'
+
+
+    async def _receive_parallel_async(self, reader, writer, codec, data_type, data_length):
+        try:
+            filename = await self._read_name_async(reader, codec)
+            transfer_id = (await self._read_exact(reader, TRANSFER_ID_SIZE)).decode("utf-8")
+            filepath = await self._run_on_disk(self._get_unique_filepath, filename)
+            transfer = await self._run_on_disk(ParallelTransfer, transfer_id, filepath, data_length, writer,
+                                               self.metrics.start(filename, 'receive', data_length))
+            async with self.async_transfers_condition:
+                self.parallel_transfers[transfer_id] = transfer
+                self.async_transfers_condition.notify_all()
+            print(f"Receiving {filename} over parallel streams")
+            if transfer.is_complete():
+                await self._finish_parallel_transfer_async(transfer)
+            else:
+                self._watch_parallel_transfer(transfer)
+            return b'Parallel Transfer Started'
+        except Exception:
+            print("Parallel Transfer Setup Error:", traceback.format_exc())
+            await self.notify_async(writer, 'Error Receiving File')
+            return b""
+
+
+    async def handle_stream_async(self, reader, writer, transfer_id: str, session: dict = None):
+        """Receive byte ranges of a parallel transfer on a stream connection, as Server.handle_stream does."""
+
+        async with self.async_transfers_condition:
+            try:
+                await asyncio.wait_for(
+                    self.async_transfers_condition.wait_for(lambda: transfer_id in self.parallel_transfers),
+                    timeout=STREAM_ATTACH_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            transfer = self.parallel_transfers.get(transfer_id)
+        if not transfer or not transfer.attach():
+            await self._answer_channel_async(writer, session, 'Unknown Transfer')
+            return
+        try:
+            await self._answer_channel_async(writer, session, 'OK')
+            await self._receive_ranges_async(reader, writer, transfer)
+        finally:
+            transfer.detach()
+            if transfer.is_abandoned():
+                self._watch_parallel_transfer(transfer)
+
+
+    async def _receive_ranges_async(self, reader, writer, transfer: ParallelTransfer):
+        codec = self._codec(writer)
+        while True:
+            data_type, data_length = await self._read_header_async(reader, codec)
+            if data_type is None:
+                break
+            if data_type != 'Range':
+                print(f"Unexpected data type on stream connection: {data_type}")
+                break
+            offset = await self._read_int_async(reader, codec)
+            transfer.check_range(offset, data_length)
+
+            received = await self._read_into_file(reader, RangeWriter(transfer, offset), data_length, transfer.metrics, self.tuners.get(writer))
+            if received < data_length:
+                # The client sends this range again on another stream
+                print("Stream Disconnected")
+                break
+            if transfer.range_received(offset):
+                await self._finish_parallel_transfer_async(transfer)
+
+
+    def _watch_parallel_transfer(self, transfer: ParallelTransfer):
+        """Abort <transfer> if it still has no stream connection STREAM_ATTACH_TIMEOUT seconds from now, on the event loop."""
+
+        self.loop.call_later(STREAM_ATTACH_TIMEOUT, lambda: asyncio.ensure_future(self._expire_parallel_transfer_async(transfer)))
+
+
+    async def _expire_parallel_transfer_async(self, transfer: ParallelTransfer):
+        if transfer.is_abandoned(STREAM_ATTACH_TIMEOUT) and await self._abort_parallel_transfer_async(transfer):
+            print(f"Parallel transfer of {transfer.filepath.name} abandoned, no stream connection for {STREAM_ATTACH_TIMEOUT} seconds")
+            await self.notify_async(transfer.conn, 'Error Receiving File')
+
+
+    async def _abort_parallel_transfer_async(self, transfer: ParallelTransfer) -> bool:
+        """Forget <transfer> and remove its partial file, as Server._abort_parallel_transfer does."""
+
+        if self.parallel_transfers.get(transfer.transfer_id) is transfer:
+            self.parallel_transfers.pop(transfer.transfer_id)
+        if not await self._run_on_disk(transfer.abort):
+            return False
+        if transfer.metrics:
+            transfer.metrics.finish('failed')
+        return True
+
+
+    async def _abort_parallel_transfers_async(self, writer: asyncio.StreamWriter):
+        """Abort the parallel transfers announced on main connection <writer>, which was closed."""
+
+        for transfer in [transfer for transfer in self.parallel_transfers.values() if transfer.conn is writer]:
+            if await self._abort_parallel_transfer_async(transfer):
+                print(f"Parallel transfer of {transfer.filepath.name} aborted, its client disconnected")
+
+
+    async def _finish_parallel_transfer_async(self, transfer: ParallelTransfer):
+        self.parallel_transfers.pop(transfer.transfer_id, None)
+        await self._run_on_disk(transfer.finish)
+        await self._run_on_disk(self.catalog.add, transfer.filepath)
+        if transfer.metrics:
+            transfer.metrics.finish()
+        print(f"\n{transfer.filepath.name} downloaded over parallel streams")
+        await self.notify_async(transfer.conn, 'File Downloaded')
+
+
+    async def _receive_batch_async(self, reader, writer, codec, data_type, data_length):
+        """Receive a batch as Server._receive_batch does, with the writes on the disk executor."""
+
+        try:
+            print(f"Receiving a batch of {data_length} files")
+            pending_writes = asyncio.Semaphore(BATCH_PENDING_WRITES)
+            writes = set()
+            write_errors = []
+
+            def write_done(future):
+                pending_writes.release()
+                writes.discard(future)
+                if future.exception():
+                    write_errors.append(future.exception())
+
+            file_count = 0
+            with self.metrics.start(f"batch of {data_length} files", 'receive', 0) as transfer:
+                while True:
+                    relative_path = await self._read_name_async(reader, codec)
+                    if not relative_path:
+                        break
+                    file_size = await self._read_int_async(reader, codec)
+
+                    if file_size <= min(self.buffer_size, MAX_EXACT_SIZE):
+                        start = time.perf_counter()
+                        data = await self._read_exact(reader, file_size)
+                        if len(data) < file_size:
+                            raise ConnectionError("Client Disconnected")
+                        socket_time = time.perf_counter() - start
+                        await pending_writes.acquire()
+                        write = asyncio.ensure_future(self._run_on_disk(self._write_batch_file, relative_path, data))
+                        write.add_done_callback(write_done)
+                        writes.add(write)
+                        await self._throttle(transfer.add(file_size, socket_time=socket_time,
+                                                          disk_time=time.perf_counter() - start - socket_time, wait=False))
+                    else:
+                        file = await self._run_on_disk(self._create_unique_file, relative_path)
+                        try:
+                            received = await self._read_into_file(reader, file, file_size, transfer, self.tuners.get(writer))
+                        finally:
+                            await self._run_on_disk(file.close)
+                        if received < file_size:
+                            raise ConnectionError("Client Disconnected")
+                        await self._run_on_disk(self.catalog.add, pathlib.Path(file.name))
+                    file_count += 1
+
+                await asyncio.gather(*writes, return_exceptions=True)
+                if write_errors:
+                    raise write_errors[0]
+            print(f"\n{file_count} files downloaded")
+        except Exception:
+            print("Batch Download Error:", traceback.format_exc())
+            await self.notify_async(writer, 'Error Receiving Batch')
+            return b""
+        await self.notify_async(writer, f'Batch Downloaded: {file_count} files')
+        return b'Batch Saved'
+
+
+    async def _receive_events_request_async(self, reader, writer, codec, data_type, data_length):
+        try:
+            await self._read_exact(reader, data_length, MAX_CONTROL_SIZE)
+            token = self._new_event_token(writer)
+            await self.send_data_async(writer, json.dumps({'reply': 'Events', 'token': token}))
+            return b'Event Channel Requested'
+        except Exception:
+            print("Event Channel Request Error:", traceback.format_exc())
+            await self.send_data_async(writer, json.dumps({'reply': 'Events', 'error': 'Invalid Events Request'}))
+            return b""
+
+
+    async def _receive_resume_request_async(self, reader, writer, codec, data_type, data_length):
+        try:
+            request = json.loads((await self._read_exact(reader, data_length, MAX_CONTROL_SIZE)).decode("utf-8"))
+            offset, digest = await self._run_on_disk(
+                self.resume_store.get_resume_point, request['transfer_id'], request['filename'], request['file_size'])
+            if offset:
+                print(f"Resuming {request['filename']} from byte {offset}")
+            await self.send_data_async(writer, json.dumps({'reply': 'Resume', 'offset': offset, 'boundary_digest': digest}))
+            return b'Resume Offset Sent'
+        except Exception:
+            print("Resume Request Error:", traceback.format_exc())
+            await self.send_data_async(writer, json.dumps({'reply': 'Resume', 'error': 'Invalid Resume Request'}))
+            return b""
+
+
+    async def _receive_resume_data_async(self, reader, writer, codec, data_type, data_length):
+        try:
+            transfer_id = (await self._read_exact(reader, TRANSFER_ID_SIZE)).decode("utf-8")
+            offset = await self._read_int_async(reader, codec)
+            partial_file = await self._run_on_disk(self.resume_store.open, transfer_id, offset)
+            try:
+                with self.metrics.start(partial_file.metadata['filename'], 'receive', data_length) as transfer:
+                    received = await self._read_into_file(reader, partial_file, data_length, transfer, self.tuners.get(writer))
+            finally:
+                await self._run_on_disk(partial_file.close)
+            if received < data_length:
+                # Keep the partial file and its checkpoint for the next attempt
+                print("Client Disconnected")
+                return b""
+
+            metadata = await self._run_on_disk(self.resume_store.load, transfer_id)
+            if partial_file.offset != metadata['file_size']:
+                # Keep the checkpoint, the client can resume from it with the right length
+                raise ValueError(f"{metadata['filename']} ends at byte {partial_file.offset}, expected {metadata['file_size']}")
+            filepath = await self._run_on_disk(self._get_unique_filepath, metadata['filename'])
+            await self._run_on_disk(self.resume_store.complete, transfer_id, filepath)
+            await self._run_on_disk(self.catalog.add, filepath)
+        except Exception:
+            print("Resumable File Download Error:", traceback.format_exc())
+            await self.notify_async(writer, 'Error Receiving File')
+            return b""
+        await self.notify_async(writer, 'File Downloaded')
+        return b'File Saved'
+
+
+    async def _receive_delta_request_async(self, reader, writer, codec, data_type, data_length):
+        try:
+            request = json.loads((await self._read_exact(reader, data_length, MAX_CONTROL_SIZE)).decode("utf-8"))
+            reply = await self._run_on_disk(self._delta_signature_reply, request)
+            await self.send_data_async(writer, json.dumps(reply))
+            return b'Delta Signature Sent'
+        except Exception:
+            print("Delta Request Error:", traceback.format_exc())
+            await self.send_data_async(writer, json.dumps({'reply': 'Delta', 'error': 'Invalid Delta Request'}))
+            return b""
+
+
+    async def _receive_delta_data_async(self, reader, writer, codec, data_type, data_length):
+        """Rebuild a file from delta instructions as Server.receive_data does, with the file work on the disk executor."""
+
+        delta_writer = None
+        try:
+            metadata = json.loads(await self._read_name_async(reader, codec))
+            delta_writer = await self._run_on_disk(self._open_delta, metadata)
+            with self.metrics.start(metadata['filename'], 'receive', data_length) as transfer:
+                while True:
+                    start = time.perf_counter()
+                    instruction = await self._read_field(reader, 1)
+                    if instruction == COPY:
+                        first_block = await self._read_int_async(reader, codec)
+                        block_count = await self._read_int_async(reader, codec)
+                        socket_time = time.perf_counter() - start
+                        written = delta_writer.written
+                        await self._run_on_disk(delta_writer.copy, first_block, block_count)
+                    elif instruction == LITERAL:
+                        literal_length = await self._read_int_async(reader, codec)
+                        if literal_length > MAX_LITERAL_SIZE:
+                            raise ValueError(f"Literal of {literal_length} bytes is larger than {MAX_LITERAL_SIZE}")
+                        literal = await self._read_field(reader, literal_length)
+                        socket_time = time.perf_counter() - start
+                        written = delta_writer.written
+                        await self._run_on_disk(delta_writer.write, literal)
+                    elif instruction == END:
+                        digest = await self._read_name_async(reader, codec)
+                        break
+                    else:
+                        raise ConnectionError(f"Unknown delta instruction: {instruction}")
+                    await self._throttle(transfer.add(delta_writer.written - written, socket_time=socket_time,
+                                                      disk_time=time.perf_counter() - start - socket_time, wait=False))
+                filepath = await self._run_on_disk(self._finish_delta, delta_writer, metadata, digest, data_length)
+        except Exception:
+            print("Delta Download Error:", traceback.format_exc())
+            await self._run_on_disk(self._abort_delta, delta_writer)
+            await self.notify_async(writer, 'Error Receiving File')
+            return b""
+        print(f"{filepath.name} rebuilt: {delta_writer.literal_bytes} of {delta_writer.written} bytes received, "
+              f"the rest copied from the previous version")
+        await self.notify_async(writer, 'File Downloaded')
+        return b'File Saved'
+
+
+    async def _receive_offer_async(self, reader, writer, codec, data_type, data_length):
+        try:
+            request = json.loads((await self._read_exact(reader, data_length, MAX_CONTROL_SIZE)).decode("utf-8"))
+            reply = await self._run_on_disk(self._offer_reply, request)
+            await self.send_data_async(writer, json.dumps(reply))
+            return b'Offer Answered'
+        except Exception:
+            print("Offer Error:", traceback.format_exc())
+            await self.send_data_async(writer, json.dumps({'reply': 'Offer', 'error': 'Invalid Offer'}))
+            return b""
+
+
+    async def _receive_udp_async(self, reader, writer, codec, data_type, data_length):
+        """Receive a file over the UDP transport as Server.receive_data does; the datagram loop runs on a thread of its own."""
+
+        try:
+            request = json.loads((await self._read_exact(reader, data_length, MAX_CONTROL_SIZE)).decode("utf-8"))
+            udp_receiver = await self._run_on_disk(self._open_udp_receiver, request, writer.get_extra_info('sockname')[0])
+        except Exception:
+            print("UDP Transfer Setup Error:", traceback.format_exc())
+            await self.send_data_async(writer, json.dumps({'reply': 'Udp', 'error': 'Invalid UDP Transfer'}))
+            return b'UDP Transfer Refused'
+        loop = asyncio.get_running_loop()
+
+        def send_report(report):
+            encoded_report = json.dumps(report).encode("utf-8")
+            loop.call_soon_threadsafe(writer.writelines, [codec.pack_int(len(encoded_report)), encoded_report])
+
+        try:
+            await self.send_data_async(writer, json.dumps({'reply': 'Udp', 'port': udp_receiver.port, 'token': udp_receiver.token.hex()}))
+            try:
+                with self.metrics.start(request['filename'], 'receive', udp_receiver.file_size) as transfer:
+                    # Not on the disk executor, the loop keeps its thread for the whole transfer
+                    complete = await loop.run_in_executor(None, udp_receiver.run, send_report, transfer)
+                if complete:
+                    await self._run_on_disk(self._finish_udp_receiver, udp_receiver)
+            finally:
+                await self._run_on_disk(self._abort_udp_receiver, udp_receiver)
+            print(f"{udp_receiver.received_blocks} blocks received over UDP, {udp_receiver.duplicates} duplicates")
+        except Exception:
+            print("UDP File Download Error:", traceback.format_exc())
+            await self.notify_async(writer, 'Error Receiving File')
+            return b""
+        if not complete:
+            print("The sender went quiet, UDP transfer abandoned")
+            await self.notify_async(writer, 'Error Receiving File')
+            return b'File Discarded'
+        await self.notify_async(writer, 'File Downloaded')
+        return b'File Saved'
+
+
+    async def _receive_stats_request_async(self, reader, writer, codec, data_type, data_length):
+        try:
+            await self._read_exact(reader, data_length, MAX_CONTROL_SIZE)
+            await self.send_data_async(writer, json.dumps({'reply': 'Stats', **self.stats()}))
+            return b'Stats Sent'
+        except Exception:
+            print("Stats Request Error:", traceback.format_exc())
+            await self.send_data_async(writer, json.dumps({'reply': 'Stats', 'error': 'Invalid Stats Request'}))
+            return b""
+
+
+    async def _receive_pipe_async(self, reader, writer, codec, data_type, data_length):
+        """Receive a 'Pipe' stream chunk by chunk, as Server._receive_pipe does, writing each chunk on the disk executor."""
+
+        try:
+            name = await self._read_name_async(reader, codec)
+            async with self.pipe_output_lock:
+                disk_writer = None if self.pipe_output else await self._run_on_disk(self._open_disk_writer, name, 0)
+                output = disk_writer or self.pipe_output
+                try:
+                    with self.metrics.start(name, 'receive', 0) as transfer:
+                        output = self.relay.tee(output, transfer)
+                        while chunk_length := await self._read_int_async(reader, codec):
+                            received = await self._read_into_file(reader, output, chunk_length, transfer, self.tuners.get(writer))
+                            if received < chunk_length:
+                                transfer.finish('failed')
+                                print("Client Disconnected")
+                                return b""
+                            if not disk_writer:
+                                await self._run_on_disk(output.flush)
+                    if disk_writer:
+                        await self._run_on_disk(self._finish_disk_writer, disk_writer)
+                finally:
+                    if disk_writer:
+                        await self._run_on_disk(self._abort_disk_writer, disk_writer)
+        except Exception:
+            print("Pipe Receiving Error:", traceback.format_exc())
+            await self.notify_async(writer, 'Error Receiving Pipe')
+            return b""
+        await self.notify_async(writer, 'Pipe Received')
+        return b'Pipe Saved'
+
+
+    async def _receive_text_async(self, reader, writer, codec, data_type, data_length):
+        data = await self._read_exact(reader, data_length, MAX_CONTROL_SIZE)
+        if len(data) < data_length:
+            print("Client Disconnected")
+            return b""
+        if data_type == 'Text':
+            await self.notify_async(writer, 'Text Received')
+        return data
+
+
+def start_async_server(s: AsyncServer = None):
+    s = s or AsyncServer()
+    try:
+        asyncio.run(s.serve())
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        print('Unexpected Server Error:\n', traceback.format_exc())
+    finally:
+        # Closing the sockets forces every client to close its socket from its side
+        s.server.close()
+        s.disk_executor.shutdown()
+        print("Shutting down the server")
+
+
+if __name__ == "__main__":
+    start_async_server()
@@ -0,0 +1,620 @@
+"""
+Loopback benchmark of the file transfer engines.
+
+Every case starts a Server (or AsyncServer) and one or more Clients on 127.0.0.1 in a
+fresh process, so CPU time and peak RSS belong to that case alone. Cases are the product
+of the swept file sizes, file counts, chunk sizes and numbers of concurrent senders.
+
+    python benchmark.py run --sizes 1K,1M,256M --counts 1,100 --senders 1,8 --engine async -o after.json
+    python benchmark.py compare before.json after.json
+    python benchmark.py startup --engine async --rtt-ms 10
+    python benchmark.py run --sizes 256M --rtt-ms 200 --loss 0.01 --client-options '{"udp_rate": 50e6}'
+
+startup measures what a one-shot transfer pays before its first byte: the time a fresh
+interpreter takes to import the client and server modules, and the time from opening a
+connection until it is ready to send, for every protocol version.
+
+--rtt-ms puts a proxy between the clients and the server that delays everything by half the
+round trip each way and, like the window of a TCP connection, lets no more than --window bytes
+be in flight. Datagrams of the UDP transport don't pass the proxy, the client delays them itself
+and drops --loss of them; the loss doesn't apply to TCP, whose losses the kernel would repair.
+"""
+
+import argparse
+import collections
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+
+from protocol import PROTOCOL_VERSION
+from recv_buffer import DEFAULT_BUFFER_SIZE
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+GENERATE_BLOCK_SIZE = 8 * 1024 * 1024   # Bytes of random data written at a time when generating test files
+CASE_TIMEOUT = 600                      # Seconds a case may run before it is abandoned
+HANDSHAKE_TIMEOUT = 30                  # Seconds to wait for every sender to connect
+STARTUP_MODULES = ('client', 'server', 'async_server', 'send_queue')
+REGRESSION_THRESHOLD = 0.10             # Relative change reported as a regression by compare
+
+COMPLETED_EVENTS = ('File Downloaded', 'File Verified', 'Batch Downloaded')
+CASE_KEYS = ('engine', 'mode', 'content', 'size', 'count', 'chunk_size', 'senders', 'client_options', 'rtt_ms', 'loss', 'window')
+# metric -> True if a higher value is better
+METRICS = {
+    'throughput_mb_s': True,
+    'ttfb_ms': False,
+    'handshake_ms': False,
+    'cpu_s': False,
+    'peak_rss_mb': False,
+}
+
+
+def default_window() -> int:
+    """Largest window a Linux receiver advertises by default: about half of its largest TCP receive buffer."""
+
+    try:
+        with open('/proc/sys/net/ipv4/tcp_rmem', encoding='ascii') as tcp_rmem:
+            return int(tcp_rmem.read().split()[2]) // 2
+    except (OSError, ValueError, IndexError):
+        return 3 * 1024 * 1024
+
+
+def parse_size(text: str) -> int:
+    """'64K', '1M', '4G' or a number of bytes."""
+
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1] if text and text[-1] in SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def format_size(size: int) -> str:
+    for unit in ('G', 'M', 'K'):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{unit}"
+    return str(size)
+
+
+def make_dataset(data_directory: pathlib.Path, size: int, count: int, content: str) -> pathlib.Path:
+    """
+    Directory of <count> files of <size> bytes, reused by every case that needs the same files.
+
+    'random' files are incompressible generated data; 'sparse' files are holes created with
+    truncate, which takes no time or disk space even for files of several GB.
+    """
+
+    directory = data_directory / f"{content}-{format_size(size)}x{count}"
+    if directory.is_dir():
+        return directory
+    partial_directory = directory.with_name(directory.name + '.partial')
+    shutil.rmtree(partial_directory, ignore_errors=True)
+    partial_directory.mkdir(parents=True)
+    for index in range(count):
+        with open(partial_directory / f"{index}.bin", 'wb') as file:
+            if content == 'sparse':
+                file.truncate(size)
+                continue
+            remaining = size
+            while remaining:
+                block = os.urandom(min(GENERATE_BLOCK_SIZE, remaining))
+                file.write(block)
+                remaining -= len(block)
+    os.replace(partial_directory, directory)
+    return directory
+
+
+def _start_server(engine: str, chunk_size: int, download_location: pathlib.Path):
+    """
+    Start a receiver on an ephemeral loopback port.
+
+    :return: (server, port). The server records in first_byte_time when it starts writing the first file.
+    """
+
+    if engine == 'async':
+        import asyncio
+        from async_server import AsyncServer as server_class
+    else:
+        from server import Server as server_class
+
+    class BenchmarkServer(server_class):
+        first_byte_time = None
+
+        def _get_unique_filepath(self, filename):
+            if self.first_byte_time is None:
+                self.first_byte_time = time.perf_counter()
+            return super()._get_unique_filepath(filename)
+
+        def _create_unique_file(self, relative_path):
+            if self.first_byte_time is None:
+                self.first_byte_time = time.perf_counter()
+            return super()._create_unique_file(relative_path)
+
+    server = BenchmarkServer(server_ip='127.0.0.1', port=0, max_connections=128, buffer_size=chunk_size,
+                             download_location=download_location)
+    if engine == 'async':
+        threading.Thread(target=lambda: asyncio.run(server.serve()), daemon=True).start()
+    else:
+        def accept_connections():
+            while True:
+                conn, addr = server.server.accept()
+                threading.Thread(target=server.handle_client, args=(conn, addr), daemon=True).start()
+        threading.Thread(target=accept_connections, daemon=True).start()
+    return server, server.server.getsockname()[1]
+
+
+def _cpu_time() -> float:
+    cpu_times = psutil.Process().cpu_times()
+    return cpu_times.user + cpu_times.system
+
+
+def _peak_rss_mb() -> float:
+    if resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+
+
+def run_case(case: dict, dataset: pathlib.Path) -> dict:
+    """
+    Run one case in the current process and measure it.
+
+    Throughput and CPU time cover everything from the moment all senders are connected until
+    the server has notified the completion of every file; time to first byte is measured until
+    the server starts writing the first file.
+    """
+
+    from client import Client
+
+    workdir = pathlib.Path(tempfile.mkdtemp(prefix='file-transfer-benchmark-'))
+    try:
+        server, port = _start_server(case['engine'], case['chunk_size'], workdir / 'Downloads')
+        client_options = dict(case['client_options'])
+        if case.get('rtt_ms'):
+            port = _start_delay_proxy(port, case['rtt_ms'] / 2000, case.get('window') or default_window())
+            client_options.setdefault('udp_delay', case['rtt_ms'] / 2000)
+        if case.get('loss'):
+            client_options.setdefault('udp_loss', case['loss'])
+        filepaths = sorted(dataset.iterdir())
+        expected_events = 1 if case['mode'] == 'batch' else len(filepaths)
+
+        completed = threading.Condition()
+        state = {'completed': 0, 'errors': []}
+
+        def on_event(message):
+            with completed:
+                if message.startswith(COMPLETED_EVENTS):
+                    state['completed'] += 1
+                else:
+                    state['errors'].append(message)
+                completed.notify_all()
+
+        handshakes = []
+        start = threading.Event()
+        connected = threading.Barrier(case['senders'] + 1, timeout=HANDSHAKE_TIMEOUT)
+
+        def sender(index):
+            try:
+                handshake_start = time.perf_counter()
+                client = Client(server_ip='127.0.0.1', port=port, buffer_size=case['chunk_size'],
+                                username=f"sender{index}", event_callback=on_event, **client_options)
+                if client.client_closed:
+                    raise ConnectionError(f"sender{index} was rejected by the server")
+                client.open_event_channel()
+                threading.Thread(target=client.listen_events, daemon=True).start()
+                handshakes.append(time.perf_counter() - handshake_start)
+            except Exception as e:
+                state['errors'].append(f"{type(e).__name__}: {e}")
+                connected.abort()
+                return
+            connected.wait()
+            start.wait()
+            try:
+                if case['mode'] == 'batch':
+                    client.send_directory(str(dataset))
+                else:
+                    for filepath in filepaths:
+                        client.send_data(str(filepath), 'File')
+                with completed:
+                    completed.wait_for(lambda: state['completed'] + len(state['errors']) >= expected_events * case['senders'],
+                                       timeout=CASE_TIMEOUT)
+            finally:
+                client.close()
+
+        senders = [threading.Thread(target=sender, args=(index,), daemon=True) for index in range(case['senders'])]
+        for thread in senders:
+            thread.start()
+        try:
+            connected.wait()
+        except threading.BrokenBarrierError:
+            raise ConnectionError(f"Senders failed to connect: {'; '.join(state['errors'])}")
+
+        cpu_start = _cpu_time()
+        start_time = time.perf_counter()
+        start.set()
+        with completed:
+            completed.wait_for(lambda: state['completed'] + len(state['errors']) >= expected_events * case['senders'],
+                               timeout=CASE_TIMEOUT)
+        elapsed = time.perf_counter() - start_time
+        cpu = _cpu_time() - cpu_start
+        for thread in senders:
+            thread.join(timeout=HANDSHAKE_TIMEOUT)
+
+        total_bytes = sum(filepath.stat().st_size for filepath in filepaths) * case['senders']
+        if state['completed'] < expected_events * case['senders'] and not state['errors']:
+            state['errors'].append(f"Timed out with {state['completed']} of {expected_events * case['senders']} transfers completed")
+        return {
+            'throughput_mb_s': total_bytes / elapsed / (1024 * 1024),
+            'ttfb_ms': (server.first_byte_time - start_time) * 1000 if server.first_byte_time else None,
+            'handshake_ms': statistics.mean(handshakes) * 1000,
+            'cpu_s': cpu,
+            'peak_rss_mb': _peak_rss_mb(),
+            'elapsed_s': elapsed,
+            'bytes': total_bytes,
+            'errors': state['errors'],
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _run_case_process(case: dict, dataset: pathlib.Path, results, verbose: bool):
+    try:
+        with contextlib.ExitStack() as stack:
+            if not verbose:
+                # Progress output of the client and server costs time and hides the results
+                stack.enter_context(contextlib.redirect_stdout(open(os.devnull, 'w')))
+            results.put(run_case(case, dataset))
+    except Exception as e:
+        results.put({'errors': [f"{type(e).__name__}: {e}"]})
+
+
+def run_isolated(case: dict, dataset: pathlib.Path, verbose: bool = False) -> dict:
+    """Run a case in a child process so its CPU time and peak RSS aren't mixed with other cases."""
+
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case_process, args=(case, dataset, results, verbose), daemon=True)
+    process.start()
+    try:
+        return results.get(timeout=CASE_TIMEOUT + HANDSHAKE_TIMEOUT)
+    except Exception:
+        return {'errors': ['Case did not finish in time']}
+    finally:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+
+def measure_imports(modules, repeat: int) -> dict:
+    """
+    Median milliseconds a fresh interpreter takes to import each module, over what it takes to start
+    and import nothing.
+    """
+
+    root = pathlib.Path(__file__).resolve().parent
+
+    def interpreter_time(code):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=root, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return time.perf_counter() - start
+
+    baseline = statistics.median(interpreter_time('pass') for _ in range(repeat))
+    return {module: (statistics.median(interpreter_time(f"import {module}") for _ in range(repeat)) - baseline) * 1000
+            for module in modules}
+
+
+def _start_delay_proxy(target_port: int, one_way_delay: float, window: int = None) -> int:
+    """
+    Loopback TCP proxy to <target_port> that holds everything it forwards for <one_way_delay> seconds,
+    so round trips cost what they would on a real network.
+
+    As with the window of a TCP connection, at most <window> bytes are in flight in each direction:
+    a byte counts from the moment it is read until its acknowledgement would be back, one round trip later.
+
+    :return: Port of the proxy.
+    """
+
+    listener = socket.create_server(('127.0.0.1', 0))
+    window = window or default_window()
+
+    def forward(source, destination):
+        line = collections.deque()              # (due time, data) on its way to <destination>
+        acknowledgements = collections.deque()  # (time the window opens again, length)
+        condition = threading.Condition()
+        state = {'in_flight': 0, 'closed': False}
+
+        def deliver():
+            try:
+                while True:
+                    with condition:
+                        condition.wait_for(lambda: line or state['closed'])
+                        if not line:
+                            return
+                        due, data = line.popleft()
+                    if due > time.monotonic():
+                        time.sleep(due - time.monotonic())
+                    destination.sendall(data)
+            except OSError:
+                pass
+            finally:
+                with contextlib.suppress(OSError):
+                    destination.shutdown(socket.SHUT_WR)
+
+        threading.Thread(target=deliver, daemon=True).start()
+        try:
+            while data := source.recv(65536):
+                with condition:
+                    while True:
+                        now = time.monotonic()
+                        while acknowledgements and acknowledgements[0][0] <= now:
+                            state['in_flight'] -= acknowledgements.popleft()[1]
+                        if not acknowledgements or state['in_flight'] + len(data) <= window:
+                            break
+                        condition.wait(acknowledgements[0][0] - now)
+                    state['in_flight'] += len(data)
+                    acknowledgements.append((now + 2 * one_way_delay, len(data)))
+                    line.append((now + one_way_delay, data))
+                    condition.notify_all()
+        except OSError:
+            pass
+        finally:
+            with condition:
+                state['closed'] = True
+                condition.notify_all()
+
+    def accept_connections():
+        while True:
+            downstream, _ = listener.accept()
+            upstream = socket.create_connection(('127.0.0.1', target_port))
+            threading.Thread(target=forward, args=(downstream, upstream), daemon=True).start()
+            threading.Thread(target=forward, args=(upstream, downstream), daemon=True).start()
+
+    threading.Thread(target=accept_connections, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def measure_handshakes(engine: str, protocol_versions, count: int, rtt: float = 0.0) -> dict:
+    """
+    Median milliseconds from opening a connection until it has a username and an event channel,
+    over <count> connections per protocol version, each closed before the next one opens.
+
+    :param rtt: Round trip time in seconds added by a delaying proxy between client and server.
+    """
+
+    from client import Client
+
+    workdir = pathlib.Path(tempfile.mkdtemp(prefix='file-transfer-benchmark-'))
+    try:
+        server, port = _start_server(engine, DEFAULT_BUFFER_SIZE, workdir)
+        if rtt:
+            port = _start_delay_proxy(port, rtt / 2)
+        results = {}
+        for version in protocol_versions:
+            handshakes = []
+            for index in range(count):
+                start = time.perf_counter()
+                client = Client(server_ip='127.0.0.1', port=port, username=f"startup{version}x{index}", protocol_version=version)
+                if client.client_closed:
+                    raise ConnectionError(f"Connection {index} with protocol v{version} was rejected by the server")
+                client.open_event_channel()
+                handshakes.append(time.perf_counter() - start)
+                client.close()
+                # The threaded engine accepts the next sender once it has dropped this one
+                deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+                while server.client_dict and time.monotonic() < deadline:
+                    time.sleep(0.001)
+            results[f"v{version}"] = statistics.median(handshakes) * 1000
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_startup(args) -> dict:
+    imports = measure_imports(STARTUP_MODULES, args.repeat)
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(open(os.devnull, 'w')))
+        handshakes = measure_handshakes(args.engine, args.protocol_versions, args.connections, args.rtt_ms / 1000)
+    return {'engine': args.engine, 'rtt_ms': args.rtt_ms, 'import_ms': imports, 'handshake_ms': handshakes}
+
+
+def _median_result(runs):
+    """Median of every metric over repeated runs of a case."""
+
+    result = {'runs': len(runs), 'errors': [error for run in runs for error in run.get('errors', [])]}
+    for metric in list(METRICS) + ['elapsed_s', 'bytes']:
+        values = [run[metric] for run in runs if run.get(metric) is not None]
+        result[metric] = statistics.median(values) if values else None
+    return result
+
+
+def run_benchmark(args) -> dict:
+    client_options = json.loads(args.client_options)
+    data_directory = pathlib.Path(args.data_dir)
+    cases = []
+    for size, count, chunk_size, senders in itertools.product(
+            args.sizes, args.counts, args.chunk_sizes, args.senders):
+        case = {'engine': args.engine, 'mode': args.mode, 'content': args.content, 'size': size, 'count': count,
+                'chunk_size': chunk_size, 'senders': senders, 'client_options': client_options,
+                'rtt_ms': args.rtt_ms, 'loss': args.loss, 'window': args.window}
+        if args.engine == 'threaded' and senders > 1:
+            # Server accepts a single sender at a time
+            print(f"Skipping {describe_case(case)}: the threaded engine accepts one sender at a time", file=sys.stderr)
+            continue
+        cases.append(case)
+
+    results = []
+    for number, case in enumerate(cases, start=1):
+        dataset = make_dataset(data_directory, case['size'], case['count'], case['content'])
+        runs = [run_isolated(case, dataset, args.verbose) for _ in range(args.repeat)]
+        result = {**case, **_median_result(runs)}
+        results.append(result)
+        print(f"[{number}/{len(cases)}] {describe_case(case)}: {describe_result(result)}", file=sys.stderr)
+
+    return {
+        'metadata': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'hostname': socket.gethostname(),
+            'arguments': sys.argv[1:],
+        },
+        'results': results,
+    }
+
+
+def describe_case(case: dict) -> str:
+    options = f" {json.dumps(case['client_options'])}" if case['client_options'] else ""
+    link = f", rtt {case['rtt_ms']:g} ms" if case.get('rtt_ms') else ""
+    link += f", loss {case['loss']:g}" if case.get('loss') else ""
+    return (f"{case['engine']} {case['mode']} {case['count']}x{format_size(case['size'])} {case['content']}, "
+            f"chunk {format_size(case['chunk_size'])}, {case['senders']} sender(s){link}{options}")
+
+
+def describe_result(result: dict) -> str:
+    if result.get('throughput_mb_s') is None:
+        return f"failed: {'; '.join(result['errors'])}"
+    ttfb = f"{result['ttfb_ms']:.1f}" if result['ttfb_ms'] is not None else '-'
+    text = (f"{result['throughput_mb_s']:.1f} MB/s, ttfb {ttfb} ms, handshake {result['handshake_ms']:.1f} ms, "
+            f"cpu {result['cpu_s']:.2f} s, peak rss {result['peak_rss_mb']:.0f} MB")
+    if result['errors']:
+        text += f" ({len(result['errors'])} errors)"
+    return text
+
+
+def case_key(result: dict):
+    # Results written before a key existed match cases that leave it unset
+    return json.dumps([result.get(key) or None for key in CASE_KEYS], sort_keys=True)
+
+
+def compare_runs(baseline: dict, current: dict, threshold: float = REGRESSION_THRESHOLD):
+    """
+    Compare the metrics of the cases both runs have in common.
+
+    :return: (rows, regressions) where every row is (case description, metric, baseline, current, relative change)
+             and regressions are the rows whose change is worse than <threshold>.
+    """
+
+    baseline_results = {case_key(result): result for result in baseline['results']}
+    rows = []
+    regressions = []
+    for result in current['results']:
+        previous = baseline_results.get(case_key(result))
+        if not previous:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            before, after = previous.get(metric), result.get(metric)
+            if before is None or after is None or before == 0:
+                continue
+            change = (after - before) / before
+            row = (describe_case(result), metric, before, after, change)
+            rows.append(row)
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(row)
+    return rows, regressions
+
+
+def _size_list(text: str):
+    return [parse_size(size) for size in text.split(',')]
+
+
+def _int_list(text: str):
+    return [int(value) for value in text.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Loopback benchmark of the file transfer client and server.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="Run a sweep of cases and write the results as JSON.")
+    run.add_argument('--sizes', type=_size_list, default=_size_list('1K,1M,64M'),
+                     help="File sizes, e.g. 1K,1M,4G (default: %(default)s)")
+    run.add_argument('--counts', type=_int_list, default=[1], help="Numbers of files each sender sends (default: 1)")
+    run.add_argument('--chunk-sizes', type=_size_list, default=_size_list('256K'),
+                     help="Client and server buffer sizes (default: 256K)")
+    run.add_argument('--senders', type=_int_list, default=[1], help="Numbers of concurrent senders (default: 1)")
+    run.add_argument('--engine', choices=('threaded', 'async'), default='threaded')
+    run.add_argument('--mode', choices=('file', 'batch'), default='file',
+                     help="Send every file with send_data, or all of them as one directory batch")
+    run.add_argument('--content', choices=('random', 'sparse'), default='random',
+                     help="Generated incompressible data, or sparse files for sizes of several GB")
+    run.add_argument('--client-options', default='{}',
+                     help='JSON object of extra Client arguments, e.g. \'{"compression": "zlib"}\'')
+    run.add_argument('--rtt-ms', type=float, default=0.0,
+                     help="Round trip time added between clients and server by a delaying proxy (default: 0)")
+    run.add_argument('--window', type=parse_size, default=None,
+                     help="Bytes the proxy lets be in flight per direction (default: half the largest TCP receive buffer)")
+    run.add_argument('--loss', type=float, default=0.0,
+                     help="Fraction of the UDP transport's datagrams to drop (default: 0)")
+    run.add_argument('--repeat', type=int, default=1, help="Runs per case; the median of each metric is kept")
+    run.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'file-transfer-benchmark-data'),
+                     help="Where generated files are kept between runs (default: %(default)s)")
+    run.add_argument('-o', '--output', help="JSON file to write the results to (default: stdout)")
+    run.add_argument('-v', '--verbose', action='store_true', help="Show the output of the client and server")
+
+    compare = commands.add_parser('compare', help="Compare two result files and report regressions.")
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                         help="Relative change reported as a regression (default: %(default)s)")
+
+    startup = commands.add_parser('startup', help="Measure import time and connection handshake latency.")
+    startup.add_argument('--engine', choices=('threaded', 'async'), default='threaded')
+    startup.add_argument('--protocol-versions', type=_int_list, default=[PROTOCOL_VERSION, 4, 1],
+                         help="Protocol versions the client connects with (default: %(default)s)")
+    startup.add_argument('--connections', type=int, default=50, help="Connections per protocol version (default: 50)")
+    startup.add_argument('--rtt-ms', type=float, default=0.0,
+                         help="Round trip time added between client and server by a delaying proxy (default: 0)")
+    startup.add_argument('--repeat', type=int, default=10, help="Interpreter starts per module (default: 10)")
+    startup.add_argument('-v', '--verbose', action='store_true', help="Show the output of the client and server")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'startup':
+        report = run_startup(args)
+        for module, milliseconds in report['import_ms'].items():
+            print(f"import {module:<28} {milliseconds:>8.1f} ms")
+        for version, milliseconds in report['handshake_ms'].items():
+            print(f"{args.engine} handshake, protocol {version}, rtt {args.rtt_ms:g} ms {milliseconds:>8.2f} ms")
+        return 0
+
+    if args.command == 'run':
+        report = run_benchmark(args)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as output:
+                json.dump(report, output, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        return 1 if any(result['errors'] for result in report['results']) else 0
+
+    with open(args.baseline, encoding='utf-8') as baseline, open(args.current, encoding='utf-8') as current:
+        rows, regressions = compare_runs(json.load(baseline), json.load(current), args.threshold)
+    for case, metric, before, after, change in rows:
+        marker = ' REGRESSION' if (case, metric, before, after, change) in regressions else ''
+        print(f"{case:<70} {metric:<16} {before:>10.2f} -> {after:>10.2f} ({change:+.1%}){marker}")
+    print(f"{len(regressions)} regression(s) over {args.threshold:.0%} in {len(rows)} compared metrics")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,300 @@
+import contextlib
+import hashlib
+import json
+import os
+import pathlib
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks on Windows, only a catalog private to one process is available there
+    fcntl = None
+
+from integrity import HASH_BLOCK_SIZE
+
+
+CATALOG_FILENAME = '.catalog.jsonl'     # Journal of the catalog, kept in download_location
+CATALOG_LOCK_FILENAME = '.catalog.lock' # Locked by the process using a shared catalog
+CATALOG_ALGORITHM = 'blake2b'           # Content hash of catalog entries, the same as a 'blake2b' Verified digest
+
+
+def hash_file(filepath: pathlib.Path) -> str:
+    digest = hashlib.new(CATALOG_ALGORITHM)
+    with open(filepath, 'rb') as file:
+        while block := file.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Catalog():
+    """
+    Name, size, mtime and content hash of every file in download_location.
+
+    It is kept in a journal of JSON lines that is replayed and compacted when the catalog is
+    loaded, after checking every entry against the directory, and appended to as files arrive.
+    Content hashes are recorded when a transfer already computed one and otherwise computed
+    the first time a file of the same size is offered.
+
+    New names are reserved from memory: the first free (cN) copy number of every name is
+    remembered, so finding one doesn't stat every earlier copy.
+
+    A shared catalog is used by several processes receiving into the same download_location.
+    Every operation holds an exclusive lock on CATALOG_LOCK_FILENAME and first replays what
+    the other processes appended to the journal since; names are still created exclusively,
+    so two processes never reserve the same one.
+    """
+
+    def __init__(self, download_location: pathlib.Path, shared: bool = False):
+        """:param shared: Other processes use the same download_location and catalog at the same time."""
+
+        if shared and fcntl is None:
+            raise ValueError("A shared catalog needs fcntl file locks, which this platform doesn't have")
+        self.download_location = pathlib.Path(download_location)
+        self.journal_path = self.download_location / CATALOG_FILENAME
+        self.entries = {}       # relative name -> {'size', 'mtime_ns', 'hash'}
+        self.by_size = {}       # size -> set of relative names
+        self.taken = set()      # relative names of files and of reserved names
+        self.next_copy = {}     # (parent, stem, suffix) -> first copy number that may be free
+        self.lock = threading.Lock()
+        self.shared = shared
+        self.lock_file = None
+        self.journal_inode = None       # Journal replayed so far, a compaction by another process replaces it
+        self.journal_position = 0       # End of what has been replayed of it
+        if shared:
+            self.download_location.mkdir(parents=True, exist_ok=True)
+            self.lock_file = open(self.download_location / CATALOG_LOCK_FILENAME, 'ab')
+        self.load()
+
+
+    def _name(self, filepath: pathlib.Path) -> str:
+        return pathlib.Path(filepath).relative_to(self.download_location).as_posix()
+
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """Keep other processes out of a shared catalog."""
+
+        if not self.shared:
+            yield
+            return
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the catalog, up to date with the journal records of other processes if it is shared."""
+
+        with self.lock, self._file_lock():
+            if self.shared:
+                self._catch_up()
+            yield
+
+
+    def _catch_up(self):
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self.journal_inode:
+            # Compacted by another process: every entry is in the new journal again
+            self.journal_inode = stat.st_ino
+            self.journal_position = 0
+        if stat.st_size <= self.journal_position:
+            return
+        with open(self.journal_path, 'rb') as journal:
+            journal.seek(self.journal_position)
+            data = journal.read()
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                break
+            self.journal_position += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            name = record['name']
+            if record.get('op') == 'remove':
+                self._drop_entry(name)
+                self.taken.discard(name)
+            else:
+                self._set_entry(name, record['size'], record['mtime_ns'], record['hash'])
+
+
+    def load(self):
+        """Replay the journal, drop entries whose file changed or is gone, add new files and compact the journal."""
+
+        with self.lock, self._file_lock():
+            recorded = {}
+            try:
+                with open(self.journal_path, 'r', encoding='utf-8') as journal:
+                    for line in journal:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # A line cut short by a crash
+                            continue
+                        if record.get('op') == 'remove':
+                            recorded.pop(record['name'], None)
+                        else:
+                            recorded[record['name']] = record
+            except FileNotFoundError:
+                pass
+
+            self.entries.clear()
+            self.by_size.clear()
+            self.taken.clear()
+            self.next_copy.clear()
+            for directory, dirnames, filenames in os.walk(self.download_location):
+                # Partial files, sidecars and the journal itself are hidden
+                dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+                for filename in filenames:
+                    filepath = pathlib.Path(directory) / filename
+                    name = self._name(filepath)
+                    self.taken.add(name)
+                    if filename.startswith('.') or filename.endswith('.part'):
+                        continue
+                    try:
+                        stat = filepath.stat()
+                    except OSError:
+                        continue
+                    record = recorded.get(name)
+                    unchanged = record and (record['size'], record['mtime_ns']) == (stat.st_size, stat.st_mtime_ns)
+                    self._set_entry(name, stat.st_size, stat.st_mtime_ns, record['hash'] if unchanged else None)
+
+            self.download_location.mkdir(parents=True, exist_ok=True)
+            temp_path = self.journal_path.with_suffix('.tmp')
+            with open(temp_path, 'w', encoding='utf-8') as journal:
+                for name, entry in self.entries.items():
+                    journal.write(json.dumps({'op': 'add', 'name': name, **entry}) + '\n')
+            os.replace(temp_path, self.journal_path)
+            stat = os.stat(self.journal_path)
+            self.journal_inode, self.journal_position = stat.st_ino, stat.st_size
+
+
+    def _set_entry(self, name: str, size: int, mtime_ns: int, content_hash: str = None):
+        old = self.entries.get(name)
+        if old:
+            self.by_size.get(old['size'], set()).discard(name)
+        self.entries[name] = {'size': size, 'mtime_ns': mtime_ns, 'hash': content_hash}
+        self.by_size.setdefault(size, set()).add(name)
+        self.taken.add(name)
+
+
+    def _drop_entry(self, name: str):
+        entry = self.entries.pop(name, None)
+        if entry:
+            self.by_size.get(entry['size'], set()).discard(name)
+
+
+    def _append(self, record: dict):
+        with open(self.journal_path, 'ab') as journal:
+            journal.write((json.dumps(record) + '\n').encode('utf-8'))
+            self.journal_position = journal.tell()
+
+
+    def reserve(self, relative_path: str):
+        """
+        Create a new file for <relative_path> under download_location, adding a (cN) suffix if the name is taken.
+
+        :param relative_path: '/' separated path, e.g. of a batch entry; it may not leave download_location.
+        :return: The new file opened for binary writing. Pass its path to add() once it is complete
+                 or to release() if it is thrown away.
+        """
+
+        relative_path = pathlib.PurePosixPath(relative_path)
+        if relative_path.is_absolute() or '..' in relative_path.parts or not relative_path.parts:
+            raise ValueError(f"Unsafe path: {relative_path}")
+        filepath = self.download_location.joinpath(*relative_path.parts)
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        key = (relative_path.parent.as_posix(), relative_path.stem, relative_path.suffix)
+
+        with self._locked():
+            candidate = filepath
+            copy_count = self.next_copy.get(key, 1)
+            while True:
+                name = self._name(candidate)
+                if name not in self.taken:
+                    # Exclusive creation still guards against files the catalog doesn't know about
+                    try:
+                        file = open(file=candidate, mode='xb')
+                    except FileExistsError:
+                        pass
+                    else:
+                        self.taken.add(name)
+                        if candidate != filepath:
+                            self.next_copy[key] = copy_count
+                        return file
+                    self.taken.add(name)
+                if candidate != filepath:
+                    copy_count += 1
+                candidate = filepath.with_name(f"{filepath.stem}(c{copy_count}){filepath.suffix}")
+
+
+    def reserve_path(self, relative_path: str) -> pathlib.Path:
+        """Same as reserve(), for callers that move a finished file over the reserved name."""
+
+        with self.reserve(relative_path) as file:
+            return pathlib.Path(file.name)
+
+
+    def add(self, filepath: pathlib.Path, content_hash: str = None):
+        """Record a complete file; <content_hash> is its CATALOG_ALGORITHM hex digest when already known."""
+
+        stat = pathlib.Path(filepath).stat()
+        name = self._name(filepath)
+        with self._locked():
+            self._set_entry(name, stat.st_size, stat.st_mtime_ns, content_hash)
+            self._append({'op': 'add', 'name': name, **self.entries[name]})
+
+
+    def release(self, filepath: pathlib.Path):
+        """Forget a reserved name whose file was removed before it was complete."""
+
+        with self._locked():
+            self.taken.discard(self._name(filepath))
+
+
+    def remove(self, filepath: pathlib.Path):
+        name = self._name(filepath)
+        with self._locked():
+            self.taken.discard(name)
+            if name in self.entries:
+                self._drop_entry(name)
+                self._append({'op': 'remove', 'name': name})
+
+
+    def find(self, size: int, content_hash: str):
+        """
+        Look for a file with this size and content hash, hashing same sized files that have no hash yet.
+
+        :return: Relative name of the file, or None.
+        """
+
+        with self._locked():
+            candidates = [(name, dict(self.entries[name])) for name in self.by_size.get(size, ())]
+        # Known hashes first, hashing a file is only needed when none of them matches
+        candidates.sort(key=lambda candidate: candidate[1]['hash'] is None)
+        for name, entry in candidates:
+            filepath = self.download_location / name
+            try:
+                stat = filepath.stat()
+                if (stat.st_size, stat.st_mtime_ns) != (entry['size'], entry['mtime_ns']):
+                    # Changed behind the catalog's back
+                    self.add(filepath)
+                    entry = self.entries.get(name, {})
+                if entry.get('hash') is None:
+                    entry_hash = hash_file(filepath)
+                    self.add(filepath, entry_hash)
+                else:
+                    entry_hash = entry['hash']
+            except FileNotFoundError:
+                self.remove(filepath)
+                continue
+            if entry_hash == content_hash and stat.st_size == size:
+                return name
+        return None
@@ -1,29 +1,119 @@
+import base64
+import contextlib
+import json
+import os
 import re
 import socket
+import sys
 import threading
 import traceback
 import time
 import pathlib
+import queue
 
-DATA_TYPE_SIZE = 10
+from catalog import CATALOG_ALGORITHM
+from compression import CODECS, ChunkCompressor
+from delta import COPY, LITERAL, delta_instructions, unpack_signature
+from integrity import FileHasher, check_algorithm
+from metrics import MetricsRegistry, ProgressPrinter, TransferMetrics
+from parallel_transfer import RANGE_SIZE, split_ranges
+from protocol import EVENTS_HELLO, PROTOCOL_VERSION, STREAM_HELLO, FrameCodec, pack_hello, send_frame
+from ratelimit import BandwidthScheduler
+from recv_buffer import DEFAULT_BUFFER_SIZE, RecvBuffer
+from resume import boundary_digest, file_transfer_id
+from tuning import ConnectionTuner, measure_rtt
+from udp_transfer import DEFAULT_BLOCK_SIZE, DEFAULT_RATE, IDLE_TIMEOUT, UdpSender
+
+USERNAME_REGEX = r'[a-zA-Z0-9]{1,20}'
+SENDFILE_BLOCK_SIZE = 8 * 1024 * 1024  # Bytes handed to the kernel per sendfile call (progress granularity)
+DELTA_PENDING_BUFFERS = 512            # Delta instruction buffers sent together in one sendmsg call
+MAX_STREAM_FAILURES = 5                # Stream connections allowed to fail before a parallel transfer is abandoned
 
 class Client():
 
-    def __init__(self, server_ip=None, port=5555, data_header_size=13, filename_header_size=7):
+    def __init__(self, server_ip=None, port=5555, data_header_size=13, filename_header_size=7,
+                 buffer_size=DEFAULT_BUFFER_SIZE, zero_copy=True, parallel_streams=1, resumable=False, event_callback=None,
+                 protocol_version=PROTOCOL_VERSION, compression=None, delta=False, delta_in_place=False,
+                 verify=True, digest_algorithm='blake2b', username=None, rate_limit=None, transfer_rate_limit=None,
+                 dedup=False, progress=True, autotune=True, udp_rate=None, udp_block_size=DEFAULT_BLOCK_SIZE,
+                 udp_loss=0.0, udp_delay=0.0):
         """
         Initialize the Network object with server and port details.
         Creates a socket and establishes a connection to the server.
 
         :param server: The IP address of the server.
         :param port: The port number to connect to.
+        :param buffer_size: Read size used when file data is sent through the buffered path.
+        :param zero_copy: Send file data with the kernel's sendfile when the platform supports it.
+        :param parallel_streams: Number of stream connections used to send a large file (1 disables parallel transfers).
+        :param resumable: Send files so that an interrupted transfer continues from the server's checkpoint.
+        :param event_callback: Called with every notification the server pushes (defaults to printing it).
+        :param protocol_version: Highest framing version to negotiate with the server (1 skips negotiation).
+        :param compression: Compress files sent with send_file using this method ('zlib', 'lzma' or 'bz2').
+        :param delta: Send only the blocks of a file that differ from the server's file of the same name.
+        :param delta_in_place: Replace the server's file with the new version instead of saving it as a copy.
+        :param verify: Send a digest of every file sent with send_file so the server can verify what it wrote
+                       (requires protocol v3 on both sides).
+        :param digest_algorithm: Digest used for verification, 'blake2b' or 'sha256'.
+        :param username: Username to connect with instead of asking for one; no other is tried if it is taken.
+        :param rate_limit: Bytes per second sent by all transfers together, shared fairly between them (None for unlimited).
+        :param transfer_rate_limit: Bytes per second sent by any single transfer (None for unlimited).
+        :param dedup: Offer the size and hash of every file first and skip the ones the server already has
+                      (requires protocol v4 on both sides).
+        :param progress: Print the progress of every transfer on the terminal.
+        :param autotune: Size chunks and socket buffers to the measured bandwidth-delay product of every
+                         connection (see tuning). TCP_NODELAY and corking are used either way.
+        :param udp_rate: Send files with send_data over the UDP transport, paced at this many bytes per second
+                         (requires protocol v8 on both sides, see send_file_udp). None sends them over TCP.
+        :param udp_block_size: File data per datagram of the UDP transport.
+        :param udp_loss: Fraction of the UDP datagrams to drop on purpose, to try the transport on loopback.
+        :param udp_delay: Seconds to hold every UDP datagram before it leaves, to simulate a long path on loopback.
         """
 
+        if compression and compression not in CODECS:
+            raise ValueError(f"Unsupported compression method: {compression}")
+        check_algorithm(digest_algorithm)
+        if username is not None and not re.fullmatch(USERNAME_REGEX, username):
+            raise ValueError(f"Invalid username: {username}")
+
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_ip = server_ip
         self.port = port
         self.data_header_size = data_header_size
         self.filename_header_size = filename_header_size
+        self.buffer_size = buffer_size
+        self.zero_copy = zero_copy
+        self.parallel_streams = parallel_streams
+        self.resumable = resumable
+        self.event_callback = event_callback or self._print_event
+        self.events = None
+        self.protocol_version = protocol_version
+        self.compression = compression
+        self.compression_stats = None
+        self.delta = delta
+        self.delta_in_place = delta_in_place
+        self.verify = verify
+        self.username = username
+        self.digest_algorithm = digest_algorithm
+        self.dedup = dedup
+        self.udp_rate = udp_rate
+        self.udp_block_size = udp_block_size
+        self.udp_loss = udp_loss
+        self.udp_delay = udp_delay
+        self.udp_stats = None
+        self.bandwidth = BandwidthScheduler(rate_limit, transfer_rate_limit)
+        self.metrics = MetricsRegistry(self.bandwidth)
+        if progress:
+            self.metrics.subscribe(ProgressPrinter('sent'))
+        self.codec = FrameCodec(1, data_header_size, filename_header_size)
+        self.reader = RecvBuffer(self.client, buffer_size)
         self.addr = (self.server_ip, self.port)
+        self.event_token = None
+        self.autotune = autotune
+        self.tuners = {}                # socket -> ConnectionTuner of the connections file data is sent on
+        self.handshake_rtt = None
+        self.server_capabilities = {}   # What a v5 server supports: 'compression' methods and 'digests'
+        self.route = None               # Worker process of a multi-process server serving this client (see workers)
         self.id = self.connect()
         if self.id:
             self.client_closed = False
@@ -31,15 +121,23 @@ class Client():
         else:
             self.client_closed = True
 
-    def set_username(self):
-        """Set a unique username"""
-        
+    def _ask_username(self) -> str:
         while True:
             username = input("Select your username (max 20 alpha-numeric characters): ")
-            username_regex = r'[a-zA-Z0-9]{1,20}'
-            if not re.fullmatch(username_regex, username):
-                print('Invalid Username. Try Again.')
-                continue
+            if re.fullmatch(USERNAME_REGEX, username):
+                return username
+            print('Invalid Username. Try Again.')
+
+
+    def set_username(self, username: str = None):
+        """
+        Set a unique username
+
+        :param username: Tried first, before the configured username or asking for one.
+        """
+        
+        while True:
+            username = username or self.username or self._ask_username()
             self.client.send(username.encode('utf-8'))
             username_status = self._receive_data().decode('utf-8')
             if username_status == 'Receiver is already connected with another device':
@@ -47,6 +145,9 @@ class Client():
                 return
             elif username_status == "Username already taken":
                 print(username_status)
+                if self.username:
+                    return
+                username = None
                 continue
             else:
                 break
@@ -57,43 +158,163 @@ class Client():
         """
         Connect to the server and receive an initial response.
 
+        With protocol v5 the username, the request for an event channel token and the
+        protocol version go out in one hello, so the connection is ready after one round trip.
+
         :return: Decoded server response or None if connection fails.
         """
 
         try:
+            username = self.username or self._ask_username()
             self.client.connect(self.addr)
-            username = self.set_username()
-            return username
+            start = time.perf_counter()
+            self.codec, session = self._negotiate_protocol(self.client, self.reader, {'username': username, 'events': True})
+            # The first guess of the round trip time, until the kernel has measured the connection
+            self.handshake_rtt = time.perf_counter() - start
+            self.tuners[self.client] = ConnectionTuner(self.client, 'send', self.buffer_size, self.handshake_rtt, self.autotune)
+            if session is None:
+                # Server before v5
+                return self.set_username(username)
+            self.server_capabilities = session.get('capabilities', {})
+            self.route = session.get('route')
+            if session.get('username'):
+                self.event_token = session.get('events')
+                return session['username']
+            print(session['error'])
+            if session['error'] == "Username already taken" and not self.username:
+                # The server keeps reading usernames the way it does for older clients
+                return self.set_username()
+            return None
             # return self.client.recv(2048).decode()
         except Exception as e:
             print("Connection Error: ", e)
             raise
 
 
-    def poll_server(self):
-        """Continuously polls the server for updates."""
-        
+    def _negotiate_protocol(self, sock, reader: RecvBuffer, session: dict = None):
+        """
+        Agree on the framing version of a new connection with the server, passing <session> along
+        to servers that speak v5.
+
+        :return: (FrameCodec of the agreed version, the server's reply to <session> or None if it
+                 wasn't answered because the server or the agreed version is older than v5).
+        """
+
+        v1_codec = FrameCodec(1, self.data_header_size, self.filename_header_size)
+        if self.protocol_version < 2:
+            return v1_codec, None
+        sock.sendall(pack_hello(self.protocol_version, session))
+        reply = self._receive_data(reader=reader, codec=v1_codec)
+        if not reply:
+            raise ConnectionError("No reply from server to protocol negotiation")
+        if not reply.startswith(b'{'):
+            return FrameCodec(int(reply.decode("utf-8")), self.data_header_size, self.filename_header_size), None
+        session_reply = json.loads(reply)
+        return FrameCodec(session_reply['version'], self.data_header_size, self.filename_header_size), session_reply
+
+
+    def _connect_channel(self, hello: str):
+        """
+        Open an extra connection to the server that identifies itself with <hello> instead of a username.
+
+        :return: (socket, RecvBuffer) of the accepted connection.
+        """
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.addr)
+            reader = RecvBuffer(sock, self.buffer_size)
+            session = {'channel': hello}
+            if self.route is not None:
+                # Lets whichever worker process accepts the connection pass it to the one serving this client
+                session['route'] = self.route
+            codec, session = self._negotiate_protocol(sock, reader, session)
+            if session is None:
+                sock.sendall(hello.encode("utf-8"))
+                status = self._receive_data(reader=reader, codec=codec)
+            else:
+                status = session.get('status', '').encode("utf-8")
+            if status != b'OK':
+                raise ConnectionError(f"Connection rejected by server: {status}")
+        except Exception:
+            sock.close()
+            raise
+        return sock, reader
+
+
+    def open_event_channel(self):
+        """
+        Open the dedicated connection the server pushes completion and error notifications on,
+        so that they arrive as soon as they happen and never interleave with file data.
+        """
+
+        # A v5 server handed out the token along with the username
+        token, self.event_token = self.event_token, None
+        if not token:
+            token = self._request('Events', {})['token']
+        self.events, self.event_reader = self._connect_channel(f"{EVENTS_HELLO}{token}")
+
+
+    def listen_events(self):
+        """Block on the event channel and hand every notification to event_callback until the server closes it."""
+
         while True:
             try:
-                # send a poll request to server
-                self.send_text("POLL", data_type='POLL')
-                data = self._receive_data()
+                data = self._receive_data(reader=self.event_reader)
                 if data:
-                    print(f'{data.decode("utf-8"):<20}')
-                    # print(f"\n{self.id}: ", end="")
-                    print("\nEnter File Path: ", end="")
+                    self.event_callback(data.decode("utf-8"))
+                elif self.client_closed:
+                    # Closed from this side
+                    break
                 else:
-                    self.client_closed = True
                     self.close()
                     print("Press Enter to close the client Application")
                     break
-                time.sleep(1)  # Optional delay between polls
             except ConnectionResetError:
                 print("Connection closed by server.")
                 break
             except Exception as e:
-                print("Polling Error: ", e)
+                print("Event Channel Error: ", e)
+                break
+
+
+    def _print_event(self, message: str):
+        print(f'{message:<20}')
+        print("\nEnter File Path: ", end="")
+
+
+    def _request(self, data_type: str, request: dict) -> dict:
+        """
+        Send a JSON request and wait for the server's JSON reply on the main connection.
+
+        Notifications that arrive first, because no event channel is open yet,
+        are passed to event_callback.
+        """
+
+        self.send_text(json.dumps(request), data_type=data_type)
+        while True:
+            data = self._receive_data()
+            if not data:
+                raise ConnectionError(f"No reply from server to '{data_type}' request")
+            reply = self._parse_reply(data)
+            if reply:
                 break
+            self.event_callback(data.decode("utf-8"))
+        if reply.get('error'):
+            raise ValueError(f"Server rejected '{data_type}' request: {reply['error']}")
+        return reply
+
+
+    def _parse_reply(self, data):
+        """Return <data> as a dict if it is a JSON reply to a request; notifications are plain text."""
+
+        if not data or not data.startswith(b'{'):
+            return None
+        try:
+            reply = json.loads(data)
+        except ValueError:
+            return None
+        return reply if isinstance(reply, dict) and 'reply' in reply else None
 
 
     def send_text(self, data: str, data_type: str):
@@ -106,17 +327,9 @@ class Client():
 
         try:
             encoded_data = data.encode("utf-8")
-            data_length = len(encoded_data)
 
-            # Send the length of data as a <data_header_size>-byte header
-            header = f"{data_length:<{(self.data_header_size)}}".encode("utf-8")
-            self.client.sendall(header)
-
-            # Send Data Type in next <DATA_TYPE_SIZE> bytes
-            self.client.sendall(f"{data_type:<{(DATA_TYPE_SIZE)}}".encode("utf-8"))
-
-            # Send the actual data
-            self.client.sendall(encoded_data)
+            # Header (data length and Data Type) and data go out in a single send
+            send_frame(self.client, self.codec.pack_header(data_type, len(encoded_data)), encoded_data)
 
             # return self._receive_data()
             return "Data Sent"
@@ -124,54 +337,109 @@ class Client():
             print("Text Sending Socket Error:", traceback.format_exc())
         except Exception:
             print("Text Sending General Error:", traceback.format_exc())
-            
 
-    def send_file(self, filepath: str):
+
+    def send_pipe(self, source=None, name: str = 'stdin', progress_callback=None):
         """
-        Send file data to the server.
+        Send data of unknown length, such as stdin, until <source> reaches its end.
 
-        :param data: The data to send to the server.
+        Whatever has been read goes out at once as a length prefixed chunk of at most <buffer_size>
+        bytes, and an empty chunk ends the stream, so memory use doesn't grow with the data. A
+        receiver that writes slowly blocks the sends, which stops the reads from <source> and
+        in turn whatever writes into it. The server notifies 'Pipe Received' at the end.
+
+        :param source: Binary file object to read, sys.stdin.buffer by default.
+        :param name: Name the server saves the data under, unless it writes streams to its own output.
+        :param progress_callback: Called as progress_callback(bytes_sent, 0) after every chunk.
         :return: "Data Sent" in case of success and None in case of failure.
         """
 
         try:
-            with open(file=pathlib.Path(filepath.strip()), mode='rb+') as file:
-                file_size = file.seek(0, 2)
-                file.seek(0)
+            if self.codec.version < 6:
+                raise ValueError(f"The server speaks protocol v{self.codec.version}, pipes need v6")
+            source = source or sys.stdin.buffer
+            # A buffered reader's readinto would wait for a full buffer before anything is sent
+            read = getattr(source, 'readinto1', source.readinto)
+            buffer = bytearray(self.buffer_size)
+            view = memoryview(buffer)
 
-                data_length = file_size
+            send_frame(self.client, self.codec.pack_header('Pipe', 0), self.codec.pack_name(name))
+            with self.metrics.start(name, 'send', 0) as transfer:
+                while True:
+                    start = time.perf_counter()
+                    length = read(view)
+                    if not length:
+                        break
+                    read_time = time.perf_counter() - start
+                    send_frame(self.client, self.codec.pack_int(length), view[:length])
+                    transfer.add(length, 2, time.perf_counter() - start - read_time, read_time)
+                    if progress_callback:
+                        progress_callback(transfer.bytes, 0)
+                # The end marker
+                send_frame(self.client, self.codec.pack_int(0))
+            return "Data Sent"
+        except socket.error as e:
+            print("Pipe Sending Socket Error:", traceback.format_exc())
+        except Exception:
+            print("Pipe Sending General Error:", traceback.format_exc())
 
-                # Send the length of data as a <data_header_size>-byte header
-                data_header = f"{data_length:<{(self.data_header_size)}}".encode("utf-8")
-                self.client.sendall(data_header)
 
-                # Send Data Type in next <DATA_TYPE_SIZE> bytes
-                self.client.sendall(f"{'File':<{(DATA_TYPE_SIZE)}}".encode("utf-8"))
+    def send_file(self, filepath: str, progress_callback=None):
+        """
+        Send file data to the server.
 
-                # Send File Name
-                filepath = pathlib.Path(filepath)
-                filename = filepath.name
-                encoded_filename = filename.encode("utf-8")
-                filename_length = len(encoded_filename)
+        The file body is streamed straight from the page cache with sendfile when
+        zero copy is enabled and available, otherwise it is read into a reused buffer
+        of <buffer_size> bytes and sent with sendall. With compression enabled the
+        file is sent as compressed chunks instead (see _send_file_compressed).
 
-                ## Send length of File Name as <filename_header_size>-byte header
-                filename_header = f"{filename_length:<{(self.filename_header_size)}}".encode("utf-8")
-                self.client.sendall(filename_header)
+        With verify enabled the file is hashed on a helper thread while it is sent and the
+        digest follows the file in a 'Digest' trailer frame; the server then notifies
+        'File Verified' or 'File Verification Failed' instead of 'File Downloaded'.
 
-                ## Send File Name
-                self.client.sendall(encoded_filename)
+        :param data: The data to send to the server.
+        :param progress_callback: Called as progress_callback(bytes_sent, file_size) after every block,
+                                  in addition to the metrics of the transfer (see metrics).
+        :return: "Data Sent" in case of success, "Skipped" if the server already has the file (see dedup)
+                 and None in case of failure.
+        """
 
-                # Send the actual file data
-                current_data_length = 0
-                while True:
-                    chunk = file.read(2048)
-                    self.client.send(chunk)
-                    if not chunk:
-                        break
+        try:
+            with open(file=pathlib.Path(filepath.strip()), mode='rb') as file:
+                file_size = os.fstat(file.fileno()).st_size
 
-                    current_data_length += len(chunk)
-                    print('\r', end="")
-                    print(f'{current_data_length / data_length * 100:.0f}% file sent', end="")
+                data_length = file_size
+                filename = pathlib.Path(filepath).name
+                server_has_file, content_hash = self._offer(file.name, filename, file_size)
+                if server_has_file:
+                    return "Skipped"
+                if self.compression:
+                    with self._bulk(self.client), self.metrics.start(filename, 'send', data_length) as transfer:
+                        self._send_file_compressed(file, filename, data_length, transfer, progress_callback)
+                    return "Data Sent"
+
+                # Header, file data and digest trailer leave in full segments
+                with self._bulk(self.client):
+                    # Send header (data length and Data Type) and length prefixed File Name in a single send
+                    if self.verify and self.codec.version >= 3:
+                        send_frame(self.client, self.codec.pack_header('Verified', data_length),
+                                   self.codec.pack_name(filename), self.codec.pack_name(self.digest_algorithm))
+                        # The offer may have hashed the whole file already
+                        digest = content_hash if self.digest_algorithm == CATALOG_ALGORITHM else None
+                        hasher = None if digest else FileHasher(file.name, 0, data_length, self.digest_algorithm)
+                    else:
+                        send_frame(self.client, self.codec.pack_header('File', data_length), self.codec.pack_name(filename))
+                        hasher = digest = None
+
+                    # Send the actual file data
+                    with self.metrics.start(filename, 'send', data_length) as transfer:
+                        if self._send_file_body(self.client, file, 0, data_length, transfer, progress_callback) < data_length:
+                            raise ValueError(f"{filename} was truncated while it was being sent")
+
+                        if hasher:
+                            digest = hasher.hexdigest()
+                        if digest:
+                            send_frame(self.client, self.codec.pack_header('Digest', len(digest)), digest.encode("utf-8"))
                 print() # blank line
 
                 # return self._receive_data()
@@ -181,45 +449,583 @@ class Client():
         except Exception as e:
             print("File Sending General Error:", traceback.format_exc())
 
+
+    def _offer(self, filepath, filename: str, file_size: int):
+        """
+        Offer a file to the server by its size and content hash when dedup is enabled.
+
+        :return: (whether the server already has the file, CATALOG_ALGORITHM hex digest of the file or None).
+        """
+
+        if not self.dedup or self.codec.version < 4:
+            return False, None
+        content_hash = FileHasher(filepath, 0, file_size, CATALOG_ALGORITHM).hexdigest()
+        reply = self._request('Offer', {'filename': filename, 'size': file_size, 'hash': content_hash})
+        if reply['have']:
+            print(f"Server already has {filename} as {reply['name']}, skipping it")
+        return reply['have'], content_hash
+
+
+    def _send_file_compressed(self, file, filename: str, data_length: int, transfer: TransferMetrics, progress_callback=None):
+        """
+        Send a file as a 'Compressed' frame: the header with the original size, the File Name,
+        the compression method and then every chunk as its original length, payload length and payload.
+
+        Chunks are compressed on a worker thread while earlier chunks are sent; chunks that
+        don't compress, like media or archives, are sent raw. The compression ratio and CPU
+        time of the transfer are printed and kept in compression_stats.
+        """
+
+        send_frame(self.client, self.codec.pack_header('Compressed', data_length),
+                   self.codec.pack_name(filename), self.codec.pack_name(self.compression))
+        compressor = ChunkCompressor(file, data_length, self.compression)
+        sent = 0
+        for raw_length, payload in compressor:
+            start = time.perf_counter()
+            send_frame(self.client, self.codec.pack_int(raw_length), self.codec.pack_int(len(payload)), payload)
+            transfer.add(raw_length, socket_time=time.perf_counter() - start)
+            sent += raw_length
+            if progress_callback:
+                progress_callback(sent, data_length)
+        if sent < data_length:
+            raise ValueError(f"{filename} was truncated while it was being sent")
+        print() # blank line
+        self.compression_stats = compressor.stats
+        print(f"Compression {compressor.stats}")
+
+
+    def send_file_parallel(self, filepath: str, progress_callback=None):
+        """
+        Send file data to the server over <parallel_streams> stream connections.
+
+        The main connection only announces the file and a transfer id. The file is split
+        into RANGE_SIZE byte ranges that stream workers pull from a shared queue, so the
+        number of streams can be changed with set_parallel_streams while the file is sent.
+        Files that fit in a single range are sent with send_file.
+
+        :return: "Data Sent" in case of success, "Skipped" if the server already has the file (see dedup)
+                 and None in case of failure.
+        """
+
+        try:
+            path = pathlib.Path(filepath.strip())
+            data_length = path.stat().st_size
+            if data_length <= RANGE_SIZE:
+                return self.send_file(filepath, progress_callback)
+            if self._offer(path, path.name, data_length)[0]:
+                return "Skipped"
+
+            # Announce the transfer: header with the file size, File Name and transfer id
+            transfer_id = os.urandom(16).hex()
+            send_frame(self.client, self.codec.pack_header('Parallel', data_length),
+                       self.codec.pack_name(path.name), transfer_id.encode("utf-8"))
+
+            ranges = queue.Queue()
+            for byte_range in split_ranges(data_length):
+                ranges.put(byte_range)
+            state = {'pending_ranges': ranges.qsize(), 'sent': 0, 'failures': 0}
+            lock = threading.Lock()
+
+            def on_range_sent(length):
+                with lock:
+                    state['pending_ranges'] -= 1
+                    state['sent'] += length
+                    if progress_callback:
+                        progress_callback(state['sent'], data_length)
+
+            def on_failure():
+                with lock:
+                    state['failures'] += 1
+
+            # One transfer for the file, the streams add to it concurrently
+            with self.metrics.start(path.name, 'send', data_length) as transfer:
+                # Keep <parallel_streams> workers running until every range has been sent
+                workers = {}
+                while True:
+                    with lock:
+                        if not state['pending_ranges'] or state['failures'] > MAX_STREAM_FAILURES:
+                            break
+                    workers = {slot: worker for slot, worker in workers.items() if worker.is_alive()}
+                    for slot in range(self.parallel_streams):
+                        if slot not in workers and not ranges.empty():
+                            workers[slot] = threading.Thread(
+                                target=self._stream_worker,
+                                args=(slot, transfer_id, path, ranges, transfer, on_range_sent, on_failure),
+                                daemon=True)
+                            workers[slot].start()
+                    time.sleep(0.1)
+                transfer.finish('failed' if state['pending_ranges'] else 'completed')
+            print() # blank line
+
+            if state['pending_ranges']:
+                print("Parallel transfer abandoned after repeated stream failures")
+                return
+            return "Data Sent"
+        except socket.error as e:
+            print("Parallel File Sending Socket Error:", traceback.format_exc())
+        except Exception as e:
+            print("Parallel File Sending General Error:", traceback.format_exc())
+
+
+    def send_file_udp(self, filepath: str, progress_callback=None, rate: float = None):
+        """
+        Send file data to the server as UDP datagrams, for links whose round trip time keeps a TCP stream
+        far below their capacity (see udp_transfer).
+
+        The main connection announces the file and then carries the receiver's reports, which a helper
+        thread reads while the datagrams go out at a fixed rate; missing blocks are sent again until
+        the server has all of them. Servers older than v8 get the file with send_file instead.
+
+        :param rate: Bytes per second to pace the datagrams at, udp_rate or DEFAULT_RATE by default.
+                     Choose what the path can carry: datagrams above it are lost and sent again.
+        :return: "Data Sent" in case of success, "Skipped" if the server already has the file (see dedup)
+                 and None in case of failure.
+        """
+
+        try:
+            path = pathlib.Path(filepath.strip())
+            data_length = path.stat().st_size
+            if self.codec.version < 8:
+                print(f"The server speaks protocol v{self.codec.version}, the UDP transport needs v8; sending over TCP")
+                return self.send_file(filepath, progress_callback)
+            if self._offer(path, path.name, data_length)[0]:
+                return "Skipped"
+
+            reply = self._request('Udp', {'filename': path.name, 'size': data_length, 'block_size': self.udp_block_size})
+            with open(path, 'rb') as file:
+                sender = UdpSender(file, data_length, self.udp_block_size, (self.server_ip, reply['port']),
+                                   bytes.fromhex(reply['token']), rate or self.udp_rate or DEFAULT_RATE,
+                                   measure_rtt(self.client) or self.handshake_rtt, self.udp_loss, self.udp_delay)
+                reports = threading.Thread(target=self._read_udp_reports, args=(sender,), daemon=True)
+                reports.start()
+                try:
+                    with self.metrics.start(path.name, 'send', data_length) as transfer:
+                        sender.run(transfer, progress_callback)
+                finally:
+                    sender.close()
+                    self._stop_udp_reports(reports, sender)
+            print() # blank line
+            self.udp_stats = sender.stats
+            print(f"UDP {sender.stats}")
+            return "Data Sent"
+        except socket.error as e:
+            print("UDP File Sending Socket Error:", traceback.format_exc())
+        except Exception as e:
+            print("UDP File Sending General Error:", traceback.format_exc())
+
+
+    def _read_udp_reports(self, sender: UdpSender):
+        """
+        Pass the receiver's reports on the main connection to <sender> until its final one,
+        which it also sends after giving up, so nothing of the transfer is left to read.
+        """
+
+        while True:
+            data = self._receive_data()
+            if not data:
+                sender.fail("Lost the connection to the server")
+                return
+            reply = self._parse_reply(data)
+            if reply and reply.get('reply') == 'UdpReport':
+                sender.handle_report(reply)
+                if reply['status'] != 'active':
+                    return
+            else:
+                # Notifications that arrive because no event channel is open
+                self.event_callback(data.decode("utf-8"))
+
+
+    def _stop_udp_reports(self, reports: threading.Thread, sender: UdpSender):
+        """
+        Wait for the thread reading the reports of <sender> to end before the main connection is used again.
+
+        A sender that failed on its own leaves the receiver waiting for datagrams, its final report
+        comes once it has given up. The connection is shut down if that report doesn't come either.
+        """
+
+        if reports.is_alive() and sender.status != 'completed':
+            print("Waiting for the server to give up on the UDP transfer")
+        reports.join(max(0.0, IDLE_TIMEOUT - (time.monotonic() - sender.last_report_time)) + 1)
+        if reports.is_alive():
+            # The reports stopped, the connection is out of step with the server
+            self.client.shutdown(socket.SHUT_RDWR)
+            reports.join()
+
+
+    def send_file_resumable(self, filepath: str, progress_callback=None):
+        """
+        Send file data so that an interrupted transfer can be continued later.
+
+        The server is first asked for the checkpoint of this version of the file. If the
+        bytes just before the checkpoint match the local file only the rest is sent,
+        otherwise the whole file is sent again.
+
+        :return: "Data Sent" in case of success, "Skipped" if the server already has the file (see dedup)
+                 and None in case of failure.
+        """
+
+        try:
+            path = pathlib.Path(filepath.strip())
+            transfer_id = file_transfer_id(path)
+
+            with open(file=path, mode='rb') as file:
+                file_size = os.fstat(file.fileno()).st_size
+                if self._offer(path, path.name, file_size)[0]:
+                    return "Skipped"
+                reply = self._request('Resume', {'transfer_id': transfer_id, 'filename': path.name, 'file_size': file_size})
+                offset = reply['offset']
+                if offset and boundary_digest(file, offset) != reply['boundary_digest']:
+                    print("Partial file on server doesn't match, sending the whole file")
+                    offset = 0
+                elif offset:
+                    print(f"Resuming from byte {offset} of {file_size}")
+
+                with self._bulk(self.client):
+                    # Send header with the length of the rest, transfer id and offset
+                    send_frame(self.client, self.codec.pack_header('ResumeData', file_size - offset),
+                               transfer_id.encode("utf-8"), self.codec.pack_int(offset))
+
+                    with self.metrics.start(path.name, 'send', file_size - offset) as transfer:
+                        self._send_file_body(self.client, file, offset, file_size - offset, transfer,
+                                             progress_callback and (lambda sent, length: progress_callback(offset + sent, file_size)))
+                print() # blank line
+                return "Data Sent"
+        except socket.error as e:
+            print("Resumable File Sending Socket Error:", traceback.format_exc())
+        except Exception as e:
+            print("Resumable File Sending General Error:", traceback.format_exc())
+
+
+    def send_file_delta(self, filepath: str, progress_callback=None):
+        """
+        Send a new version of a file the server already has, rsync style.
+
+        The server replies with the signature of its file of the same name; only the parts
+        of the local file that match no block of it are sent, the rest is sent as instructions
+        to copy blocks of the old version. Without an old version the whole file is sent.
+
+        :return: "Data Sent" in case of success and None in case of failure.
+        """
+
+        try:
+            path = pathlib.Path(filepath.strip())
+            file_size = path.stat().st_size
+
+            reply = self._request('Delta', {'filename': path.name})
+            if not reply['block_size']:
+                print("No previous version on server, sending the whole file")
+                return self.send_file(filepath, progress_callback)
+            block_size = reply['block_size']
+            basis_size = reply['basis_size']
+            signature = unpack_signature(base64.b64decode(reply['signature']))
+
+            metadata = {'filename': path.name, 'basis_size': basis_size, 'basis_mtime_ns': reply['basis_mtime_ns'],
+                        'block_size': block_size, 'in_place': self.delta_in_place}
+            send_frame(self.client, self.codec.pack_header('DeltaData', file_size), self.codec.pack_name(json.dumps(metadata)))
+
+            # Instructions are collected and sent together, a copy instruction is only a few bytes
+            pending = []
+            pending_bytes = 0
+            literal_bytes = 0
+            position = 0
+            sent_position = 0
+            with self._bulk(self.client), self.metrics.start(path.name, 'send', file_size) as transfer:
+                for instruction, *fields in delta_instructions(path, signature, block_size, basis_size):
+                    if instruction == COPY:
+                        first_block, block_count = fields
+                        pending += [COPY, self.codec.pack_int(first_block), self.codec.pack_int(block_count)]
+                        position += min(block_count * block_size, basis_size - first_block * block_size)
+                    elif instruction == LITERAL:
+                        literal, = fields
+                        pending += [LITERAL, self.codec.pack_int(len(literal)), literal]
+                        pending_bytes += len(literal)
+                        literal_bytes += len(literal)
+                        position += len(literal)
+                    else:
+                        digest, = fields
+                        pending += [instruction, self.codec.pack_name(digest)]
+                    if pending_bytes >= self.buffer_size or len(pending) >= DELTA_PENDING_BUFFERS or instruction not in (COPY, LITERAL):
+                        start = time.perf_counter()
+                        send_frame(self.client, *pending)
+                        # Bytes of the new file the instructions cover, most of them aren't sent
+                        transfer.add(position - sent_position, socket_time=time.perf_counter() - start)
+                        sent_position = position
+                        pending = []
+                        pending_bytes = 0
+                        if progress_callback and file_size:
+                            progress_callback(position, file_size)
+            print() # blank line
+            print(f"Delta: sent {literal_bytes} of {file_size} bytes, the rest matched the server's previous version")
+            return "Data Sent"
+        except socket.error as e:
+            print("Delta File Sending Socket Error:", traceback.format_exc())
+        except Exception as e:
+            print("Delta File Sending General Error:", traceback.format_exc())
+
+
+    def send_directory(self, dirpath: str):
+        """
+        Send every file under a directory back to back in one 'Batch' frame.
+
+        Each entry carries its path relative to the directory's parent, so the server
+        recreates the tree including the directory itself. There is no reply per file;
+        the server answers once when the end marker (an empty path) has been received.
+
+        :return: "Data Sent" in case of success and None in case of failure.
+        """
+
+        try:
+            root = pathlib.Path(dirpath.strip())
+            filepaths = [pathlib.Path(directory) / name for directory, _, names in os.walk(root) for name in sorted(names)]
+
+            # Send the number of files in the header
+            send_frame(self.client, self.codec.pack_header('Batch', len(filepaths)))
+
+            # The total size isn't known without a stat of every file, the batch is reported by bytes sent so far
+            file_count = 0
+            with self._bulk(self.client), self.metrics.start(f"{root.name} ({len(filepaths)} files)", 'send', 0) as transfer:
+                for filepath in filepaths:
+                    try:
+                        file = open(file=filepath, mode='rb')
+                    except OSError as e:
+                        print(f"Skipping {filepath}: {e}")
+                        continue
+                    with file:
+                        file_size = os.fstat(file.fileno()).st_size
+                        entry_header = (self.codec.pack_name(filepath.relative_to(root.parent).as_posix())
+                                        + self.codec.pack_int(file_size))
+
+                        # Small files go out together with their entry header in a single send
+                        if file_size <= self.buffer_size:
+                            start = time.perf_counter()
+                            data = file.read(file_size)
+                            if len(data) < file_size:
+                                raise ValueError(f"{filepath} was truncated while it was being sent")
+                            disk_time = time.perf_counter() - start
+                            send_frame(self.client, entry_header, data)
+                            transfer.add(file_size, 2, time.perf_counter() - start - disk_time, disk_time)
+                        else:
+                            self.client.sendall(entry_header)
+                            if self._send_file_body(self.client, file, 0, file_size, transfer) < file_size:
+                                raise ValueError(f"{filepath} was truncated while it was being sent")
+                    file_count += 1
+
+                # An empty path marks the end of the batch
+                send_frame(self.client, self.codec.pack_name(b""))
+            print() # blank line
+            print(f"{file_count} files sent")
+            return "Data Sent"
+        except socket.error as e:
+            print("Directory Sending Socket Error:", traceback.format_exc())
+        except Exception as e:
+            print("Directory Sending General Error:", traceback.format_exc())
+
+
+    def set_rate_limit(self, rate: float = None, transfer_id: int = None):
+        """
+        Change the global send rate limit, or that of one transfer (ids are in metrics.stats()),
+        in bytes per second; None removes it. Transfers in progress pick it up with their next block.
+        """
+
+        self.bandwidth.set_rate(rate, transfer_id)
+
+
+    def set_transfer_weight(self, transfer_id: int, weight: float):
+        """Change the share of the global rate limit a transfer in progress gets relative to the others."""
+
+        self.bandwidth.set_weight(transfer_id, weight)
+
+
+    def set_parallel_streams(self, parallel_streams: int):
+        """Change the number of stream connections, also for a parallel transfer that is in progress."""
+
+        if parallel_streams < 1:
+            raise ValueError("At least one stream is required")
+        self.parallel_streams = parallel_streams
+
+
+    def _stream_worker(self, slot, transfer_id, filepath, ranges, transfer, on_range_sent, on_failure):
+        """
+        Open a stream connection and send ranges from the queue until it is empty
+        or <slot> is no longer below parallel_streams.
+        """
+
+        stream = None
+        current_range = None
+        try:
+            stream, _ = self._connect_channel(f"{STREAM_HELLO}{transfer_id}")
+            self.tuners[stream] = ConnectionTuner(stream, 'send', self.buffer_size, self.handshake_rtt, self.autotune)
+
+            with open(file=filepath, mode='rb') as file, self._bulk(stream):
+                while slot < self.parallel_streams:
+                    try:
+                        current_range = ranges.get_nowait()
+                    except queue.Empty:
+                        break
+                    offset, length = current_range
+
+                    # Send header with the range length and the offset
+                    send_frame(stream, self.codec.pack_header('Range', length), self.codec.pack_int(offset))
+                    if self._send_file_body(stream, file, offset, length, transfer) < length:
+                        raise ValueError(f"{filepath} was truncated while it was being sent")
+                    current_range = None
+                    on_range_sent(length)
+        except Exception:
+            print("Stream Error:", traceback.format_exc())
+            # Hand the unfinished range to another stream
+            if current_range:
+                ranges.put(current_range)
+            on_failure()
+        finally:
+            if stream:
+                self.tuners.pop(stream, None)
+                stream.close()
+
+
+    def _bulk(self, sock):
+        """Cork <sock> while file data is written to it, see ConnectionTuner.bulk. Never hold it across a wait for a reply."""
+
+        tuner = self.tuners.get(sock)
+        return tuner.bulk() if tuner else contextlib.nullcontext()
+
+
+    def _send_file_body(self, sock, file, offset, length, transfer: TransferMetrics, progress_callback=None):
+        """
+        Send <length> bytes of <file> starting at <offset>, through sendfile when zero copy is enabled.
+
+        :param transfer: Credited with every block, its system calls and the time spent on the socket and the file.
+        :param progress_callback: Called as progress_callback(bytes_sent, length) after every block.
+        :return: Number of bytes sent.
+        """
+
+        if self.zero_copy and hasattr(os, 'sendfile'):
+            return self._send_file_zero_copy(sock, file, offset, length, transfer, progress_callback)
+        return self._send_file_buffered(sock, file, offset, length, transfer, progress_callback)
+
+
+    def _send_file_zero_copy(self, sock, file, offset, length, transfer, progress_callback):
+        """
+        Let the kernel copy the file body to the socket in blocks of SENDFILE_BLOCK_SIZE bytes.
+        The kernel reads the file as part of sendfile, so all of its time counts as socket time.
+
+        :return: Number of bytes sent.
+        """
+
+        tuner = self.tuners.get(sock)
+        current_data_length = 0
+        while current_data_length < length:
+            # Grows the send buffer with the bandwidth-delay product
+            chunk_size = tuner.update(transfer) if tuner else self.buffer_size
+            # Smaller blocks keep a rate limited transfer smooth
+            block_size = chunk_size if transfer.bucket and transfer.bucket.rate else SENDFILE_BLOCK_SIZE
+            count = min(block_size, length - current_data_length)
+            start = time.perf_counter()
+            sent = sock.sendfile(file, offset + current_data_length, count)
+            if not sent:
+                break
+            transfer.add(sent, socket_time=time.perf_counter() - start)
+            current_data_length += sent
+            if progress_callback:
+                progress_callback(current_data_length, length)
+        return current_data_length
+
+
+    def _send_file_buffered(self, sock, file, offset, length, transfer, progress_callback):
+        """
+        Read the file body into a reused buffer and send every block with sendall.
+
+        :return: Number of bytes sent.
+        """
+
+        tuner = self.tuners.get(sock)
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        file.seek(offset)
+        current_data_length = 0
+        while current_data_length < length:
+            # The chunk size follows the measured throughput of the connection
+            if tuner and tuner.update(transfer) != len(buffer):
+                buffer = bytearray(tuner.chunk_size)
+                view = memoryview(buffer)
+            start = time.perf_counter()
+            read_length = file.readinto(view[:min(len(buffer), length - current_data_length)])
+            if not read_length:
+                break
+            disk_time = time.perf_counter() - start
+            sock.sendall(view[:read_length])
+            transfer.add(read_length, 2, time.perf_counter() - start - disk_time, disk_time)
+            current_data_length += read_length
+            if progress_callback:
+                progress_callback(current_data_length, length)
+        return current_data_length
+
+
+    def get_server_stats(self) -> dict:
+        """
+        Metrics of the transfers the server is receiving and has recently received.
+        The metrics of this client's own transfers are in metrics.stats().
+
+        :return: Dict with 'active' and 'finished' transfer snapshots and 'totals'.
+        """
+
+        return self._request('Stats', {})
+
+
     def send_data(self, data, data_type):
+        """
+        Send text, a file or a directory with the method the client is configured for.
+
+        :return: What the send method returned: "Data Sent", "Skipped" if the server already had the file
+                 (see dedup) or None in case of failure.
+        """
+
         if data_type == 'Text':
-            self.send_text(data=data, data_type='Text')
+            return self.send_text(data=data, data_type='Text')
         elif data_type == 'POLL':
-            self.send_text(data=data, data_type='POLL')
+            return self.send_text(data=data, data_type='POLL')
         elif data_type == 'File':
-            self.send_file(data)
+            if pathlib.Path(data.strip()).is_dir():
+                return self.send_directory(data)
+            elif self.resumable:
+                return self.send_file_resumable(data)
+            elif self.delta:
+                return self.send_file_delta(data)
+            elif self.udp_rate:
+                return self.send_file_udp(data)
+            elif self.parallel_streams > 1:
+                return self.send_file_parallel(data)
+            else:
+                return self.send_file(data)
 
 
-    def _receive_data(self):
+    def _receive_data(self, reader: RecvBuffer = None, codec: FrameCodec = None):
         """
         Receive data from the server in a loop to handle large responses.
 
+        :param reader: Receive engine to read from; defaults to the one of the main connection.
+        :param codec: Framing of the reply; defaults to the version negotiated on the main connection.
         :return: The complete decoded server response.
         """
 
+        if reader is None:
+            reader = self.reader
+        if codec is None:
+            codec = self.codec
+
         try:
-            data_header = self.client.recv(self.data_header_size)
-            if not data_header:
+            data_header = reader.recv_exact(codec.int_size)
+            if len(data_header) < codec.int_size:
                 print("Server Disconnected")
                 return b""
 
-            data_length = int(data_header.decode("utf-8").strip())
+            data_length = codec.unpack_int(data_header)
             # print(f'Expecting {data_length} bytes of data')
             print('\r', end="")
 
-            data = b""
-            while len(data) < data_length:
-                try:
-                    chunk = self.client.recv(2048)
-                    if not chunk:
-                        print('Disconnected from server')
-                        break
-                    else:
-                        data += chunk
-
-                except Exception as e:
-                    print("Data reading error: ", traceback.format_exc())
-                    break
+            # Accumulate the response in a single preallocated bytearray
+            data = reader.recv_exact(data_length)
+            if len(data) < data_length:
+                print('Disconnected from server')
 
             return data
         except socket.error as e:
@@ -235,6 +1041,16 @@ class Client():
         Close the client socket connection.
         """
         try:
+            self.client_closed = True
+            events, self.events = self.events, None
+            if events:
+                # Wakes up listen_events, which is blocked reading the event channel
+                try:
+                    events.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                events.close()
+            self.tuners.pop(self.client, None)
             self.client.close()
             print("Connection closed from client side.")
         except socket.error as e:
@@ -259,7 +1075,8 @@ def start_client():
     try:
         n = Client(server_ip=server_ip, port=server_port)
         if not n.client_closed:
-            t = threading.Thread(target=n.poll_server, daemon=True)
+            n.open_event_channel()
+            t = threading.Thread(target=n.listen_events, daemon=True)
             t.start()
         else:
             t = None
@@ -291,4 +1108,8 @@ def start_client():
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # Paths given on the command line go through the send queue
+        import send_queue
+        sys.exit(send_queue.main())
     start_client()
\ No newline at end of file
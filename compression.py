@@ -0,0 +1,185 @@
+import bz2
+import lzma
+import queue
+import threading
+import time
+import zlib
+
+
+COMPRESSION_CHUNK_SIZE = 1024 * 1024    # Bytes of the file compressed as one independent chunk
+MAX_CHUNK_SIZE = 64 * 1024 * 1024       # Largest decompressed chunk a receiver accepts
+PROBE_SIZE = 64 * 1024                  # Bytes of a chunk test compressed before the whole chunk is
+PROBE_MAX_RATIO = 0.9                   # Chunks whose probe doesn't shrink below this fraction are sent raw
+COMPRESSION_PENDING_CHUNKS = 4          # Compressed chunks waiting to be sent while the next ones are compressed
+
+# method -> (compress function, decompressor factory)
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompressobj),
+    'lzma': (lambda data: lzma.compress(data, preset=1), lzma.LZMADecompressor),
+    'bz2': (lambda data: bz2.compress(data, 9), bz2.BZ2Decompressor),
+}
+
+
+def compress_chunk(data, method: str) -> bytes:
+    """
+    Compress one chunk, unless it is already compressed data such as media or archives.
+
+    A quick zlib probe of the first PROBE_SIZE bytes decides whether the chunk is worth
+    compressing with <method>. A chunk that doesn't get smaller is returned as it is.
+
+    :return: The payload to send; it is shorter than <data> only if it is compressed.
+    """
+
+    probe = data[:PROBE_SIZE]
+    if len(zlib.compress(probe, 1)) > len(probe) * PROBE_MAX_RATIO:
+        return data
+    compressed = CODECS[method][0](data)
+    return compressed if len(compressed) < len(data) else data
+
+
+def check_chunk_header(raw_length: int, payload_length: int):
+    """Reject a chunk header before its payload is read, so a peer can't make the receiver buffer any size."""
+
+    if raw_length > MAX_CHUNK_SIZE or payload_length > raw_length:
+        raise ValueError(f"Invalid chunk of {payload_length} bytes announced as {raw_length} bytes")
+
+
+class CompressionStats():
+    """Bytes and CPU time of one compressed transfer, on either side of the connection."""
+
+
+    def __init__(self, method: str):
+        self.method = method
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.compressed_chunks = 0
+        self.raw_chunks = 0
+        self.cpu_time = 0.0
+
+
+    def add_chunk(self, raw_length: int, payload_length: int, cpu_time: float):
+        self.raw_bytes += raw_length
+        self.wire_bytes += payload_length
+        self.cpu_time += cpu_time
+        if payload_length < raw_length:
+            self.compressed_chunks += 1
+        else:
+            self.raw_chunks += 1
+
+
+    @property
+    def ratio(self) -> float:
+        """Original size divided by the size sent over the connection."""
+
+        return self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+
+
+    def __str__(self):
+        return (f"{self.method}: {self.raw_bytes} -> {self.wire_bytes} bytes ({self.ratio:.2f}x), "
+                f"{self.compressed_chunks}/{self.compressed_chunks + self.raw_chunks} chunks compressed, "
+                f"{self.cpu_time:.3f}s CPU")
+
+
+class ChunkCompressor():
+    """
+    Iterator over the compressed chunks of a file, produced by a worker thread.
+
+    The worker reads and compresses up to COMPRESSION_PENDING_CHUNKS chunks ahead, so
+    compression overlaps with sending the previous chunks. zlib, lzma and bz2 release
+    the GIL while they work.
+    """
+
+    def __init__(self, file, length: int, method: str, chunk_size: int = COMPRESSION_CHUNK_SIZE):
+        """
+        :param file: Binary file object positioned at the first byte to send.
+        :param length: Number of bytes to read from <file>.
+        :param method: Key of CODECS.
+        """
+
+        self.file = file
+        self.length = length
+        self.method = method
+        self.chunk_size = chunk_size
+        self.stats = CompressionStats(method)
+        self.chunks = queue.Queue(maxsize=COMPRESSION_PENDING_CHUNKS)
+        self.stopped = threading.Event()
+        self.worker = threading.Thread(target=self._compress_file, daemon=True)
+        self.worker.start()
+
+
+    def _compress_file(self):
+        try:
+            remaining = self.length
+            while remaining and not self.stopped.is_set():
+                data = self.file.read(min(self.chunk_size, remaining))
+                if not data:
+                    break
+                start = time.thread_time()
+                payload = compress_chunk(data, self.method)
+                self.stats.add_chunk(len(data), len(payload), time.thread_time() - start)
+                remaining -= len(data)
+                self._put((len(data), payload))
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+
+    def _put(self, item):
+        # Give up once the consumer has stopped reading
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+    def __iter__(self):
+        """Yield (raw length, payload) of every chunk; the payload is compressed if it is shorter."""
+
+        try:
+            while True:
+                item = self.chunks.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.stopped.set()
+
+
+class ChunkDecompressor():
+    """File-like writer that restores the chunks produced by ChunkCompressor."""
+
+
+    def __init__(self, file, method: str):
+        """
+        :param file: Binary file object the original data is written to.
+        :param method: Key of CODECS announced by the sender.
+        """
+
+        if method not in CODECS:
+            raise ValueError(f"Unsupported compression method: {method}")
+        self.file = file
+        self.method = method
+        self.stats = CompressionStats(method)
+
+
+    def write_chunk(self, raw_length: int, payload) -> int:
+        """
+        Write the original bytes of one chunk.
+
+        :return: Number of bytes written to the file.
+        """
+
+        start = time.thread_time()
+        if len(payload) < raw_length:
+            # Never inflate past the announced size, whatever the payload contains
+            data = CODECS[self.method][1]().decompress(payload, raw_length)
+            if len(data) != raw_length:
+                raise ValueError(f"Chunk decompressed to {len(data)} bytes instead of {raw_length}")
+        else:
+            data = payload
+        self.stats.add_chunk(raw_length, len(payload), time.thread_time() - start)
+        return self.file.write(data)
@@ -0,0 +1,227 @@
+import hashlib
+import math
+import mmap
+import os
+import pathlib
+import struct
+import zlib
+
+
+MIN_BLOCK_SIZE = 2 * 1024           # Block sizes grow with the square root of the basis file size,
+MAX_BLOCK_SIZE = 1024 * 1024        # like rsync, within these bounds
+MAX_LITERAL_SIZE = 1024 * 1024      # Largest run of literal data sent as one instruction
+COPY_BUFFER_SIZE = 1024 * 1024      # Bytes read from the basis file at a time while copying blocks
+STRONG_DIGEST_SIZE = 16             # BLAKE2b digest of one block, checked when the weak checksums match
+
+# Instructions of a delta, each followed by its fields
+COPY = b'C'         # first block index, block count: blocks of the basis file
+LITERAL = b'L'      # length, data: bytes that aren't in the basis file
+END = b'E'          # BLAKE2b digest of the whole new file
+
+_ADLER_MOD = 65521
+_SIGNATURE_ENTRY = struct.Struct(f'!I{STRONG_DIGEST_SIZE}s')   # weak checksum, strong digest
+
+
+def delta_block_size(file_size: int) -> int:
+    """Block size for a basis file: about its square root, rounded up to a power of two."""
+
+    block_size = 1 << max(0, math.ceil(math.log2(math.sqrt(file_size or 1))))
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def strong_digest(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=STRONG_DIGEST_SIZE).digest()
+
+
+def file_signature(filepath: pathlib.Path, block_size: int) -> bytes:
+    """
+    Weak (Adler-32) and strong (BLAKE2b) checksums of every block of a file, packed back to back.
+    The last block may be shorter than <block_size>.
+    """
+
+    signature = bytearray()
+    with open(filepath, 'rb') as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            signature += _SIGNATURE_ENTRY.pack(zlib.adler32(block), strong_digest(block))
+    return bytes(signature)
+
+
+def unpack_signature(signature: bytes):
+    """:return: List of (weak checksum, strong digest) of every block."""
+
+    return list(_SIGNATURE_ENTRY.iter_unpack(signature))
+
+
+def delta_instructions(filepath: pathlib.Path, signature, block_size: int, basis_size: int):
+    """
+    Compare a file with the signature of the basis file on the other side, rsync style.
+
+    An Adler-32 checksum is rolled over the file one byte at a time; where it matches a block
+    of the basis file and the strong digests agree, the block is copied instead of being sent.
+    Runs of consecutive blocks are merged into one copy. The file is memory mapped, so memory
+    use doesn't grow with its size.
+
+    :param signature: (weak checksum, strong digest) of every basis block, see unpack_signature.
+    :return: Generator of (COPY, first block index, block count), (LITERAL, data) and finally
+             (END, BLAKE2b hex digest of the whole file).
+    """
+
+    blocks = {}
+    for index, (weak, strong) in enumerate(signature):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+    # The last basis block can only match the end of the file
+    tail_length = basis_size - (len(signature) - 1) * block_size if signature else 0
+    tail_block = signature[-1] if signature and tail_length < block_size else None
+
+    with open(filepath, 'rb') as file:
+        length = os.fstat(file.fileno()).st_size
+        if not length:
+            yield END, hashlib.blake2b(digest_size=32).hexdigest()
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            copy_run = None         # [first block index, block count]
+            literal_start = 0
+            position = 0
+            last_window = length - block_size
+            a = b = None
+            while position <= last_window:
+                if position - literal_start >= MAX_LITERAL_SIZE:
+                    if copy_run:
+                        yield COPY, *copy_run
+                        copy_run = None
+                    yield from _literals(data, literal_start, position)
+                    literal_start = position
+                if a is None:
+                    checksum = zlib.adler32(data[position:position + block_size])
+                    a, b = checksum & 0xffff, checksum >> 16
+                candidates = blocks.get((b << 16) | a)
+                if candidates:
+                    index = candidates.get(strong_digest(data[position:position + block_size]))
+                    if index is not None and (tail_block is None or index < len(signature) - 1):
+                        if literal_start < position:
+                            if copy_run:
+                                yield COPY, *copy_run
+                                copy_run = None
+                            yield from _literals(data, literal_start, position)
+                        if copy_run and copy_run[0] + copy_run[1] == index:
+                            copy_run[1] += 1
+                        else:
+                            if copy_run:
+                                yield COPY, *copy_run
+                            copy_run = [index, 1]
+                        position += block_size
+                        literal_start = position
+                        a = None
+                        continue
+
+                end = min(last_window, literal_start + MAX_LITERAL_SIZE)
+                if position >= end:
+                    break
+                position, a, b = _roll(data, position, end, block_size, a, b, blocks)
+
+            tail = data[literal_start:]
+            if (tail_block and len(tail) == tail_length
+                    and zlib.adler32(tail) == tail_block[0] and strong_digest(tail) == tail_block[1]):
+                if copy_run and copy_run[0] + copy_run[1] == len(signature) - 1:
+                    copy_run[1] += 1
+                else:
+                    if copy_run:
+                        yield COPY, *copy_run
+                    copy_run = [len(signature) - 1, 1]
+                literal_start = length
+            if copy_run:
+                yield COPY, *copy_run
+            yield from _literals(data, literal_start, length)
+            yield END, hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+def _roll(data, position: int, end: int, block_size: int, a: int, b: int, blocks: dict):
+    """
+    Roll the Adler-32 checksum of the window at <position> forward one byte at a time.
+
+    :return: (position, a, b) of the first window whose checksum is in <blocks>, or of the window at <end>.
+    """
+
+    # Iterating over two slices is much faster than indexing the mapped file byte by byte
+    for out_byte, in_byte in zip(data[position:end], data[position + block_size:end + block_size]):
+        a = (a - out_byte + in_byte) % _ADLER_MOD
+        b = (b - block_size * out_byte + a - 1) % _ADLER_MOD
+        position += 1
+        if ((b << 16) | a) in blocks:
+            break
+    return position, a, b
+
+
+def _literals(data, start: int, end: int):
+    for offset in range(start, end, MAX_LITERAL_SIZE):
+        yield LITERAL, data[offset:min(end, offset + MAX_LITERAL_SIZE)]
+
+
+class DeltaWriter():
+    """
+    Rebuilds a new version of a file from blocks of the basis file and literal data.
+
+    The result is written to a separate output file and checked against the digest the
+    sender computed, so the basis file stays untouched until the caller replaces it.
+    """
+
+    def __init__(self, basis_path: pathlib.Path, output_path: pathlib.Path, block_size: int):
+        """
+        :param basis_path: Existing version of the file the signature was computed from.
+        :param output_path: File the new version is written to; it is created or truncated.
+        :param block_size: Block size of the signature.
+        """
+
+        self.block_size = block_size
+        self.output_path = output_path
+        self.basis = open(basis_path, 'rb')
+        self.basis_size = os.fstat(self.basis.fileno()).st_size
+        self.output = open(output_path, 'wb')
+        self.digest = hashlib.blake2b(digest_size=32)
+        self.written = 0
+        self.literal_bytes = 0
+
+
+    def copy(self, first_block: int, block_count: int):
+        """Append <block_count> blocks of the basis file, starting at block <first_block>."""
+
+        offset = first_block * self.block_size
+        end = min(self.basis_size, offset + block_count * self.block_size)
+        if first_block < 0 or block_count < 1 or offset >= end:
+            raise ValueError(f"Blocks {first_block}+{block_count} are not in the basis file")
+        self.basis.seek(offset)
+        while offset < end:
+            data = self.basis.read(min(COPY_BUFFER_SIZE, end - offset))
+            if not data:
+                raise ValueError("Basis file was truncated while it was being copied")
+            self._append(data)
+            offset += len(data)
+
+
+    def write(self, data) -> int:
+        """Append literal data."""
+
+        self.literal_bytes += len(data)
+        return self._append(data)
+
+
+    def _append(self, data) -> int:
+        self.digest.update(data)
+        self.written += len(data)
+        return self.output.write(data)
+
+
+    def finish(self, expected_digest: str):
+        """Close both files; raise ValueError if the new version doesn't match what the sender has."""
+
+        self.close()
+        if self.digest.hexdigest() != expected_digest:
+            raise ValueError("Rebuilt file doesn't match the digest of the sender")
+
+
+    def close(self):
+        self.basis.close()
+        self.output.close()
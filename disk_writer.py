@@ -0,0 +1,149 @@
+import os
+import pathlib
+import queue
+import threading
+
+
+DISK_QUEUE_BLOCKS = 64      # Received blocks that may wait for the disk before the socket stops being read
+FSYNC_POLICIES = ('none', 'end')    # or a number of MB written between two fsyncs
+
+
+def check_fsync_policy(policy):
+    """:return: Bytes written between two fsyncs for an 'every N MB' policy, otherwise None."""
+
+    if policy in FSYNC_POLICIES:
+        return None
+    if isinstance(policy, int) and not isinstance(policy, bool) and policy > 0:
+        return policy * 1024 * 1024
+    raise ValueError(f"Unsupported fsync policy: {policy!r} (expected 'none', 'end' or a number of MB)")
+
+
+def _sync(fd: int):
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def _sync_directory(path: pathlib.Path):
+    """Make a rename in <path> durable; not every platform can open a directory."""
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class DiskWriter():
+    """
+    File-like writer that hands blocks to a writer thread through a bounded queue.
+
+    The thread reading the socket only copies a block into the queue, so a disk stall
+    doesn't leave the socket unread until the queue is full; then write() blocks, which
+    stops the reads and lets TCP push back on the sender.
+
+    Data goes to a '.part' file next to <filepath>, preallocated to the expected size,
+    which replaces <filepath> in one rename once finish() is called. A transfer that
+    isn't finished leaves nothing behind.
+    """
+
+    def __init__(self, filepath: pathlib.Path, size: int, fsync_policy='none', reserved: bool = False):
+        """
+        :param filepath: Final path of the file.
+        :param size: Expected size of the file, used to preallocate it.
+        :param fsync_policy: 'none', 'end' to fsync before the rename, or N to also fsync every N MB.
+        :param reserved: <filepath> is an empty file created to hold the name; abort() removes it too.
+        """
+
+        self.fsync_interval = check_fsync_policy(fsync_policy)
+        self.fsync_policy = fsync_policy
+        self.filepath = pathlib.Path(filepath)
+        self.reserved = reserved
+        self.part_filepath = self.filepath.with_name(self.filepath.name + '.part')
+        self.fd = os.open(self.part_filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+        self.written = 0
+        self.error = None
+        self.closed = False
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+            except OSError:
+                # Not supported by every file system, the file simply grows as it is written
+                pass
+        self.blocks = queue.Queue(maxsize=DISK_QUEUE_BLOCKS)
+        self.thread = threading.Thread(target=self._write_blocks, daemon=True)
+        self.thread.start()
+
+
+    def _write_blocks(self):
+        unsynced = 0
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            if self.error:
+                # Keep draining so write() never blocks on a dead writer
+                continue
+            try:
+                view = memoryview(block)
+                while view:
+                    view = view[os.write(self.fd, view):]
+                self.written += len(block)
+                unsynced += len(block)
+                if self.fsync_interval and unsynced >= self.fsync_interval:
+                    _sync(self.fd)
+                    unsynced = 0
+            except Exception as e:
+                self.error = e
+
+
+    def write(self, data) -> int:
+        """Queue a copy of <data>; raises the error of an earlier block that failed to be written."""
+
+        if self.error:
+            raise self.error
+        self.blocks.put(bytes(data))
+        return len(data)
+
+
+    def _stop(self):
+        if self.thread.is_alive():
+            self.blocks.put(None)
+            self.thread.join()
+
+
+    def finish(self) -> pathlib.Path:
+        """Wait for the queued blocks, apply the fsync policy and move the file to its final path."""
+
+        self._stop()
+        if self.error:
+            raise self.error
+        # Drop what was preallocated but never written
+        os.ftruncate(self.fd, self.written)
+        if self.fsync_policy != 'none':
+            _sync(self.fd)
+        os.close(self.fd)
+        self.closed = True
+        os.replace(self.part_filepath, self.filepath)
+        if self.fsync_policy != 'none':
+            _sync_directory(self.filepath.parent)
+        return self.filepath
+
+
+    def abort(self):
+        """Throw the partial file away; does nothing once finish() succeeded."""
+
+        self._stop()
+        if self.closed:
+            return
+        os.close(self.fd)
+        self.closed = True
+        self.part_filepath.unlink(missing_ok=True)
+        if self.reserved:
+            self.filepath.unlink(missing_ok=True)
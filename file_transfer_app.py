@@ -1,5 +1,10 @@
-from server import start_server
-from client import start_client
+# Only the side that is chosen is imported, the other one's dependencies don't slow down startup
+import sys
+
+if len(sys.argv) > 1:
+    # 'send' or 'receive' on the command line streams stdin to the receiver's stdout
+    import pipe
+    sys.exit(pipe.main())
 
 while True:
 
@@ -7,10 +12,12 @@ while True:
 
     if action.strip().casefold() == "receive":
         print()
+        from server import start_server
         start_server()
         break
     elif action.strip().casefold() == "send":
         print()
+        from client import start_client
         start_client()
         break
     else:
@@ -0,0 +1,105 @@
+import hashlib
+import queue
+import threading
+
+
+DIGEST_ALGORITHMS = ('blake2b', 'sha256')   # Algorithms a sender may choose for the digest trailer
+HASH_BLOCK_SIZE = 1024 * 1024               # Bytes read at a time when hashing a file
+HASH_PENDING_BLOCKS = 16                    # Received blocks waiting for the hashing thread
+
+
+def check_algorithm(algorithm: str):
+    if algorithm not in DIGEST_ALGORITHMS:
+        raise ValueError(f"Unsupported digest algorithm: {algorithm}")
+
+
+class StreamHasher():
+    """
+    Digest of a stream of blocks, computed on a helper thread.
+
+    update() only queues a copy of the block, so the caller can reuse its buffer and go back
+    to the socket straight away. hashlib releases the GIL while it hashes large blocks.
+    """
+
+    def __init__(self, algorithm: str = 'blake2b'):
+        check_algorithm(algorithm)
+        self.hash = hashlib.new(algorithm)
+        self.blocks = queue.Queue(maxsize=HASH_PENDING_BLOCKS)
+        self.thread = threading.Thread(target=self._hash_blocks, daemon=True)
+        self.thread.start()
+
+
+    def _hash_blocks(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            self.hash.update(block)
+
+
+    def update(self, data):
+        self.blocks.put(bytes(data))
+
+
+    def hexdigest(self) -> str:
+        """Wait for the queued blocks to be hashed and return the digest; no more blocks can be added."""
+
+        if self.thread.is_alive():
+            self.blocks.put(None)
+            self.thread.join()
+        return self.hash.hexdigest()
+
+
+class HashingWriter():
+    """File-like writer that feeds everything written to a file into a StreamHasher."""
+
+    def __init__(self, file, hasher: StreamHasher):
+        self.file = file
+        self.hasher = hasher
+
+
+    def write(self, data) -> int:
+        written = self.file.write(data)
+        self.hasher.update(data)
+        return written
+
+
+class FileHasher():
+    """
+    Digest of a byte range of a file, read and hashed on a helper thread.
+
+    The sender starts it next to a transfer that never copies the data into Python, such as
+    sendfile, so the range is hashed while it is sent, mostly from the page cache.
+    """
+
+    def __init__(self, filepath, offset: int, length: int, algorithm: str = 'blake2b'):
+        check_algorithm(algorithm)
+        self.filepath = filepath
+        self.offset = offset
+        self.length = length
+        self.hash = hashlib.new(algorithm)
+        self.error = None
+        self.thread = threading.Thread(target=self._hash_file, daemon=True)
+        self.thread.start()
+
+
+    def _hash_file(self):
+        try:
+            with open(self.filepath, 'rb') as file:
+                file.seek(self.offset)
+                remaining = self.length
+                while remaining:
+                    block = file.read(min(HASH_BLOCK_SIZE, remaining))
+                    if not block:
+                        raise ValueError(f"{self.filepath} was truncated while it was being hashed")
+                    self.hash.update(block)
+                    remaining -= len(block)
+        except Exception as e:
+            self.error = e
+
+
+    def hexdigest(self) -> str:
+        self.thread.join()
+        if self.error:
+            raise self.error
+        return self.hash.hexdigest()
@@ -0,0 +1,271 @@
+import collections
+import itertools
+import threading
+import time
+
+
+RATE_WINDOW = 1.0           # Seconds of history the instantaneous rate is computed over
+PROGRESS_INTERVAL = 0.25    # Seconds between two terminal progress updates of a transfer
+FINISHED_HISTORY = 100      # Finished transfers kept for stats()
+
+
+def format_bytes(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+class TransferMetrics():
+    """
+    Counters of one transfer, updated by the code that moves its bytes.
+
+    Time is split between blocking on the socket and blocking on the disk, so a slow
+    transfer shows which side holds it up. Time spent waiting for a rate limit is kept
+    apart as throttled time.
+    """
+
+    def __init__(self, registry, transfer_id: int, name: str, direction: str, total_bytes: int):
+        """
+        :param direction: 'send' or 'receive'.
+        :param total_bytes: Bytes the transfer is expected to move.
+        """
+
+        self.registry = registry
+        self.transfer_id = transfer_id
+        self.name = name
+        self.direction = direction
+        self.total_bytes = total_bytes
+        self.bytes = 0
+        self.syscalls = 0
+        self.socket_time = 0.0
+        self.disk_time = 0.0
+        self.throttled_time = 0.0
+        self.bucket = None          # TokenBucket of the transfer when the registry has a BandwidthScheduler
+        self.tuning = None          # Parameters chosen for the connection by its ConnectionTuner (see tuning)
+        self.status = 'active'
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.samples = collections.deque([(self.start_time, 0)])
+        self.lock = threading.Lock()
+
+
+    def add(self, length: int, syscalls: int = 1, socket_time: float = 0.0, disk_time: float = 0.0, wait: bool = True) -> float:
+        """
+        Record <length> more bytes moved with <syscalls> calls and the time they blocked, and pay
+        for them if the transfer is rate limited.
+
+        :param wait: Sleep until the bytes fit the rate limit. Code on an event loop passes False
+                     and waits for the returned delay itself.
+        :return: Seconds to wait before moving more data.
+        """
+
+        delay = self.bucket.reserve(length) if self.bucket else 0.0
+        now = time.monotonic()
+        with self.lock:
+            self.bytes += length
+            self.syscalls += syscalls
+            self.socket_time += socket_time
+            self.disk_time += disk_time
+            self.throttled_time += delay
+            self.samples.append((now, self.bytes))
+            while len(self.samples) > 2 and now - self.samples[1][0] >= RATE_WINDOW:
+                self.samples.popleft()
+        self.registry.publish(self)
+        if delay and wait:
+            time.sleep(delay)
+        return delay
+
+
+    def finish(self, status: str = 'completed'):
+        """Mark the transfer 'completed' or 'failed'; only the first call counts."""
+
+        with self.lock:
+            if self.end_time is not None:
+                return
+            self.status = status
+            self.end_time = time.monotonic()
+        self.registry.transfer_finished(self)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Finish as 'failed' on an exception or if fewer than total_bytes were moved."""
+
+        self.finish('failed' if exc_type or self.bytes < self.total_bytes else 'completed')
+
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end_time or time.monotonic()) - self.start_time
+
+
+    @property
+    def average_rate(self) -> float:
+        """Bytes per second since the transfer started."""
+
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+
+    @property
+    def rate(self) -> float:
+        """Bytes per second over the last RATE_WINDOW seconds."""
+
+        with self.lock:
+            (first_time, first_bytes), (last_time, last_bytes) = self.samples[0], self.samples[-1]
+        if self.end_time is not None or last_time <= first_time:
+            return self.average_rate
+        return (last_bytes - first_bytes) / (last_time - first_time)
+
+
+    @property
+    def eta(self):
+        """Seconds until the transfer completes at the current rate, or None if nothing is moving."""
+
+        rate = self.rate
+        if self.end_time is not None:
+            return 0.0
+        return max(0, self.total_bytes - self.bytes) / rate if rate else None
+
+
+    def snapshot(self) -> dict:
+        return {
+            'id': self.transfer_id,
+            'name': self.name,
+            'direction': self.direction,
+            'status': self.status,
+            'bytes': self.bytes,
+            'total_bytes': self.total_bytes,
+            'rate': self.rate,
+            'average_rate': self.average_rate,
+            'eta': self.eta,
+            'elapsed': self.elapsed,
+            'syscalls': self.syscalls,
+            'socket_time': self.socket_time,
+            'disk_time': self.disk_time,
+            'throttled_time': self.throttled_time,
+            'rate_limit': self.bucket.rate if self.bucket else None,
+            'tuning': self.tuning,
+        }
+
+
+class MetricsRegistry():
+    """
+    Metrics of the transfers in progress and of the last FINISHED_HISTORY finished ones.
+
+    Subscribers are called with the TransferMetrics every time it is updated and once more
+    when it finishes, on the thread that moved the bytes; they should return quickly.
+    """
+
+    def __init__(self, scheduler=None):
+        """:param scheduler: BandwidthScheduler that rate limits every transfer started on this registry."""
+
+        self.scheduler = scheduler
+        self.active = {}
+        self.finished = collections.deque(maxlen=FINISHED_HISTORY)
+        self.totals = collections.Counter()
+        self.subscribers = []
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+
+    def start(self, name: str, direction: str, total_bytes: int, weight: float = 1) -> TransferMetrics:
+        """:param weight: Share of the scheduler's global rate relative to the other transfers."""
+
+        transfer = TransferMetrics(self, next(self.ids), name, direction, total_bytes)
+        if self.scheduler:
+            transfer.bucket = self.scheduler.register(transfer.transfer_id, weight)
+        with self.lock:
+            self.active[transfer.transfer_id] = transfer
+        self.publish(transfer)
+        return transfer
+
+
+    def subscribe(self, callback):
+        """
+        Call <callback>(TransferMetrics) on every update.
+
+        :return: Function that removes the subscription.
+        """
+
+        with self.lock:
+            self.subscribers = self.subscribers + [callback]
+        return lambda: self.unsubscribe(callback)
+
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers = [subscriber for subscriber in self.subscribers if subscriber is not callback]
+
+
+    def publish(self, transfer: TransferMetrics):
+        for subscriber in self.subscribers:
+            subscriber(transfer)
+
+
+    def transfer_finished(self, transfer: TransferMetrics):
+        if self.scheduler:
+            self.scheduler.unregister(transfer.transfer_id)
+        with self.lock:
+            self.active.pop(transfer.transfer_id, None)
+            self.finished.append(transfer)
+            self.totals[f"bytes_{transfer.direction}"] += transfer.bytes
+            self.totals[f"transfers_{transfer.status}"] += 1
+        self.publish(transfer)
+
+
+    def stats(self) -> dict:
+        """Snapshot of every transfer and of the totals since the registry was created."""
+
+        with self.lock:
+            active = list(self.active.values())
+            finished = list(self.finished)
+            totals = dict(self.totals)
+        return {
+            'active': [transfer.snapshot() for transfer in active],
+            'finished': [transfer.snapshot() for transfer in finished],
+            'totals': totals,
+        }
+
+
+class ProgressPrinter():
+    """
+    Terminal progress of transfers, as a MetricsRegistry subscriber.
+
+    A transfer's line is redrawn at most every PROGRESS_INTERVAL seconds and once when it
+    finishes, however many blocks it is moved in.
+    """
+
+    def __init__(self, verb: str, interval: float = PROGRESS_INTERVAL):
+        """:param verb: Shown after the percentage, e.g. 'sent' or 'downloaded'."""
+
+        self.verb = verb
+        self.interval = interval
+        self.last_update = {}
+
+
+    def __call__(self, transfer: TransferMetrics):
+        now = time.monotonic()
+        finished = transfer.end_time is not None
+        if finished:
+            self.last_update.pop(transfer.transfer_id, None)
+        elif now - self.last_update.get(transfer.transfer_id, 0) < self.interval:
+            return
+        else:
+            self.last_update[transfer.transfer_id] = now
+
+        rate = format_bytes(transfer.rate)
+        if transfer.total_bytes:
+            percent = transfer.bytes / transfer.total_bytes * 100
+            eta = f", ETA {transfer.eta:.0f}s" if transfer.eta and not finished else ""
+            line = (f"{percent:.0f}% file {self.verb} ({format_bytes(transfer.bytes)} of {format_bytes(transfer.total_bytes)}, "
+                    f"{rate}/s{eta})")
+        else:
+            # Size not known up front, e.g. a batch
+            line = f"{format_bytes(transfer.bytes)} {self.verb} ({rate}/s)"
+        print('\r', end="")
+        print(f"{line:<72}", end="", flush=True)
@@ -0,0 +1,180 @@
+import os
+import pathlib
+import threading
+import time
+
+
+RANGE_SIZE = 32 * 1024 * 1024  # A file sent over parallel streams is split into ranges of this size
+TRANSFER_ID_SIZE = 32          # Transfer ids are 16 random bytes as hex strings
+STREAM_ATTACH_TIMEOUT = 10     # Seconds a stream waits for its transfer to be announced on the main connection
+
+
+def split_ranges(file_size: int, range_size: int = RANGE_SIZE):
+    """
+    Split a file into consecutive (offset, length) byte ranges of at most <range_size> bytes.
+    """
+
+    return [(offset, min(range_size, file_size - offset)) for offset in range(0, file_size, range_size)]
+
+
+class ParallelTransfer():
+    """
+    Receiver side state of one file that arrives as byte ranges over several stream connections.
+
+    The target is preallocated under a '.part' name and every range is written in place
+    with positional writes, so ranges can arrive in any order and on any stream. The file is
+    complete once every range of split_ranges has arrived; a range sent twice, e.g. again
+    on another stream after a failure the server didn't see, counts once.
+    """
+
+    def __init__(self, transfer_id: str, filepath: pathlib.Path, file_size: int, conn, metrics=None):
+        """
+        :param transfer_id: Id chosen by the client and repeated by every stream connection.
+        :param filepath: Final path of the file once all ranges have arrived.
+        :param file_size: Total size of the file in bytes.
+        :param conn: Main connection of the sender, used to report completion.
+        :param metrics: TransferMetrics shared by all stream connections of the transfer.
+        """
+
+        self.transfer_id = transfer_id
+        self.filepath = filepath
+        self.part_filepath = filepath.with_name(filepath.name + '.part')
+        self.file_size = file_size
+        self.conn = conn
+        self.metrics = metrics
+        self.ranges = dict(split_ranges(file_size))     # offset -> length of every range of the file
+        self.received = set()                           # offsets of the ranges written in full
+        self.streams = 0                                # stream connections attached to the transfer
+        self.idle_since = time.monotonic()              # when the last stream connection detached
+        self.writes = 0                                 # writes in progress, the file is only closed without any
+        self.completing = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.fd = os.open(self.part_filepath, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        os.ftruncate(self.fd, file_size)
+
+
+    def check_range(self, offset: int, length: int):
+        """Raise ValueError unless <offset> and <length> are exactly one of the ranges of the file."""
+
+        if self.ranges.get(offset) != length:
+            raise ValueError(f"Invalid range of {self.filepath.name}: {length} bytes at offset {offset} "
+                             f"(the file has {self.file_size} bytes in ranges of {RANGE_SIZE})")
+
+
+    def attach(self) -> bool:
+        """Count a stream connection sending ranges. :return: False if the transfer is already over."""
+
+        with self.condition:
+            if self.closed or self.completing:
+                return False
+            self.streams += 1
+            return True
+
+
+    def detach(self):
+        with self.condition:
+            self.streams -= 1
+            if not self.streams:
+                self.idle_since = time.monotonic()
+
+
+    def is_abandoned(self, idle_time: float = 0) -> bool:
+        """:return: True if ranges are missing while no stream connection has been attached for <idle_time> seconds."""
+
+        with self.condition:
+            if self.streams or self.completing or self.closed:
+                return False
+            return time.monotonic() - self.idle_since >= idle_time
+
+
+    def write_at(self, offset: int, data) -> int:
+        """Write <data> at <offset> without moving any shared file position."""
+
+        with self.condition:
+            if self.closed:
+                raise ValueError(f"Parallel transfer of {self.filepath.name} is already over")
+            self.writes += 1
+        try:
+            view = memoryview(data)
+            if hasattr(os, 'pwrite'):
+                while view:
+                    written = os.pwrite(self.fd, view, offset)
+                    offset += written
+                    view = view[written:]
+            else:
+                with self.lock:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    while view:
+                        written = os.write(self.fd, view)
+                        view = view[written:]
+        finally:
+            with self.condition:
+                self.writes -= 1
+                self.condition.notify_all()
+        return len(data)
+
+
+    def range_received(self, offset: int) -> bool:
+        """
+        Record that the range at <offset> was written in full.
+
+        :return: True, to a single caller, once every range of the file has arrived.
+        """
+
+        with self.condition:
+            self.received.add(offset)
+            if self.completing or len(self.received) < len(self.ranges):
+                return False
+            self.completing = True
+            return True
+
+
+    def is_complete(self) -> bool:
+        return len(self.received) == len(self.ranges)
+
+
+    def _close(self):
+        # Called with the condition held; a range sent twice may still be written by another stream
+        self.closed = True
+        self.condition.wait_for(lambda: not self.writes)
+        os.close(self.fd)
+
+
+    def finish(self):
+        """Close the partial file and move it to its final name."""
+
+        with self.condition:
+            self._close()
+        os.replace(self.part_filepath, self.filepath)
+
+
+    def abort(self) -> bool:
+        """
+        Close and remove the partial file of a transfer that won't be completed, and the empty file reserving its name.
+
+        :return: False if the transfer was already completed or aborted.
+        """
+
+        with self.condition:
+            if self.closed or self.completing:
+                return False
+            self._close()
+        self.part_filepath.unlink(missing_ok=True)
+        self.filepath.unlink(missing_ok=True)
+        return True
+
+
+class RangeWriter():
+    """File-like adapter that writes consecutive blocks of one range into a ParallelTransfer."""
+
+    def __init__(self, transfer: ParallelTransfer, offset: int):
+        self.transfer = transfer
+        self.offset = offset
+
+
+    def write(self, data) -> int:
+        written = self.transfer.write_at(self.offset, data)
+        self.offset += written
+        return written
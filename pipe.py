@@ -0,0 +1,117 @@
+"""
+Pipe mode: stream the stdin of one host to the stdout of another.
+
+    python pipe.py receive --port 5555 > dump.sql
+    pg_dump mydb | python pipe.py send 192.168.1.20 5555
+
+The data moves in chunks as soon as it is produced, in constant memory on both sides, and a
+slow reader of the receiver's stdout slows the sender down instead of filling memory. Only
+the data goes to stdout; everything else the sender and receiver print goes to stderr.
+
+The receiver exits once a stream has been received, with status 0 if it was complete; the
+sender once the receiver has confirmed the end of the stream. A sender pointed at a receiver
+that isn't in pipe mode has its stream saved as a file named after --name.
+"""
+
+import argparse
+import contextlib
+import queue
+import sys
+import threading
+import time
+
+
+PIPE_PORT = 5555
+CONFIRMATION_TIMEOUT = 60       # Seconds the sender waits for the receiver to confirm the end of the stream
+DISCONNECT_TIMEOUT = 5          # Seconds the receiver waits for the sender to read the confirmation and leave
+
+
+def receive(server_ip: str = None, port: int = PIPE_PORT) -> int:
+    """Write the first stream a sender sends to stdout. :return: Exit status."""
+
+    from server import Server, start_server
+
+    output = sys.stdout.buffer
+    finished = threading.Event()
+    result = {}
+
+    def on_transfer(transfer):
+        if transfer.status != 'active':
+            result.setdefault('status', transfer.status)
+            finished.set()
+
+    with contextlib.redirect_stdout(sys.stderr):
+        server = Server(server_ip, port, pipe_output=output)
+        server.metrics.subscribe(on_transfer)
+        accept_thread = threading.Thread(target=start_server, args=(server,), daemon=True)
+        accept_thread.start()
+        try:
+            while not finished.wait(0.5):
+                if not accept_thread.is_alive():
+                    # The server couldn't listen, start_server printed why
+                    return 1
+            # Leave the sender time to read the 'Pipe Received' notification
+            deadline = time.monotonic() + DISCONNECT_TIMEOUT
+            while server.client_dict and time.monotonic() < deadline:
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            return 1
+        finally:
+            server.server.close()
+    output.flush()
+    return 0 if result.get('status') == 'completed' else 1
+
+
+def send(server_ip: str, port: int = PIPE_PORT, name: str = 'stdin', username: str = 'pipe') -> int:
+    """Send stdin to a receiver until it ends. :return: Exit status."""
+
+    from client import Client
+
+    events = queue.Queue()
+    with contextlib.redirect_stdout(sys.stderr):
+        client = Client(server_ip=server_ip, port=port, username=username, event_callback=events.put, progress=False)
+        try:
+            if client.client_closed:
+                return 1
+            client.open_event_channel()
+            threading.Thread(target=client.listen_events, daemon=True).start()
+            if client.send_pipe(sys.stdin.buffer, name) is None:
+                return 1
+            try:
+                event = events.get(timeout=CONFIRMATION_TIMEOUT)
+            except queue.Empty:
+                print("The receiver didn't confirm the end of the stream")
+                return 1
+            print(event)
+            return 0 if event == 'Pipe Received' else 1
+        except KeyboardInterrupt:
+            return 1
+        finally:
+            client.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream stdin to the stdout of a receiver on another host.")
+    modes = parser.add_subparsers(dest='mode', required=True)
+    receive_parser = modes.add_parser('receive', help="Write the stream of a sender to stdout")
+    receive_parser.add_argument('--ip', help="Address to listen on (default: this host's private network address)")
+    receive_parser.add_argument('-p', '--port', type=int, default=PIPE_PORT, help="(default: %(default)s)")
+    send_parser = modes.add_parser('send', help="Send stdin to a receiver")
+    send_parser.add_argument('server_ip')
+    send_parser.add_argument('port', type=int)
+    send_parser.add_argument('-n', '--name', default='stdin',
+                             help="File name a receiver that isn't in pipe mode saves the stream under (default: %(default)s)")
+    send_parser.add_argument('-u', '--username', default='pipe', help="(default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.mode == 'receive':
+            return receive(args.ip, args.port)
+        return send(args.server_ip, args.port, args.name, args.username)
+    except (ConnectionError, OSError) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+import json
+import struct
+
+
+# Connections that are not a client session start with one of these instead of a username
+STREAM_HELLO = "STREAM "    # "STREAM <transfer_id>": byte ranges of a parallel transfer
+EVENTS_HELLO = "EVENTS "    # "EVENTS <token>": event channel the server pushes notifications on
+RELAY_HELLO = "RELAY "      # "RELAY": subscriber that the server passes every upload on to (see relay)
+
+# A client that speaks protocol v2 or later opens every connection with HELLO_MAGIC followed by
+# the highest version it supports as one byte. The server answers with the version both sides
+# will use, framed as a v1 reply. v1 clients send their username straight away; the magic is not
+# valid UTF-8 so it can never be mistaken for one.
+# v3 has the same framing as v2 and adds the 'Verified' file frame with its 'Digest' trailer.
+# v4 adds the 'Offer' request, which lets a client skip a file the server already has.
+# v5 lets the hello carry the session as a length prefixed JSON object: the username and whether an
+# event channel token is wanted, or the STREAM/EVENTS hello of an extra connection. The server answers
+# the version, the outcome, the token and its capabilities in one JSON reply, still framed as v1, so
+# a connection is ready after one round trip. Servers before v5 ignore the session and answer the
+# version alone; the client then continues with the v2 handshake.
+# v6 adds the 'Pipe' frame: data of unknown length, e.g. stdin, as length prefixed chunks that end
+# with an empty one.
+# v7 adds RELAY connections: a subscriber gets every upload as a 'Relay' frame, the size (0 if unknown)
+# and name followed by length prefixed chunks, an empty chunk and the status 'completed' or 'failed'.
+# v8 adds the 'Udp' request: the file body goes over a UDP port the server opens for it, while the
+# connection carries the receiver's reports (see udp_transfer).
+PROTOCOL_VERSION = 8
+HELLO_MAGIC = b"\xffFT"
+SESSION_HELLO_VERSION = 5
+
+# v1 Data Type is an ASCII string padded to DATA_TYPE_SIZE bytes, v2 sends its index in DATA_TYPES
+DATA_TYPE_SIZE = 10
+DATA_TYPES = ('File', 'Text', 'POLL', 'Parallel', 'Range', 'Batch', 'Events', 'Resume', 'ResumeData',
+              'Compressed', 'Delta', 'DeltaData', 'Verified', 'Digest', 'Stats', 'Offer', 'Pipe', 'Relay', 'Udp')
+
+MAX_CONTROL_SIZE = 1024 * 1024      # Largest Text frame or JSON request a receiver reads
+
+_V2_HEADER = struct.Struct('!BQ')       # data type code, data length
+_V2_INT = struct.Struct('!Q')           # lengths and offsets
+_V2_NAME_LENGTH = struct.Struct('!H')   # length of a file name or relative path
+_SESSION_LENGTH = struct.Struct('!H')   # length of the JSON session of a v5 hello
+
+
+def pack_hello(version: int, session: dict = None) -> bytes:
+    """Protocol hello for <version>, carrying <session> if the version supports it."""
+
+    hello = HELLO_MAGIC + bytes([version])
+    if session is None or version < SESSION_HELLO_VERSION:
+        return hello
+    encoded_session = json.dumps(session).encode("utf-8")
+    return hello + _SESSION_LENGTH.pack(len(encoded_session)) + encoded_session
+
+
+def hello_size(hello: bytes) -> int:
+    """Bytes of the complete hello that <hello> starts with, so a server can read what is missing."""
+
+    prefix_size = len(HELLO_MAGIC) + 1
+    if len(hello) < prefix_size + _SESSION_LENGTH.size or hello[len(HELLO_MAGIC)] < SESSION_HELLO_VERSION:
+        return len(hello)
+    return prefix_size + _SESSION_LENGTH.size + _SESSION_LENGTH.unpack_from(hello, prefix_size)[0]
+
+
+def unpack_hello(hello: bytes):
+    """:return: (requested version, session dict or None if the hello carries none)."""
+
+    prefix_size = len(HELLO_MAGIC) + 1
+    requested_version = hello[len(HELLO_MAGIC)] if len(hello) > len(HELLO_MAGIC) else 1
+    if requested_version < SESSION_HELLO_VERSION or len(hello) < prefix_size + _SESSION_LENGTH.size:
+        return requested_version, None
+    session = json.loads(hello[prefix_size + _SESSION_LENGTH.size:hello_size(hello)])
+    return requested_version, session if isinstance(session, dict) else None
+
+
+def send_frame(sock, *buffers):
+    """
+    Send <buffers> back to back, as one scatter/gather sendmsg call where the platform has it.
+
+    Partial sends are continued until every buffer has been sent.
+    """
+
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b"".join(buffers))
+        return
+
+    views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    while views:
+        sent = sock.sendmsg(views)
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+class FrameCodec():
+    """
+    Encoding of frame headers and header fields for one protocol version.
+
+    v1 frames use space padded ASCII numbers: a <data_header_size>-byte length, a
+    <DATA_TYPE_SIZE>-byte data type and <filename_header_size>-byte name lengths.
+    v2 frames pack the same fields with struct: a 9-byte header, 8-byte integers and
+    2-byte name lengths. Replies from the server are a length followed by the data.
+    """
+
+    def __init__(self, version: int = 1, data_header_size: int = 13, filename_header_size: int = 7):
+        self.version = version
+        if version >= 2:
+            self.header_size = _V2_HEADER.size
+            self.int_size = _V2_INT.size
+            self.name_length_size = _V2_NAME_LENGTH.size
+        else:
+            self.header_size = data_header_size + DATA_TYPE_SIZE
+            self.int_size = data_header_size
+            self.name_length_size = filename_header_size
+
+
+    def pack_header(self, data_type: str, data_length: int) -> bytes:
+        if self.version >= 2:
+            return _V2_HEADER.pack(DATA_TYPES.index(data_type) + 1, data_length)
+        return f"{data_length:<{(self.int_size)}}{data_type:<{(DATA_TYPE_SIZE)}}".encode("utf-8")
+
+
+    def unpack_header(self, header: bytes):
+        """:return: (data type, data length)"""
+
+        if self.version >= 2:
+            type_code, data_length = _V2_HEADER.unpack(header)
+            if not 0 < type_code <= len(DATA_TYPES):
+                raise ValueError(f"Unknown data type code: {type_code}")
+            return DATA_TYPES[type_code - 1], data_length
+        return header[self.int_size:].decode("utf-8").strip(), int(header[:self.int_size].decode("utf-8").strip())
+
+
+    def pack_int(self, value: int) -> bytes:
+        if self.version >= 2:
+            return _V2_INT.pack(value)
+        return f"{value:<{(self.int_size)}}".encode("utf-8")
+
+
+    def unpack_int(self, data: bytes) -> int:
+        if self.version >= 2:
+            return _V2_INT.unpack(data)[0]
+        return int(data.decode("utf-8").strip())
+
+
+    def pack_name(self, name) -> bytes:
+        """Length prefixed file name or relative path."""
+
+        encoded_name = name.encode("utf-8") if isinstance(name, str) else name
+        if self.version >= 2:
+            return _V2_NAME_LENGTH.pack(len(encoded_name)) + encoded_name
+        return f"{len(encoded_name):<{(self.name_length_size)}}".encode("utf-8") + encoded_name
+
+
+    def unpack_name_length(self, data: bytes) -> int:
+        if self.version >= 2:
+            return _V2_NAME_LENGTH.unpack(data)[0]
+        return int(data.decode("utf-8").strip())
+
+
+    def read_header(self, reader):
+        """
+        Read a frame header from a RecvBuffer.
+
+        :return: (data type, data length), or (None, 0) if the peer disconnected.
+        """
+
+        header = reader.recv_exact(self.header_size)
+        if len(header) < self.header_size:
+            return None, 0
+        return self.unpack_header(header)
+
+
+    def read_int(self, reader) -> int:
+        return self.unpack_int(self._read_exact(reader, self.int_size))
+
+
+    def read_name(self, reader) -> str:
+        name_length = self.unpack_name_length(self._read_exact(reader, self.name_length_size))
+        return self._read_exact(reader, name_length).decode("utf-8")
+
+
+    def _read_exact(self, reader, length: int) -> bytes:
+        data = reader.recv_exact(length)
+        if len(data) < length:
+            raise ConnectionError("Disconnected in the middle of a frame")
+        return data
@@ -0,0 +1,163 @@
+import threading
+import time
+
+
+BUCKET_DEPTH = 0.25     # Seconds of traffic a bucket holds, the largest burst after an idle period
+MIN_BUCKET_SIZE = 64 * 1024
+
+
+class TokenBucket():
+    """
+    Token bucket of <rate> bytes per second.
+
+    Bytes are paid for as they are moved and the bucket may go into debt, so blocks of any
+    size keep the average at the rate; the caller waits until the debt is paid back.
+    A rate of None means unlimited.
+    """
+
+    def __init__(self, rate: float = None):
+        self.rate = None
+        self.capacity = 0.0
+        self.tokens = 0.0
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        self.set_rate(rate)
+
+
+    def _refill(self, now: float):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+
+    def set_rate(self, rate: float = None):
+        """Change the rate; bytes already paid for keep their place."""
+
+        if rate is not None and rate <= 0:
+            raise ValueError(f"Rate limit must be positive, got {rate}")
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self.capacity = max(MIN_BUCKET_SIZE, rate * BUCKET_DEPTH) if rate else 0.0
+            self.tokens = min(self.tokens, self.capacity)
+
+
+    def reserve(self, length: int) -> float:
+        """
+        Pay for <length> bytes.
+
+        :return: Seconds the caller has to wait before moving more data.
+        """
+
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            self._refill(time.monotonic())
+            self.tokens -= length
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+    def consume(self, length: int) -> float:
+        """Pay for <length> bytes and sleep until the bucket is out of debt; return the time slept."""
+
+        delay = self.reserve(length)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class BandwidthScheduler():
+    """
+    Global and per-transfer rate limits of the transfers of one Client or Server.
+
+    The global rate is shared by the active transfers in proportion to their weight. A
+    transfer whose own limit is below its share keeps its limit and the rest is shared
+    by the others, so the global rate is used as long as some transfer can take it.
+    Limits and weights can be changed while transfers are running.
+    """
+
+    def __init__(self, rate: float = None, transfer_rate: float = None):
+        """
+        :param rate: Bytes per second for all transfers together, None for unlimited.
+        :param transfer_rate: Default limit in bytes per second of every single transfer, None for unlimited.
+        """
+
+        self.rate = rate
+        self.transfer_rate = transfer_rate
+        self.limits = {}        # transfer id -> own limit of the transfer
+        self.weights = {}       # transfer id -> weight of the transfer
+        self.buckets = {}       # transfer id -> TokenBucket running at the transfer's share
+        self.lock = threading.Lock()
+        self.set_rate(rate)
+
+
+    def register(self, transfer_id: int, weight: float = 1) -> TokenBucket:
+        """Add a transfer and return the bucket it has to pay its bytes into."""
+
+        bucket = TokenBucket()
+        with self.lock:
+            self.limits[transfer_id] = self.transfer_rate
+            self.weights[transfer_id] = weight
+            self.buckets[transfer_id] = bucket
+            self._rebalance()
+        return bucket
+
+
+    def unregister(self, transfer_id: int):
+        with self.lock:
+            self.limits.pop(transfer_id, None)
+            self.weights.pop(transfer_id, None)
+            self.buckets.pop(transfer_id, None)
+            self._rebalance()
+
+
+    def set_rate(self, rate: float = None, transfer_id: int = None):
+        """
+        Change the global rate limit, or the limit of one transfer if <transfer_id> is given.
+        None removes the limit.
+        """
+
+        if rate is not None and rate <= 0:
+            raise ValueError(f"Rate limit must be positive, got {rate}")
+        with self.lock:
+            if transfer_id is None:
+                self.rate = rate
+            elif transfer_id in self.limits:
+                self.limits[transfer_id] = rate
+            else:
+                raise KeyError(f"No active transfer with id {transfer_id}")
+            self._rebalance()
+
+
+    def set_weight(self, transfer_id: int, weight: float):
+        """Change the share of the global rate a transfer gets relative to the others."""
+
+        if weight <= 0:
+            raise ValueError(f"Weight must be positive, got {weight}")
+        with self.lock:
+            if transfer_id not in self.weights:
+                raise KeyError(f"No active transfer with id {transfer_id}")
+            self.weights[transfer_id] = weight
+            self._rebalance()
+
+
+    def _rebalance(self):
+        """Set the bucket of every transfer to its weighted share of the global rate (water-filling)."""
+
+        rates = {transfer_id: limit for transfer_id, limit in self.limits.items()}
+        if self.rate:
+            remaining = self.rate
+            unsettled = set(rates)
+            while unsettled:
+                total_weight = sum(self.weights[transfer_id] for transfer_id in unsettled)
+                capped = {transfer_id for transfer_id in unsettled
+                          if self.limits[transfer_id] and self.limits[transfer_id] <= remaining * self.weights[transfer_id] / total_weight}
+                if not capped:
+                    for transfer_id in unsettled:
+                        rates[transfer_id] = remaining * self.weights[transfer_id] / total_weight
+                    break
+                for transfer_id in capped:
+                    remaining -= self.limits[transfer_id]
+                unsettled -= capped
+        for transfer_id, bucket in self.buckets.items():
+            bucket.set_rate(rates[transfer_id])
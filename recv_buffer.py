@@ -0,0 +1,109 @@
+import socket
+import time
+
+
+DEFAULT_BUFFER_SIZE = 256 * 1024
+MAX_EXACT_SIZE = 64 * 1024 * 1024   # Largest frame body held in memory at once, e.g. a compressed chunk
+
+
+class RecvBuffer():
+    """
+    Receive engine shared by the Server and the Client.
+
+    Data is read with recv_into into one preallocated buffer that is reused for the
+    whole lifetime of the connection, so no bytes object is allocated per chunk.
+    Reads never go past the length that was asked for, which keeps the framing of
+    the connection untouched for whoever reads next.
+    """
+
+    def __init__(self, sock: socket.socket, buffer_size: int = DEFAULT_BUFFER_SIZE, tuner=None):
+        """
+        :param sock: Connected socket to read from.
+        :param buffer_size: Size of the reused receive buffer; file data is written to disk in blocks of this size.
+        :param tuner: ConnectionTuner of the socket; the buffer follows the chunk size it picks during a transfer.
+        """
+
+        self.sock = sock
+        self.tuner = tuner
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+
+
+    def resize(self, buffer_size: int):
+        """Replace the reused buffer; only between two blocks, never while it holds data."""
+
+        if buffer_size != len(self.buffer):
+            self.buffer = bytearray(buffer_size)
+            self.view = memoryview(self.buffer)
+
+
+    def recv_exact(self, length: int, max_length: int = MAX_EXACT_SIZE) -> bytearray:
+        """
+        Receive exactly <length> bytes, looping over short reads.
+
+        The bytes are held in memory, so <length> comes from the peer it is checked before anything is
+        allocated; bulk data goes through recv_into_file instead.
+
+        :param max_length: Largest <length> accepted.
+        :return: The received bytes. Fewer than <length> bytes are returned only if the peer disconnected.
+        :raises ValueError: If <length> is above <max_length>.
+        """
+
+        if length > max_length:
+            raise ValueError(f"Frame of {length} bytes is larger than the {max_length} bytes accepted")
+        data = bytearray(length)
+        received = 0
+        with memoryview(data) as view:
+            while received < length:
+                chunk_length = self.sock.recv_into(view[received:], length - received)
+                if not chunk_length:
+                    break
+                received += chunk_length
+        del data[received:]
+        return data
+
+
+    def recv_into_file(self, file, length: int, progress_callback=None, metrics=None) -> int:
+        """
+        Receive <length> bytes and write them to <file> in coalesced blocks of the buffer size.
+
+        :param file: Binary file object opened for writing.
+        :param progress_callback: Called as progress_callback(bytes_received, length) after every block written.
+        :param metrics: TransferMetrics credited with every block, its system calls and the time
+                        spent waiting for the socket and for the file.
+        :return: Number of bytes received. Less than <length> if the peer disconnected.
+        """
+
+        buffer_size = len(self.buffer)
+        received = 0
+        filled = 0
+        syscalls = 0
+        socket_time = 0.0
+        while received < length:
+            start = time.perf_counter()
+            chunk_length = self.sock.recv_into(self.view[filled:], min(buffer_size - filled, length - received))
+            socket_time += time.perf_counter() - start
+            syscalls += 1
+            if not chunk_length:
+                break
+            filled += chunk_length
+            received += chunk_length
+            if filled == buffer_size or received == length:
+                start = time.perf_counter()
+                file.write(self.view[:filled])
+                if metrics:
+                    metrics.add(filled, syscalls + 1, socket_time, time.perf_counter() - start)
+                    if self.tuner:
+                        self.resize(self.tuner.update(metrics))
+                        buffer_size = len(self.buffer)
+                filled = syscalls = 0
+                socket_time = 0.0
+                if progress_callback:
+                    progress_callback(received, length)
+
+        # Keep whatever arrived before the peer disconnected
+        if filled:
+            file.write(self.view[:filled])
+            if metrics:
+                metrics.add(filled, syscalls + 1, socket_time)
+        return received
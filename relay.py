@@ -0,0 +1,373 @@
+"""
+Fan-out relay: a server started with relay='drop' or relay='spill' passes every upload on to the
+clients subscribed to it while the upload arrives, so the uploader sends it only once.
+
+Subscribers open a RELAY connection and receive each upload as a 'Relay' frame: the size (0 if
+it isn't known, e.g. a pipe), the name, length prefixed chunks, an empty chunk and finally the
+status of the upload, 'completed' or 'failed'. Every subscriber has its own bounded buffer; one
+that falls RELAY_BUFFER_SIZE bytes behind is either dropped or has the rest of its data spilled
+to a temporary file, so it never holds up the upload or the other subscribers.
+
+    python relay.py 192.168.1.20 5555 --download-location Mirror
+"""
+
+import argparse
+import collections
+import json
+import pathlib
+import socket
+import sys
+import tempfile
+import threading
+
+from catalog import Catalog
+from disk_writer import DiskWriter
+from metrics import MetricsRegistry, ProgressPrinter
+from protocol import PROTOCOL_VERSION, RELAY_HELLO, FrameCodec, pack_hello, send_frame
+from recv_buffer import DEFAULT_BUFFER_SIZE, RecvBuffer
+
+
+RELAY_POLICIES = ('drop', 'spill')
+RELAY_VERSION = 7                       # First protocol version with RELAY connections and 'Relay' frames
+RELAY_BUFFER_SIZE = 16 * 1024 * 1024    # Bytes a subscriber may fall behind before it is dropped or spilled
+MAX_SPILL_SIZE = 4 * 1024 ** 3          # Bytes spilled for one subscriber before it is dropped anyway
+SPILL_DIRECTORY = '.relay'              # Sub directory of download_location holding spill files
+SPILL_READ_SIZE = 256 * 1024            # Bytes read back from a spill file per send
+
+
+class RelayOutlet():
+    """
+    Bounded buffer of the frames waiting to be sent to one subscriber.
+
+    Frames are kept in memory up to <buffer_size> bytes. Past that the subscriber is closed with
+    the 'drop' policy; with 'spill' the frames are appended to a temporary file instead, until
+    the subscriber has caught up with everything in it, which keeps them in order.
+    """
+
+    def __init__(self, conn, codec: FrameCodec, policy: str, spill_directory: pathlib.Path,
+                 buffer_size: int = RELAY_BUFFER_SIZE, on_ready=None):
+        """
+        :param conn: Socket of the subscriber, shut down when it is dropped.
+        :param on_ready: Called without arguments when frames are added, from the uploading thread.
+        """
+
+        self.conn = conn
+        self.codec = codec
+        self.policy = policy
+        self.spill_directory = spill_directory
+        self.buffer_size = buffer_size
+        self.on_ready = on_ready
+        self.frames = collections.deque()   # tuples of buffers sent together
+        self.buffered = 0
+        self.spill = None
+        self.spill_read = 0
+        self.spill_written = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+
+    def put(self, *buffers) -> bool:
+        """Queue a frame; :return: False if the subscriber is closed, e.g. just dropped for being too slow."""
+
+        length = sum(len(buffer) for buffer in buffers)
+        with self.condition:
+            if self.closed:
+                return False
+            if self.spill is None and self.buffered + length > self.buffer_size:
+                if self.policy != 'spill':
+                    print(f"Dropping relay subscriber {self._peer()}, it is {self.buffered} bytes behind")
+                    self._close()
+                    return False
+                self.spill_directory.mkdir(parents=True, exist_ok=True)
+                self.spill = tempfile.TemporaryFile(dir=self.spill_directory)
+            if self.spill is not None:
+                if self.spill_written + length > MAX_SPILL_SIZE:
+                    print(f"Dropping relay subscriber {self._peer()}, {self.spill_written} bytes are spilled")
+                    self._close()
+                    return False
+                self.spill.seek(self.spill_written)
+                for buffer in buffers:
+                    self.spill.write(buffer)
+                self.spill_written += length
+            else:
+                self.frames.append(buffers)
+                self.buffered += length
+            self.condition.notify()
+        if self.on_ready:
+            self.on_ready()
+        return True
+
+
+    def take(self):
+        """:return: Buffers to send next, an empty tuple if there are none yet, or None once closed."""
+
+        with self.condition:
+            if self.closed:
+                return None
+            if self.frames:
+                buffers = self.frames.popleft()
+                self.buffered -= sum(len(buffer) for buffer in buffers)
+                return buffers
+            if self.spill is None:
+                return ()
+            self.spill.seek(self.spill_read)
+            data = self.spill.read(SPILL_READ_SIZE)
+            self.spill_read += len(data)
+            if self.spill_read == self.spill_written:
+                # Caught up, frames go to memory again
+                self.spill.close()
+                self.spill = None
+                self.spill_read = self.spill_written = 0
+            return (data,)
+
+
+    def get(self):
+        """Blocking take() for a sending thread. :return: Buffers to send, or None once closed."""
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or self.frames or self.spill is not None)
+        return self.take()
+
+
+    def _peer(self):
+        try:
+            return self.conn.getpeername()
+        except OSError:
+            return "(disconnected)"
+
+
+    def _close(self):
+        self.closed = True
+        self.frames.clear()
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        try:
+            # Wakes up whoever is reading or sending on the subscriber's connection
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.condition.notify_all()
+
+
+    def close(self):
+        with self.condition:
+            if not self.closed:
+                self._close()
+        if self.on_ready:
+            self.on_ready()
+
+
+class RelayWriter():
+    """File-like writer that passes every block written to <file> on to the subscribers of an upload."""
+
+    def __init__(self, file, outlets: list):
+        self.file = file
+        self.outlets = outlets
+
+
+    def write(self, data) -> int:
+        # One copy, shared by the file and every subscriber
+        block = bytes(data)
+        written = self.file.write(block)
+        for outlet in self.outlets:
+            outlet.put(outlet.codec.pack_int(len(block)), block)
+        return written
+
+
+    def flush(self):
+        self.file.flush()
+
+
+class Relay():
+    """
+    Subscribers of a relaying server and the uploads being passed on to them.
+
+    Uploads are tied to their TransferMetrics: an upload is announced when its data starts to
+    be written through tee(), and ends with the status of the transfer once it finishes, so
+    subscribe on_transfer to the server's MetricsRegistry.
+    """
+
+    def __init__(self, policy: str = None, spill_directory: pathlib.Path = None, buffer_size: int = RELAY_BUFFER_SIZE):
+        """:param policy: 'drop' or 'spill' for slow subscribers (see RelayOutlet); None doesn't take subscribers."""
+
+        if policy not in (None,) + RELAY_POLICIES:
+            raise ValueError(f"Unsupported relay policy: {policy!r} (expected one of {RELAY_POLICIES})")
+        self.policy = policy
+        self.spill_directory = spill_directory
+        self.buffer_size = buffer_size
+        self.outlets = []
+        self.uploads = {}           # transfer id -> outlets the upload is passed on to
+        self.lock = threading.Lock()
+
+
+    def subscribe(self, conn, codec: FrameCodec, on_ready=None) -> RelayOutlet:
+        """Pass the uploads that start from now on to <conn>."""
+
+        outlet = RelayOutlet(conn, codec, self.policy, self.spill_directory, self.buffer_size, on_ready)
+        with self.lock:
+            self.outlets = self.outlets + [outlet]
+        return outlet
+
+
+    def unsubscribe(self, outlet: RelayOutlet):
+        outlet.close()
+        with self.lock:
+            self.outlets = [subscribed for subscribed in self.outlets if subscribed is not outlet]
+
+
+    def tee(self, file, transfer):
+        """
+        Announce the upload of <transfer> to the subscribers.
+
+        :return: Writer that passes what is written to <file> on to them, or <file> itself if there are none.
+        """
+
+        outlets = [outlet for outlet in self.outlets if not outlet.closed]
+        if not outlets:
+            return file
+        for outlet in outlets:
+            outlet.put(outlet.codec.pack_header('Relay', transfer.total_bytes), outlet.codec.pack_name(transfer.name))
+        with self.lock:
+            self.uploads[transfer.transfer_id] = outlets
+        return RelayWriter(file, outlets)
+
+
+    def on_transfer(self, transfer):
+        """MetricsRegistry subscriber that ends a relayed upload with the status of its transfer."""
+
+        if transfer.end_time is None or transfer.transfer_id not in self.uploads:
+            return
+        with self.lock:
+            outlets = self.uploads.pop(transfer.transfer_id, ())
+        for outlet in outlets:
+            outlet.put(outlet.codec.pack_int(0), outlet.codec.pack_name(transfer.status))
+
+
+def serve_outlet(outlet: RelayOutlet):
+    """Send the frames of <outlet> on its blocking socket until it is closed; the target of a thread per subscriber."""
+
+    try:
+        while (buffers := outlet.get()) is not None:
+            if buffers:
+                send_frame(outlet.conn, *buffers)
+    except OSError:
+        # The subscriber went away
+        outlet.close()
+
+
+class RelayReceiver():
+    """
+    Subscriber of a relaying server: saves every upload it passes on in download_location as it arrives.
+    Uploads that fail on the server's side are thrown away.
+    """
+
+    def __init__(self, server_ip: str, port: int = 5555, download_location: pathlib.Path = None,
+                 buffer_size: int = DEFAULT_BUFFER_SIZE, on_upload=None, data_header_size: int = 13, filename_header_size: int = 7):
+        """
+        :param on_upload: Called as on_upload(path, status) after every upload, path is None if it failed.
+        """
+
+        self.addr = (server_ip, port)
+        self.download_location = pathlib.Path(download_location) if download_location else pathlib.Path.cwd() / 'Downloads'
+        self.catalog = Catalog(self.download_location)
+        self.buffer_size = buffer_size
+        self.on_upload = on_upload
+        self.data_header_size = data_header_size
+        self.filename_header_size = filename_header_size
+        self.metrics = MetricsRegistry()
+        self.metrics.subscribe(ProgressPrinter('relayed'))
+        self.sock = None
+        self.reader = None
+        self.codec = None
+
+
+    def connect(self):
+        """Open the RELAY connection; raises ConnectionError if the server refuses it or doesn't relay."""
+
+        self.sock = socket.create_connection(self.addr)
+        self.reader = RecvBuffer(self.sock, self.buffer_size)
+        self.sock.sendall(pack_hello(PROTOCOL_VERSION, {'channel': RELAY_HELLO}))
+        # The answer to a session is framed as v1
+        v1_codec = FrameCodec(1, self.data_header_size, self.filename_header_size)
+        reply = self.reader.recv_exact(v1_codec.read_int(self.reader))
+        if not reply.startswith(b'{'):
+            raise ConnectionError(f"The server speaks protocol v{reply.decode('utf-8')}, relaying needs v{RELAY_VERSION}")
+        session = json.loads(reply)
+        if session.get('status') != 'OK':
+            raise ConnectionError(f"Relay refused by server: {session.get('status')}")
+        self.codec = FrameCodec(session['version'], self.data_header_size, self.filename_header_size)
+
+
+    def receive_upload(self) -> bool:
+        """Receive one upload. :return: False once the server closed the connection."""
+
+        data_type, size = self.codec.read_header(self.reader)
+        if data_type is None:
+            return False
+        if data_type != 'Relay':
+            raise ValueError(f"Unexpected data type on relay connection: {data_type}")
+        name = self.codec.read_name(self.reader)
+        disk_writer = DiskWriter(self.catalog.reserve_path(name), size, reserved=True)
+        try:
+            with self.metrics.start(name, 'receive', size) as transfer:
+                while chunk_length := self.codec.read_int(self.reader):
+                    if self.reader.recv_into_file(disk_writer, chunk_length, metrics=transfer) < chunk_length:
+                        raise ConnectionError("Disconnected in the middle of a frame")
+                status = self.codec.read_name(self.reader)
+                if status != 'completed':
+                    transfer.finish('failed')
+            print() # blank line
+            if status == 'completed':
+                filepath = disk_writer.finish()
+                self.catalog.add(filepath)
+                print(f"{filepath.name} relayed")
+            else:
+                filepath = None
+                print(f"{name} failed on the server's side, discarded")
+        finally:
+            if not disk_writer.closed:
+                disk_writer.abort()
+                self.catalog.release(disk_writer.filepath)
+        if self.on_upload:
+            self.on_upload(filepath, status)
+        return True
+
+
+    def run(self):
+        """Receive uploads until the server closes the connection."""
+
+        try:
+            while self.receive_upload():
+                pass
+        finally:
+            self.close()
+
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Save every upload a relaying server passes on.")
+    parser.add_argument('server_ip')
+    parser.add_argument('port', type=int)
+    parser.add_argument('-d', '--download-location', help="Directory relayed files are saved in (default: ./Downloads)")
+    args = parser.parse_args(argv)
+
+    receiver = RelayReceiver(args.server_ip, args.port, args.download_location)
+    try:
+        receiver.connect()
+        print(f"Subscribed to the relay of {args.server_ip}, port {args.port}")
+        receiver.run()
+    except (ConnectionError, OSError) as e:
+        print(e)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import pathlib
+import re
+import time
+
+
+PARTIAL_DIRECTORY = '.partial'         # Sub directory of download_location holding partial files and their sidecars
+CHECKPOINT_INTERVAL = 64 * 1024 * 1024  # Bytes written between two checkpoints
+BOUNDARY_SIZE = 64 * 1024              # Bytes before the resume offset compared by the client and server
+PARTIAL_MAX_AGE = 7 * 24 * 3600        # Seconds a partial file is kept without being written to
+
+
+def file_transfer_id(filepath: pathlib.Path) -> str:
+    """
+    Id of one version of a file, so that a client reconnecting after a crash finds its partial file again.
+    """
+
+    stat = filepath.stat()
+    identity = f"{filepath.name}\0{stat.st_size}\0{stat.st_mtime_ns}".encode("utf-8")
+    return hashlib.sha256(identity).hexdigest()[:32]
+
+
+def boundary_digest(file, offset: int) -> str:
+    """SHA-256 of the BOUNDARY_SIZE bytes that precede <offset> in an open binary file."""
+
+    start = max(0, offset - BOUNDARY_SIZE)
+    file.seek(start)
+    return hashlib.sha256(file.read(offset - start)).hexdigest()
+
+
+class ResumeStore():
+    """
+    Partial files of interrupted transfers, each with a JSON sidecar holding its checkpoint.
+
+    The sidecar offset is only advanced after the data before it has been fsynced,
+    so it never points past what is safely on disk. Partial files of transfers that
+    were abandoned are removed once they haven't been written to for <max_age> seconds.
+    """
+
+    def __init__(self, download_location: pathlib.Path, max_age: float = PARTIAL_MAX_AGE):
+        """:param max_age: Seconds a partial file is kept without being written to (None keeps it forever)."""
+
+        self.directory = download_location / PARTIAL_DIRECTORY
+        self.max_age = max_age
+
+
+    def _paths(self, transfer_id: str):
+        if not re.fullmatch(r'[0-9a-f]{32}', transfer_id):
+            raise ValueError(f"Invalid transfer id: {transfer_id!r}")
+        return self.directory / f"{transfer_id}.part", self.directory / f"{transfer_id}.json"
+
+
+    def load(self, transfer_id: str):
+        """:return: Sidecar of the transfer or None if there is no partial file for it."""
+
+        part_path, sidecar_path = self._paths(transfer_id)
+        try:
+            with open(sidecar_path, 'r', encoding='utf-8') as sidecar:
+                metadata = json.load(sidecar)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if not part_path.is_file():
+            return None
+        return metadata
+
+
+    def save(self, metadata: dict):
+        """Replace the sidecar atomically so a crash never leaves it half written."""
+
+        _, sidecar_path = self._paths(metadata['transfer_id'])
+        temp_path = sidecar_path.with_suffix('.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as sidecar:
+            json.dump(metadata, sidecar)
+            sidecar.flush()
+            os.fsync(sidecar.fileno())
+        os.replace(temp_path, sidecar_path)
+
+
+    def prune(self):
+        """Remove the partial files and sidecars of transfers that haven't been written to for max_age seconds."""
+
+        if self.max_age is None or not self.directory.is_dir():
+            return
+        last_written = {}
+        for path in self.directory.iterdir():
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            last_written[path.stem] = max(mtime, last_written.get(path.stem, 0))
+        expired = {stem for stem, mtime in last_written.items() if time.time() - mtime > self.max_age}
+        for path in self.directory.iterdir():
+            if path.stem in expired:
+                print(f"Removing abandoned partial file {path.name}")
+                path.unlink(missing_ok=True)
+
+
+    def get_resume_point(self, transfer_id: str, filename: str, file_size: int):
+        """
+        Find the checkpoint of a transfer, creating an empty partial file for a new one.
+
+        :return: (offset, boundary digest) the client has to check before sending the rest.
+        """
+
+        self.prune()
+        metadata = self.load(transfer_id)
+        if (not metadata or metadata['filename'] != filename or metadata['file_size'] != file_size
+                or metadata['offset'] > file_size):
+            self.directory.mkdir(parents=True, exist_ok=True)
+            part_path, _ = self._paths(transfer_id)
+            part_path.touch()
+            metadata = {'transfer_id': transfer_id, 'filename': filename, 'file_size': file_size, 'offset': 0}
+            self.save(metadata)
+
+        part_path, _ = self._paths(transfer_id)
+        with open(part_path, 'rb') as part:
+            return metadata['offset'], boundary_digest(part, metadata['offset'])
+
+
+    def open(self, transfer_id: str, offset: int):
+        """
+        Open the partial file for writing from <offset>, which may not be past the checkpoint.
+
+        :return: CheckpointWriter positioned at <offset>.
+        """
+
+        metadata = self.load(transfer_id)
+        if not metadata:
+            raise ValueError(f"Unknown transfer id: {transfer_id}")
+        if offset > metadata['offset']:
+            raise ValueError(f"Offset {offset} is past the checkpoint at {metadata['offset']}")
+        part_path, _ = self._paths(transfer_id)
+        return CheckpointWriter(self, metadata, part_path, offset)
+
+
+    def complete(self, transfer_id: str, filepath: pathlib.Path):
+        """Move a fully received partial file to <filepath> and forget its checkpoint."""
+
+        part_path, sidecar_path = self._paths(transfer_id)
+        os.replace(part_path, filepath)
+        sidecar_path.unlink(missing_ok=True)
+
+
+class CheckpointWriter():
+    """File-like writer of a partial file that checkpoints every CHECKPOINT_INTERVAL bytes."""
+
+    def __init__(self, store: ResumeStore, metadata: dict, part_path: pathlib.Path, offset: int):
+        self.store = store
+        self.metadata = metadata
+        self.offset = offset
+        self.unsaved_bytes = 0
+        # Move the checkpoint back before dropping the data after it
+        self.metadata['offset'] = offset
+        self.store.save(self.metadata)
+        self.file = open(part_path, 'r+b')
+        self.file.truncate(offset)
+        self.file.seek(offset)
+
+
+    def write(self, data) -> int:
+        written = self.file.write(data)
+        self.offset += written
+        self.unsaved_bytes += written
+        if self.unsaved_bytes >= CHECKPOINT_INTERVAL:
+            self.checkpoint()
+        return written
+
+
+    def checkpoint(self):
+        """Make everything written so far durable and record it in the sidecar."""
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.metadata['offset'] = self.offset
+        self.store.save(self.metadata)
+        self.unsaved_bytes = 0
+
+
+    def close(self):
+        self.checkpoint()
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
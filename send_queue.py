@@ -0,0 +1,409 @@
+"""
+Send queue of the file transfer client.
+
+Files, directories and glob patterns are queued from the command line or from stdin, one per
+line, and sent over a pool of connections to the server, smallest first:
+
+    python send_queue.py 192.168.1.20 5555 'photos/**/*.jpg' notes.txt --connections 4
+    find . -name '*.log' | python send_queue.py 192.168.1.20 5555 -
+
+A summary table is printed once every queued transfer has been acknowledged by the server.
+"""
+
+import argparse
+import collections
+import glob
+import heapq
+import itertools
+import json
+import os
+import pathlib
+import statistics
+import sys
+import threading
+import time
+import traceback
+
+from client import Client
+from metrics import format_bytes
+
+
+QUEUE_CONNECTIONS = 4                   # Connections opened to the server by default
+IN_FLIGHT_PER_CONNECTION = 2            # Transfers sent but not acknowledged yet, per connection, by default
+COMPLETION_TIMEOUT = 300                # Seconds to wait for the server to acknowledge the last transfers
+COMPLETED_EVENTS = ('File Downloaded', 'File Verified', 'Batch Downloaded')
+NAME_COLUMN_WIDTH = 40
+
+
+def expand_pattern(pattern: str) -> list:
+    """
+    :param pattern: Path of a file or directory, or a glob pattern ('**' matches directories recursively).
+    :return: Matching paths; an existing path is taken as it is even if it looks like a pattern.
+    """
+
+    pattern = os.path.expanduser(pattern.strip())
+    if os.path.exists(pattern):
+        return [pathlib.Path(pattern)]
+    return [pathlib.Path(match) for match in sorted(glob.glob(pattern, recursive=True))]
+
+
+def _path_size(path: pathlib.Path) -> int:
+    if not path.is_dir():
+        return path.stat().st_size
+    size = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.stat(os.path.join(directory, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class QueuedTransfer():
+    """A file or directory in the queue, and what became of it."""
+
+    def __init__(self, path: pathlib.Path, size: int):
+        self.path = path
+        self.size = size
+        self.result = None          # Notification of the server, 'Skipped', or why the transfer failed
+        self.succeeded = False
+        self.connection = None
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+
+
+    @property
+    def wait(self) -> float:
+        """Seconds spent in the queue before being sent."""
+
+        return (self.started_at or self.finished_at) - self.queued_at
+
+
+    @property
+    def duration(self) -> float:
+        """Seconds from the start of the transfer until the server acknowledged it."""
+
+        return self.finished_at - self.started_at if self.started_at else 0.0
+
+
+    @property
+    def latency(self) -> float:
+        return self.finished_at - self.queued_at
+
+
+class SendQueue():
+    """
+    Queue of files and directories sent over a pool of connections to one server.
+
+    Every connection runs a worker that takes the smallest queued transfer, so small files
+    aren't held up behind large ones and the average time until a file arrives stays low.
+    A worker sends its next transfer as soon as the previous one is on the wire, without
+    waiting for the server's acknowledgement; max_in_flight bounds the transfers that are
+    sent but not acknowledged across all connections. Acknowledgements arrive in order on
+    the event channel of each connection.
+
+    The threaded Server accepts a single connection per receiver, the pool then runs
+    on the connections the server accepted.
+    """
+
+    def __init__(self, server_ip: str, port: int, connections: int = QUEUE_CONNECTIONS, max_in_flight: int = None,
+                 username: str = 'queue', **client_options):
+        """
+        :param connections: Connections opened to the server.
+        :param max_in_flight: Transfers that may be sent but not yet acknowledged by the server, across all
+                              connections (defaults to IN_FLIGHT_PER_CONNECTION per connection).
+        :param username: Prefix of the usernames of the connections, which are numbered from 0.
+        :param client_options: Extra Client arguments, e.g. compression or dedup.
+        """
+
+        if connections < 1:
+            raise ValueError(f"At least one connection is needed, got {connections}")
+        max_in_flight = max_in_flight or connections * IN_FLIGHT_PER_CONNECTION
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be positive, got {max_in_flight}")
+
+        self.server_ip = server_ip
+        self.port = port
+        self.connections = connections
+        self.username = username
+        self.client_options = client_options
+        self.heap = []                  # (size, sequence number, QueuedTransfer) not sent yet
+        self.sequence = itertools.count()
+        self.transfers = []             # Every QueuedTransfer in the order it was queued
+        self.not_found = []
+        self.input_closed = False
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.condition = threading.Condition()
+        self.done = 0
+        self.active_connections = 0
+        self.start_time = None
+        self.elapsed = 0.0
+
+
+    def add(self, pattern: str) -> int:
+        """
+        Queue the files and directories matching <pattern>; can be called while the queue is running.
+
+        :return: Number of paths queued.
+        """
+
+        paths = expand_pattern(pattern)
+        if not paths:
+            print(f"No such file or directory: {pattern.strip()}")
+            self.not_found.append(pattern.strip())
+            return 0
+        queued = 0
+        for path in paths:
+            try:
+                transfer = QueuedTransfer(path, _path_size(path))
+            except OSError as e:
+                print(f"Skipping {path}: {e}")
+                continue
+            with self.condition:
+                heapq.heappush(self.heap, (transfer.size, next(self.sequence), transfer))
+                self.transfers.append(transfer)
+                self.condition.notify_all()
+            queued += 1
+        return queued
+
+
+    def close_input(self):
+        """No more paths will be added; run() returns once the queued ones are done."""
+
+        with self.condition:
+            self.input_closed = True
+            self.condition.notify_all()
+
+
+    def _next_transfer(self):
+        """Block until a transfer is queued; return the smallest one, or None once the input is closed and drained."""
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.heap or self.input_closed)
+            if not self.heap:
+                return None
+            return heapq.heappop(self.heap)[2]
+
+
+    def _finish(self, transfer: QueuedTransfer, result: str, succeeded: bool = False):
+        transfer.result = result
+        transfer.succeeded = succeeded
+        transfer.finished_at = time.monotonic()
+        with self.condition:
+            self.done += 1
+            done, total = self.done, len(self.transfers)
+        print(f"[{done}/{total}] {transfer.path} ({format_bytes(transfer.size)}): {result}")
+
+
+    def _connect(self, index: int, on_event):
+        """:return: Connected Client, or None if the server didn't accept the connection."""
+
+        try:
+            client = Client(server_ip=self.server_ip, port=self.port, username=f"{self.username}{index}",
+                            event_callback=on_event, progress=False, **self.client_options)
+        except Exception as e:
+            print(f"Connection {index} failed: {e}")
+            return None
+        if client.client_closed:
+            client.close()
+            return None
+        try:
+            client.open_event_channel()
+        except Exception as e:
+            print(f"Connection {index} failed to open its event channel: {e}")
+            client.close()
+            return None
+        return client
+
+
+    def _worker(self, index: int, connected: threading.Barrier):
+        pending = collections.deque()       # Transfers sent on this connection, waiting for their acknowledgement
+        lock = threading.Lock()
+
+        def on_event(message: str):
+            with lock:
+                transfer = pending.popleft() if pending else None
+            if transfer is None:
+                print(f"Connection {index}: {message}")
+                return
+            self._finish(transfer, message, message.startswith(COMPLETED_EVENTS))
+            self.in_flight.release()
+
+        def fail_pending(reason: str):
+            with lock:
+                failed = list(pending)
+                pending.clear()
+            for transfer in failed:
+                self._finish(transfer, reason)
+                self.in_flight.release()
+
+        client = self._connect(index, on_event)
+        if client:
+            with self.condition:
+                self.active_connections += 1
+        connected.wait()
+        if client is None:
+            return
+
+        def listen():
+            client.listen_events()
+            fail_pending('Connection lost')
+
+        listener = threading.Thread(target=listen, daemon=True)
+        listener.start()
+        try:
+            while not client.client_closed:
+                # The slot is taken first, so the transfer picked is the smallest one queued when it frees up
+                self.in_flight.acquire()
+                transfer = self._next_transfer()
+                if transfer is None:
+                    self.in_flight.release()
+                    break
+                if client.client_closed:
+                    # Back to the queue for the connections that are still up
+                    with self.condition:
+                        heapq.heappush(self.heap, (transfer.size, next(self.sequence), transfer))
+                    self.in_flight.release()
+                    break
+                transfer.connection = index
+                transfer.started_at = time.monotonic()
+                # Queued as pending before it is sent, the acknowledgement can come right after the last byte
+                with lock:
+                    pending.append(transfer)
+                result = client.send_data(str(transfer.path), 'File')
+                if result == "Data Sent":
+                    continue
+                with lock:
+                    unacknowledged = pending and pending[-1] is transfer and pending.pop()
+                if unacknowledged:
+                    if result == "Skipped":
+                        # The server already has it and sends no acknowledgement
+                        self._finish(transfer, 'Skipped', succeeded=True)
+                    else:
+                        self._finish(transfer, 'Send failed')
+                    self.in_flight.release()
+                if result != "Skipped":
+                    # The stream may be cut in the middle of a frame, the connection can't be trusted anymore
+                    break
+
+            deadline = time.monotonic() + COMPLETION_TIMEOUT
+            while pending and listener.is_alive() and time.monotonic() < deadline:
+                listener.join(timeout=0.05)
+        except Exception:
+            print("Send Queue Error:", traceback.format_exc())
+        finally:
+            client.close()
+            listener.join(timeout=1)
+            fail_pending('No acknowledgement from server')
+
+
+    def run(self) -> list:
+        """
+        Send everything queued, and what is added until close_input() is called, then print the summary.
+
+        :return: Every QueuedTransfer in the order it was queued.
+        """
+
+        self.start_time = time.monotonic()
+        connected = threading.Barrier(self.connections + 1)
+        workers = [threading.Thread(target=self._worker, args=(index, connected), daemon=True)
+                   for index in range(self.connections)]
+        for worker in workers:
+            worker.start()
+        connected.wait()
+        if not self.active_connections:
+            self.close_input()
+            raise ConnectionError(f"Could not connect to {self.server_ip}:{self.port}")
+        print(f"Sending over {self.active_connections} of {self.connections} connections")
+
+        for worker in workers:
+            worker.join()
+        # Left over when every connection was lost
+        with self.condition:
+            self.input_closed = True
+            left_over = [transfer for _, _, transfer in self.heap]
+            self.heap.clear()
+        for transfer in left_over:
+            self._finish(transfer, 'Not sent')
+        self.elapsed = time.monotonic() - self.start_time
+        self.print_summary()
+        return self.transfers
+
+
+    def print_summary(self):
+        """Print a line per transfer with its size, result, connection, time queued and transfer time and rate."""
+
+        name_width = min(NAME_COLUMN_WIDTH, max([len(str(transfer.path)) for transfer in self.transfers] + [4]))
+        print()
+        print(f"{'File':<{name_width}}  {'Size':>10}  {'Result':<28}  {'Conn':>4}  {'Queued':>8}  {'Time':>8}  {'Rate':>12}")
+        for transfer in self.transfers:
+            name = str(transfer.path)
+            if len(name) > name_width:
+                name = '...' + name[-(name_width - 3):]
+            connection = '-' if transfer.connection is None else str(transfer.connection)
+            rate = f"{format_bytes(transfer.size / transfer.duration)}/s" if transfer.result.startswith(COMPLETED_EVENTS) and transfer.duration else '-'
+            print(f"{name:<{name_width}}  {format_bytes(transfer.size):>10}  {transfer.result:<28.28}  {connection:>4}  "
+                  f"{transfer.wait:>7.2f}s  {transfer.duration:>7.2f}s  {rate:>12}")
+
+        succeeded = [transfer for transfer in self.transfers if transfer.succeeded]
+        sent_bytes = sum(transfer.size for transfer in succeeded)
+        print()
+        print(f"{len(succeeded)} of {len(self.transfers)} transfers succeeded, {format_bytes(sent_bytes)} in {self.elapsed:.2f}s "
+              f"({format_bytes(sent_bytes / self.elapsed if self.elapsed else 0)}/s)")
+        if self.transfers:
+            print(f"Mean latency {statistics.mean(transfer.latency for transfer in self.transfers):.2f}s, "
+                  f"max {max(transfer.latency for transfer in self.transfers):.2f}s")
+        if self.not_found:
+            print(f"Not found: {', '.join(self.not_found)}")
+
+
+def _read_stdin(send_queue: SendQueue):
+    try:
+        for line in sys.stdin:
+            if line.strip():
+                send_queue.add(line)
+    finally:
+        send_queue.close_input()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send files, directories and glob patterns to a receiver, smallest first.")
+    parser.add_argument('server_ip')
+    parser.add_argument('port', type=int)
+    parser.add_argument('paths', nargs='*',
+                        help="Files, directories or glob patterns; '-' or none reads them from stdin, one per line")
+    parser.add_argument('-c', '--connections', type=int, default=QUEUE_CONNECTIONS,
+                        help="Connections opened to the server (default: %(default)s)")
+    parser.add_argument('--max-in-flight', type=int,
+                        help=f"Transfers sent but not yet acknowledged (default: {IN_FLIGHT_PER_CONNECTION} per connection)")
+    parser.add_argument('-u', '--username', default='queue',
+                        help="Prefix of the usernames of the connections (default: %(default)s)")
+    parser.add_argument('--client-options', default='{}',
+                        help='JSON object of extra Client arguments, e.g. \'{"compression": "zlib", "dedup": true}\'')
+    args = parser.parse_args(argv)
+
+    send_queue = SendQueue(args.server_ip, args.port, connections=args.connections, max_in_flight=args.max_in_flight,
+                           username=args.username, **json.loads(args.client_options))
+    patterns = [path for path in args.paths if path != '-']
+    for pattern in patterns:
+        send_queue.add(pattern)
+    if '-' in args.paths or not args.paths:
+        threading.Thread(target=_read_stdin, args=(send_queue,), daemon=True).start()
+    else:
+        send_queue.close_input()
+
+    try:
+        transfers = send_queue.run()
+    except ConnectionError as e:
+        print(e)
+        return 1
+    except KeyboardInterrupt:
+        print("Closing Client Application")
+        return 1
+    return 0 if all(transfer.succeeded for transfer in transfers) and not send_queue.not_found else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
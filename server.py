@@ -1,35 +1,140 @@
+import base64
+import concurrent.futures
+import functools
 import ipaddress
+import json
+import os
 import pathlib
-import psutil
+import secrets
 import socket
 import threading
+import time
 import traceback
 
+from catalog import CATALOG_ALGORITHM, Catalog
+from compression import CODECS, ChunkDecompressor, check_chunk_header
+from delta import COPY, END, LITERAL, MAX_LITERAL_SIZE, DeltaWriter, delta_block_size, file_signature
+from disk_writer import DiskWriter, check_fsync_policy
+from integrity import DIGEST_ALGORITHMS, HashingWriter, StreamHasher
+from metrics import MetricsRegistry, ProgressPrinter, TransferMetrics
+from parallel_transfer import STREAM_ATTACH_TIMEOUT, TRANSFER_ID_SIZE, ParallelTransfer, RangeWriter
+from protocol import EVENTS_HELLO, HELLO_MAGIC, MAX_CONTROL_SIZE, PROTOCOL_VERSION, RELAY_HELLO, SESSION_HELLO_VERSION, STREAM_HELLO, FrameCodec, hello_size, send_frame, unpack_hello
+from ratelimit import BandwidthScheduler
+from recv_buffer import DEFAULT_BUFFER_SIZE, MAX_EXACT_SIZE, RecvBuffer
+from relay import RELAY_VERSION, SPILL_DIRECTORY, Relay, serve_outlet
+from resume import PARTIAL_MAX_AGE, ResumeStore
+from tuning import ConnectionTuner
+from udp_transfer import UdpReceiver
 
-# Data Type can be of max 10 Characters
-# Currently supports (Text/File) -> to implemet POLL
-DATA_TYPE_SIZE = 10        
+
+BATCH_WRITER_THREADS = 8    # Threads writing the files of a batch, so file creation doesn't stall the socket
+BATCH_PENDING_WRITES = 64   # Files of a batch held in memory while waiting for a writer thread
+ROUTE_PROBE_ADDRESS = ('10.255.255.255', 1)     # Any private address; only used to look up the outgoing interface
+
+
+def _is_private(address: str) -> bool:
+    ip = ipaddress.ip_address(address)
+    return ip.is_private and not ip.is_loopback and not ip.is_link_local
+
+
+@functools.lru_cache(maxsize=None)
+def private_ip_address():
+    """
+    IPv4 address of this host on its private network, looked up once per process.
+
+    The address of the interface the routing table picks comes from connecting a UDP socket,
+    which sends nothing; every interface is only walked, with psutil, when that address isn't private.
+    """
+
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(ROUTE_PROBE_ADDRESS)
+        address = probe.getsockname()[0]
+        if _is_private(address):
+            return address
+    except OSError:
+        # No route, e.g. no network at all
+        pass
+    finally:
+        probe.close()
+
+    # psutil takes longer to import than everything else a sender or receiver needs at startup
+    import psutil
+    for addrs in psutil.net_if_addrs().values():
+        for addr in addrs:
+            # Check for IPv4 addresses that are not loopback
+            if addr.family == socket.AF_INET and _is_private(addr.address):
+                return addr.address
+    return None
 
 
 class Server():
 
-    def __init__(self, server_ip: str = None, port: int = 5555, max_connections: int = 1, data_header_size: int = 13, filename_header_size: int = 7):
+    def __init__(self, server_ip: str = None, port: int = 5555, max_connections: int = 1, data_header_size: int = 13, filename_header_size: int = 7, buffer_size: int = DEFAULT_BUFFER_SIZE, download_location: pathlib.Path = None, rate_limit: float = None, transfer_rate_limit: float = None, fsync_policy='none', autotune: bool = True, listen_socket: socket.socket = None, reuse_port: bool = False, shared_catalog: bool = False, pipe_output=None, relay: str = None, resume_max_age: float = PARTIAL_MAX_AGE):
         """
         Create socket object; bind server to host ip address and port; start listening for incoming connections
         
         :param server: The IP address of the server/host.
         :param port: The port number.
+        :param buffer_size: Size of the per-connection receive buffer and of the blocks written to disk.
+        :param download_location: Directory received files are saved in (defaults to Downloads in the working directory).
+        :param rate_limit: Bytes per second received by all transfers together, shared fairly between them (None for unlimited).
+        :param transfer_rate_limit: Bytes per second received by any single transfer (None for unlimited).
+        :param fsync_policy: When received files are made durable: 'none', 'end' (before they get their final name)
+                             or N to also fsync every N MB.
+        :param autotune: Size receive blocks and socket buffers to the measured bandwidth-delay product of
+                         every connection (see tuning). TCP_NODELAY is set either way.
+        :param listen_socket: Listening socket to accept on, e.g. one inherited from workers.Supervisor, instead of binding one.
+        :param reuse_port: Bind with SO_REUSEPORT, so other processes listening on the same port share its connections.
+        :param shared_catalog: Other processes receive into download_location at the same time (see Catalog).
+        :param pipe_output: Binary file object 'Pipe' streams are written to, one after another, e.g. sys.stdout.buffer.
+                            By default every stream is saved in download_location under the name it was sent with.
+        :param relay: Pass every File, Verified and Pipe upload on to the clients subscribed over RELAY connections
+                      while it arrives; 'drop' or 'spill' says what happens to a subscriber that falls behind (see relay).
+        :param resume_max_age: Seconds the partial file of an interrupted resumable transfer is kept without being
+                               written to (None keeps it forever).
         """
 
+        check_fsync_policy(fsync_policy)
         try:
             self.client_dict = {}
+            self.parallel_transfers = {}
+            self.transfers_condition = threading.Condition()
+            self.event_tokens = {}      # event channel token -> main connection of the client
+            self.event_channels = {}    # main connection -> event channel connection
+            self.notify_lock = threading.Lock()
             self.data_header_size = data_header_size
             self.filename_header_size = filename_header_size
-            self.download_location = pathlib.Path.cwd() / 'Downloads'
+            self.default_codec = FrameCodec(1, data_header_size, filename_header_size)
+            self.codecs = {}            # connection -> FrameCodec of the protocol version negotiated on it
+            self.buffer_size = buffer_size
+            self.autotune = autotune
+            self.tuners = {}            # connection -> ConnectionTuner adjusting it to its bandwidth-delay product
+            self.download_location = pathlib.Path(download_location) if download_location else pathlib.Path.cwd() / 'Downloads'
+            self.resume_store = ResumeStore(self.download_location, resume_max_age)
+            self.catalog = Catalog(self.download_location, shared=shared_catalog)
+            self.fsync_policy = fsync_policy
+            self.pipe_output = pipe_output
+            self.pipe_lock = threading.Lock()
+            self.bandwidth = BandwidthScheduler(rate_limit, transfer_rate_limit)
+            self.metrics = MetricsRegistry(self.bandwidth)
+            self.metrics.subscribe(ProgressPrinter('downloaded'))
+            self.relay = Relay(relay, self.download_location / SPILL_DIRECTORY)
+            self.metrics.subscribe(self.relay.on_transfer)
             self.print_received_text = True
+            self.router = None          # workers.ChannelRouter when this is one of several worker processes
+            self.port = port
+            if listen_socket:
+                # Already bound and listening
+                self.server = listen_socket
+                self.server_ip, self.port = listen_socket.getsockname()[:2]
+                print(f"Server accepting on {self.server_ip}, port {self.port}")
+                return
             self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) #Avoid TIME-WAIT Period after closing connction
-            self.port = port
+            if reuse_port:
+                # Every process bound to the port gets its own accept queue, the kernel spreads connections over them
+                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.server_ip = self._get_private_ip_address() if not server_ip else server_ip
             if self.server_ip:
                 self.server.bind((self.server_ip, self.port))
@@ -46,13 +151,7 @@ class Server():
 
     def _get_private_ip_address(self):
         try:
-            for addrs in psutil.net_if_addrs().values():
-                for addr in addrs:
-                    # Check for IPv4 addresses that are not loopback
-                    if addr.family == socket.AF_INET:
-                        ip = ipaddress.ip_address(addr.address)
-                        if ip.is_private and not ip.is_loopback and not ip.is_link_local:
-                            return addr.address
+            return private_ip_address()
         except Exception as e:
             print("Private IP address fetching Error: ", traceback.format_exc())
             return None
@@ -77,32 +176,213 @@ class Server():
                 encoded_data = data
             data_length = len(encoded_data)
 
-            header = f"{data_length:<{(self.data_header_size)}}".encode("utf-8")
-            conn.sendall(header)
-
-            # Send the actual data
-            conn.sendall(encoded_data)
+            # Send header and data together
+            send_frame(conn, self._codec(conn).pack_int(data_length), encoded_data)
         except socket.error as e:
             print("Server Data Sending Socket Error: ", traceback.format_exc())
         except Exception as e:
             print("Server Data Sending General Error: ",  traceback.format_exc())
 
 
-    def receive_data(self, conn):
+    def _codec(self, conn) -> FrameCodec:
+        return self.codecs.get(conn, self.default_codec)
+
+
+    def _negotiate_protocol(self, conn, hello: bytes):
+        """
+        Answer a client's protocol hello with the highest version both sides support.
+        The answer itself is a v1 reply; everything after it uses the agreed version.
+
+        :return: Session carried by a v5 hello, or None. A session is answered by _answer_session
+                 once it has been handled, instead of with the version alone.
+        """
+
+        requested_version, session = unpack_hello(hello)
+        version = max(1, min(requested_version, PROTOCOL_VERSION))
+        if version < SESSION_HELLO_VERSION:
+            session = None
+        if session is None:
+            self.send_data(sender_conn=conn, receiver=None, data=str(version))
+        self.codecs[conn] = FrameCodec(version, self.data_header_size, self.filename_header_size)
+        return session
+
+
+    def _read_hello(self, conn, hello: bytes) -> bytes:
+        """Complete a protocol hello that didn't arrive in a single recv."""
+
+        while len(hello) < hello_size(hello):
+            data = conn.recv(hello_size(hello) - len(hello))
+            if not data:
+                raise ConnectionError("Disconnected in the middle of the protocol hello")
+            hello += data
+        return hello
+
+
+    def _session_reply(self, conn, session: dict, username: str = None, error: str = None) -> dict:
+        """
+        Reply to a v5 session: the agreed version, the accepted username or why it was refused, an event
+        channel token if the client asked for one, and what the server supports.
+        """
+
+        reply = {'version': self._codec(conn).version,
+                 'capabilities': {'compression': sorted(CODECS), 'digests': list(DIGEST_ALGORITHMS)}}
+        if username:
+            reply['username'] = username
+            if session.get('events'):
+                # Saves the client the 'Events' request (see handle_events)
+                reply['events'] = self._new_event_token(conn)
+        if error:
+            reply['error'] = error
+        if self.router:
+            # Echoed by the client's streams, so any worker can pass them to this one
+            reply['route'] = self.router.index
+        return reply
+
+
+    def _new_event_token(self, conn) -> str:
+        """One time token that attaches an event channel to main connection <conn> (see handle_events)."""
+
+        token = secrets.token_hex(16)
+        if self.router:
+            token = self.router.route_token(token)
+        self.event_tokens[token] = conn
+        return token
+
+
+    def _answer_session(self, conn, reply: dict):
+        """Send a session reply, framed as v1 like the version answer of older servers."""
+
+        encoded_reply = json.dumps(reply).encode("utf-8")
+        send_frame(conn, self.default_codec.pack_int(len(encoded_reply)), encoded_reply)
+
+
+    def _answer_channel(self, conn, session: dict, status: str):
+        """Accept ('OK') or refuse a STREAM or EVENTS connection, in a session reply for v5 clients or plainly as before."""
+
+        if session is None:
+            self.send_data(sender_conn=conn, receiver=None, data=status)
+        else:
+            self._answer_session(conn, {**self._session_reply(conn, session), 'status': status})
+
+
+    def _answer_username(self, conn, session: dict, username: str = None, error: str = None):
+        """Accept <username> or refuse it with <error>, in a session reply for v5 clients or plainly as before."""
+
+        if session is None:
+            self.send_data(sender_conn=conn, receiver=None, data=username or error)
+        else:
+            self._answer_session(conn, self._session_reply(conn, session, username, error))
+
+
+    def notify(self, conn, data):
+        """
+        Push a completion or error notification to the client of main connection <conn>.
+
+        It goes over the client's event channel when it opened one; clients that poll
+        read it from the main connection instead.
+        """
+
+        with self.notify_lock:
+            self.send_data(sender_conn=self.event_channels.get(conn, conn), receiver=None, data=data)
+
+
+    def handle_events(self, conn, addr, token: str, session: dict = None):
+        """
+        Register <conn> as the event channel of the client that was given <token>
+        and keep it until either side closes it.
+
+        :param session: Session of a v5 hello, which is answered instead of a plain status.
+        """
+
+        main_conn = self.event_tokens.pop(token, None)
+        if not main_conn:
+            self._answer_channel(conn, session, 'Unknown Token')
+            self.codecs.pop(conn, None)
+            self.tuners.pop(conn, None)
+            conn.close()
+            return
+        self._answer_channel(conn, session, 'OK')
+        self.event_channels[main_conn] = conn
         try:
-            # Receive Data Size
-            data_size = conn.recv(self.data_header_size)
+            # Nothing is expected from the client, this only returns once the channel is closed
+            while conn.recv(2048):
+                pass
+        except OSError:
+            pass
+        finally:
+            if self.event_channels.get(main_conn) is conn:
+                self.event_channels.pop(main_conn)
+            self.codecs.pop(conn, None)
+            self.tuners.pop(conn, None)
+            conn.close()
+
+
+    def handle_relay(self, conn, addr, session: dict = None):
+        """
+        Pass every upload that starts from now on to the subscriber on <conn> until either side closes it.
+        A thread sends the subscriber's frames, so it never holds up the connection of the uploader.
+        """
+
+        status = 'OK'
+        if not self.relay.policy:
+            status = 'Relay Disabled'
+        elif self._codec(conn).version < RELAY_VERSION:
+            status = 'Relay Needs Protocol v7'
+        self._answer_channel(conn, session, status)
+        if status != 'OK':
+            self.codecs.pop(conn, None)
+            self.tuners.pop(conn, None)
+            conn.close()
+            return
+        print(f"Relay subscriber connected: {addr}")
+        outlet = self.relay.subscribe(conn, self._codec(conn))
+        sender = threading.Thread(target=serve_outlet, args=(outlet,), daemon=True)
+        sender.start()
+        try:
+            # Nothing is expected from the subscriber, this only returns once the connection is closed
+            while conn.recv(2048):
+                pass
+        except OSError:
+            pass
+        finally:
+            self.relay.unsubscribe(outlet)
+            sender.join()
+            self.codecs.pop(conn, None)
+            self.tuners.pop(conn, None)
+            conn.close()
+            print(f"Relay subscriber disconnected: {addr}")
+
+
+    def _close_event_channel(self, conn):
+        """Close the event channel of main connection <conn>, which tells the client the session is over."""
+
+        event_conn = self.event_channels.pop(conn, None)
+        if event_conn:
+            try:
+                event_conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+    def receive_data(self, conn, reader: RecvBuffer = None):
+        """
+        Receive one frame from the client.
+
+        :param reader: Receive engine of the connection. Pass the same one for every frame to reuse its buffer.
+        """
+
+        if reader is None:
+            reader = RecvBuffer(conn, self.buffer_size, self.tuners.get(conn))
+        codec = self._codec(conn)
+
+        try:
+            # Receive Data Type and Data Size
+            data_type, data_length = codec.read_header(reader)
             # If empty data is sent assume client socket is closed
-            if not data_size:
+            if data_type is None:
                 print("Client Disconected")
                 return
-            
-            data_length = int(data_size.decode().strip())
             print(f"Expecting {data_length} bytes of data.")
-
-            # Receive Data Type
-            data_type = conn.recv(DATA_TYPE_SIZE)
-            data_type = data_type.decode().strip()
             
         except ConnectionResetError:
             # return empty data if connection is closed by client
@@ -113,146 +393,822 @@ class Server():
 
         if data_type == "File":
             try:
-                # Receive Filename length
-                filename_size = conn.recv(self.filename_header_size)
-                filename_length = int(filename_size.decode("utf-8").strip())
-                
-                # Receive filename
-                filename = b""
                 exception_occured = False
-                pending_filename_bytes = filename_length
-                while len(filename) < filename_length:
-                    if pending_filename_bytes < 2048:
-                        chunk = conn.recv(pending_filename_bytes)
-                    else:
-                        chunk = conn.recv(2048)
-                        pending_filename_bytes -= 2048
-
-                    if not chunk:
-                        print("Client Disconnected")
-                        break
-                    else:
-                        filename += chunk
-
-                filename = filename.decode("utf-8")
-                
-                # create Downloads Folder if it doesn't exist
-                if not self.download_location.is_dir():
-                    self.download_location.mkdir()
-                # handle duplicate filenames
-                filepath = self.download_location / filename
-                copy_count = 0
-                while filepath.is_file():
-                    copy_count += 1
-                    filename = f"{filepath.stem}(c{copy_count})"
-                    filepath = self.download_location / f"{filename}{filepath.suffix}"
+                filename = codec.read_name(reader)
+                disk_writer = self._open_disk_writer(filename, data_length)
 
                 # Download the file
-                with open(file=filepath, mode='ab+') as file:
-                    current_data_length = 0
-                    while current_data_length < data_length:
-                        chunk = conn.recv(2048)
-
-                        if not chunk:
-                            print("Client Disconnected")
-                            break
-                        else:
-                            file.write(chunk)
-                            current_data_length += len(chunk)
-                            downloaded_percent = current_data_length / data_length * 100
-                            print("\r", end="")
-                            print(f"{downloaded_percent:.0f}% file downloaded", end="")
+                try:
+                    with self.metrics.start(filename, 'receive', data_length) as transfer:
+                        current_data_length = reader.recv_into_file(self.relay.tee(disk_writer, transfer), data_length, metrics=transfer)
+                    if current_data_length == data_length:
+                        self._finish_disk_writer(disk_writer)
+                finally:
+                    self._abort_disk_writer(disk_writer)
                 print() # Go to next line after 100% file downloaded is displayed
+                if current_data_length < data_length:
+                    # Never report a partial file as downloaded
+                    print("Client Disconnected")
+                    return
 
             except Exception:
                 print("File Download Error:", traceback.format_exc())
-                self.send_data(sender_conn=conn, receiver=None, data='Error Receiving Text')
+                self.notify(conn, 'Error Receiving Text')
                 exception_occured = True
                 
             if not exception_occured:
-                self.send_data(sender_conn=conn, receiver=None, data='File Downloaded')
+                self.notify(conn, 'File Downloaded')
                 return b'File Saved'
  
+        elif data_type == "Verified":
+            # Same as File plus a 'Digest' trailer frame with the sender's digest of the file
+            hasher = None
+            try:
+                filename = codec.read_name(reader)
+                algorithm = codec.read_name(reader)
+                hasher = StreamHasher(algorithm)
+                disk_writer = self._open_disk_writer(filename, data_length)
+                filepath = disk_writer.filepath
+                try:
+                    with self.metrics.start(filename, 'receive', data_length) as transfer:
+                        current_data_length = reader.recv_into_file(self.relay.tee(HashingWriter(disk_writer, hasher), transfer), data_length,
+                                                                    metrics=transfer)
+                        digest = hasher.hexdigest()
+                        if current_data_length < data_length:
+                            print("\nClient Disconnected")
+                            return
+                        trailer_type, trailer_length = codec.read_header(reader)
+                        if trailer_type != 'Digest':
+                            raise ValueError(f"Expected a 'Digest' trailer, got {trailer_type}")
+                        expected_digest = reader.recv_exact(trailer_length).decode("utf-8")
+                        # A file that doesn't match never appears under its final name
+                        if digest == expected_digest:
+                            self._finish_disk_writer(disk_writer, digest if algorithm == CATALOG_ALGORITHM else None)
+                        else:
+                            transfer.finish('failed')
+                finally:
+                    self._abort_disk_writer(disk_writer)
+                print() # Go to next line after 100% file downloaded is displayed
+            except Exception:
+                print("Verified File Download Error:", traceback.format_exc())
+                if hasher:
+                    # Stops the hashing thread
+                    hasher.hexdigest()
+                self.notify(conn, 'Error Receiving File')
+            else:
+                if not self._verify_digest(filepath, digest, expected_digest):
+                    self.notify(conn, 'File Verification Failed')
+                    return b'File Discarded'
+                self.notify(conn, 'File Verified')
+                return b'File Saved'
+
+        elif data_type == "Compressed":
+            # File name and compression method followed by independently compressed chunks
+            try:
+                filename = codec.read_name(reader)
+                method = codec.read_name(reader)
+                disk_writer = self._open_disk_writer(filename, data_length)
+                try:
+                    with self.metrics.start(filename, 'receive', data_length) as transfer:
+                        stats = self._receive_compressed_chunks(reader, codec, ChunkDecompressor(disk_writer, method), data_length, transfer)
+                    self._finish_disk_writer(disk_writer)
+                finally:
+                    self._abort_disk_writer(disk_writer)
+                print() # Go to next line after 100% file downloaded is displayed
+                print(f"Compression {stats}")
+            except Exception:
+                print("Compressed File Download Error:", traceback.format_exc())
+                self.notify(conn, 'Error Receiving File')
+            else:
+                self.notify(conn, 'File Downloaded')
+                return b'File Saved'
+
+        elif data_type == "Parallel":
+            # File body arrives as byte ranges on separate stream connections (see handle_stream)
+            try:
+                filename = codec.read_name(reader)
+                transfer_id = reader.recv_exact(TRANSFER_ID_SIZE).decode("utf-8")
+                filepath = self._get_unique_filepath(filename)
+                transfer = ParallelTransfer(transfer_id, filepath, data_length, conn, self.metrics.start(filename, 'receive', data_length))
+                with self.transfers_condition:
+                    self.parallel_transfers[transfer_id] = transfer
+                    self.transfers_condition.notify_all()
+                print(f"Receiving {filename} over parallel streams")
+                if transfer.is_complete():
+                    self._finish_parallel_transfer(transfer)
+                else:
+                    self._watch_parallel_transfer(transfer)
+                return b'Parallel Transfer Started'
+            except Exception:
+                print("Parallel Transfer Setup Error:", traceback.format_exc())
+                self.notify(conn, 'Error Receiving File')
+
+        elif data_type == "Batch":
+            # A directory tree sent back to back; <data_length> is the number of files
+            try:
+                print(f"Receiving a batch of {data_length} files")
+                with self.metrics.start(f"batch of {data_length} files", 'receive', 0) as transfer:
+                    file_count = self._receive_batch(reader, codec, transfer)
+                print()
+                print(f"{file_count} files downloaded")
+            except Exception:
+                print("Batch Download Error:", traceback.format_exc())
+                self.notify(conn, 'Error Receiving Batch')
+            else:
+                self.notify(conn, f'Batch Downloaded: {file_count} files')
+                return b'Batch Saved'
+
+        elif data_type == "Events":
+            # Hand out a one time token for opening an event channel (see handle_events)
+            try:
+                reader.recv_exact(data_length, MAX_CONTROL_SIZE)
+                token = self._new_event_token(conn)
+                self.send_data(sender_conn=conn, receiver=None, data=json.dumps({'reply': 'Events', 'token': token}))
+                return b'Event Channel Requested'
+            except Exception:
+                print("Event Channel Request Error:", traceback.format_exc())
+                self.send_data(sender_conn=conn, receiver=None, data=json.dumps({'reply': 'Events', 'error': 'Invalid Events Request'}))
+
+        elif data_type == "Resume":
+            # Reply with the checkpoint of a resumable transfer, creating one for a new transfer
+            try:
+                request = json.loads(reader.recv_exact(data_length, MAX_CONTROL_SIZE).decode("utf-8"))
+                offset, digest = self.resume_store.get_resume_point(request['transfer_id'], request['filename'], request['file_size'])
+                if offset:
+                    print(f"Resuming {request['filename']} from byte {offset}")
+                self.send_data(sender_conn=conn, receiver=None, data=json.dumps({'reply': 'Resume', 'offset': offset, 'boundary_digest': digest}))
+                return b'Resume Offset Sent'
+            except Exception:
+                print("Resume Request Error:", traceback.format_exc())
+                self.send_data(sender_conn=conn, receiver=None, data=json.dumps({'reply': 'Resume', 'error': 'Invalid Resume Request'}))
+
+        elif data_type == "ResumeData":
+            # <TRANSFER_ID_SIZE>-byte transfer id and offset followed by the rest of the file
+            try:
+                transfer_id = reader.recv_exact(TRANSFER_ID_SIZE).decode("utf-8")
+                offset = codec.read_int(reader)
+                with self.resume_store.open(transfer_id, offset) as partial_file:
+                    with self.metrics.start(partial_file.metadata['filename'], 'receive', data_length) as transfer:
+                        current_data_length = reader.recv_into_file(partial_file, data_length, metrics=transfer)
+                print() # Go to next line after 100% file downloaded is displayed
+                if current_data_length < data_length:
+                    # Keep the partial file and its checkpoint for the next attempt
+                    print("Client Disconnected")
+                    return
+
+                metadata = self.resume_store.load(transfer_id)
+                if partial_file.offset != metadata['file_size']:
+                    # Keep the checkpoint, the client can resume from it with the right length
+                    raise ValueError(f"{metadata['filename']} ends at byte {partial_file.offset}, expected {metadata['file_size']}")
+                filepath = self._get_unique_filepath(metadata['filename'])
+                self.resume_store.complete(transfer_id, filepath)
+                self.catalog.add(filepath)
+            except Exception:
+                print("Resumable File Download Error:", traceback.format_exc())
+                self.notify(conn, 'Error Receiving File')
+            else:
+                self.notify(conn, 'File Downloaded')
+                return b'File Saved'
+
+        elif data_type == "Delta":
+            # Reply with the signature of the existing file the client wants to send a new version of
+            try:
+                request = json.loads(reader.recv_exact(data_length, MAX_CONTROL_SIZE).decode("utf-8"))
+                self.send_data(sender_conn=conn, receiver=None, data=json.dumps(self._delta_signature_reply(request)))
+                return b'Delta Signature Sent'
+            except Exception:
+                print("Delta Request Error:", traceback.format_exc())
+                self.send_data(sender_conn=conn, receiver=None, data=json.dumps({'reply': 'Delta', 'error': 'Invalid Delta Request'}))
+
+        elif data_type == "DeltaData":
+            # Instructions to rebuild the new version from blocks of the existing file (see delta.py)
+            delta_writer = None
+            try:
+                metadata = json.loads(codec.read_name(reader))
+                delta_writer = self._open_delta(metadata)
+                with self.metrics.start(metadata['filename'], 'receive', data_length) as transfer:
+                    while True:
+                        start = time.perf_counter()
+                        instruction = reader.recv_exact(1)
+                        if instruction == COPY:
+                            first_block, block_count = codec.read_int(reader), codec.read_int(reader)
+                            socket_time = time.perf_counter() - start
+                            written = delta_writer.written
+                            delta_writer.copy(first_block, block_count)
+                        elif instruction == LITERAL:
+                            literal_length = codec.read_int(reader)
+                            if literal_length > MAX_LITERAL_SIZE:
+                                raise ValueError(f"Literal of {literal_length} bytes is larger than {MAX_LITERAL_SIZE}")
+                            literal = reader.recv_exact(literal_length)
+                            if len(literal) < literal_length:
+                                raise ConnectionError("Client Disconnected")
+                            socket_time = time.perf_counter() - start
+                            written = delta_writer.written
+                            delta_writer.write(literal)
+                        elif instruction == END:
+                            digest = codec.read_name(reader)
+                            break
+                        else:
+                            raise ConnectionError(f"Unknown delta instruction: {instruction}")
+                        transfer.add(delta_writer.written - written, socket_time=socket_time,
+                                     disk_time=time.perf_counter() - start - socket_time)
+                    filepath = self._finish_delta(delta_writer, metadata, digest, data_length)
+                print() # Go to next line after 100% file downloaded is displayed
+            except Exception:
+                print("Delta Download Error:", traceback.format_exc())
+                self._abort_delta(delta_writer)
+                self.notify(conn, 'Error Receiving File')
+            else:
+                print(f"{filepath.name} rebuilt: {delta_writer.literal_bytes} of {delta_writer.written} bytes received, "
+                      f"the rest copied from the previous version")
+                self.notify(conn, 'File Downloaded')
+                return b'File Saved'
+
+        elif data_type == "Offer":
+            # Tell the client whether a file with this size and content is already here, so it can skip the body
+            try:
+                request = json.loads(reader.recv_exact(data_length, MAX_CONTROL_SIZE).decode("utf-8"))
+                self.send_data(sender_conn=conn, receiver=None, data=json.dumps(self._offer_reply(request)))
+                return b'Offer Answered'
+            except Exception:
+                print("Offer Error:", traceback.format_exc())
+                self.send_data(sender_conn=conn, receiver=None, data=json.dumps({'reply': 'Offer', 'error': 'Invalid Offer'}))
+
+        elif data_type == "Udp":
+            # File body arrives as datagrams on a UDP port opened for it, the connection carries the reports (see udp_transfer)
+            try:
+                request = json.loads(reader.recv_exact(data_length, MAX_CONTROL_SIZE).decode("utf-8"))
+                udp_receiver = self._open_udp_receiver(request, conn.getsockname()[0])
+            except Exception:
+                print("UDP Transfer Setup Error:", traceback.format_exc())
+                self.send_data(sender_conn=conn, receiver=None, data=json.dumps({'reply': 'Udp', 'error': 'Invalid UDP Transfer'}))
+                return b'UDP Transfer Refused'
+            try:
+                self.send_data(sender_conn=conn, receiver=None,
+                               data=json.dumps({'reply': 'Udp', 'port': udp_receiver.port, 'token': udp_receiver.token.hex()}))
+                try:
+                    with self.metrics.start(request['filename'], 'receive', udp_receiver.file_size) as transfer:
+                        complete = udp_receiver.run(
+                            lambda report: self.send_data(sender_conn=conn, receiver=None, data=json.dumps(report)), transfer)
+                    if complete:
+                        self._finish_udp_receiver(udp_receiver)
+                finally:
+                    self._abort_udp_receiver(udp_receiver)
+                print() # Go to next line after 100% file downloaded is displayed
+                print(f"{udp_receiver.received_blocks} blocks received over UDP, {udp_receiver.duplicates} duplicates")
+            except Exception:
+                print("UDP File Download Error:", traceback.format_exc())
+                self.notify(conn, 'Error Receiving File')
+            else:
+                if not complete:
+                    print("The sender went quiet, UDP transfer abandoned")
+                    self.notify(conn, 'Error Receiving File')
+                    return b'File Discarded'
+                self.notify(conn, 'File Downloaded')
+                return b'File Saved'
+
+        elif data_type == "Stats":
+            # Reply with the metrics of the transfers in progress and of the recently finished ones
+            try:
+                reader.recv_exact(data_length, MAX_CONTROL_SIZE)
+                self.send_data(sender_conn=conn, receiver=None, data=json.dumps({'reply': 'Stats', **self.stats()}))
+                return b'Stats Sent'
+            except Exception:
+                print("Stats Request Error:", traceback.format_exc())
+                self.send_data(sender_conn=conn, receiver=None, data=json.dumps({'reply': 'Stats', 'error': 'Invalid Stats Request'}))
+
+        elif data_type == "Pipe":
+            # Data of unknown length, e.g. the sender's stdin, in length prefixed chunks until an empty one
+            try:
+                name = codec.read_name(reader)
+                with self.pipe_lock:
+                    complete = self._receive_pipe(reader, codec, name)
+            except Exception:
+                print("Pipe Receiving Error:", traceback.format_exc())
+                self.notify(conn, 'Error Receiving Pipe')
+                return
+            print() # blank line
+            if not complete:
+                print("Client Disconnected")
+                return
+            self.notify(conn, 'Pipe Received')
+            return b'Pipe Saved'
+
         elif data_type in ('Text', 'POLL'):
             self.print_received_text = True
-            data = b""
-            current_data_length = 0
             exception_occured = False
-            while current_data_length < data_length:
-                try:
-                    chunk = conn.recv(2048)
-
-                    if not chunk:
-                        print("Client Disconnected")
-                        break
-                    else:
-                        data += chunk
-                        current_data_length = len(chunk)
-                except Exception:
-                    print("Text Reading Error: ", traceback.format_exc())
-                    self.send_data(sender_conn=conn, receiver=None, data='Error Receiving Text')
-                    exception_occured = True
-                    break
+            try:
+                # Accumulate the message in a single preallocated bytearray
+                data = reader.recv_exact(data_length, MAX_CONTROL_SIZE)
+                if len(data) < data_length:
+                    print("Client Disconnected")
+            except Exception:
+                print("Text Reading Error: ", traceback.format_exc())
+                self.notify(conn, 'Error Receiving Text')
+                exception_occured = True
             if not exception_occured and data_type == 'Text':
-                self.send_data(sender_conn=conn, receiver=None, data='Text Received')
+                self.notify(conn, 'Text Received')
+                return data
             elif not exception_occured and data_type == 'POLL':
                 self.print_received_text = False
                 return data
-    
+
+
+    def _receive_pipe(self, reader: RecvBuffer, codec: FrameCodec, name: str) -> bool:
+        """
+        Receive the chunks of a 'Pipe' stream into pipe_output, or into a new file named <name>.
+
+        Only one chunk is held at a time and every chunk is written before the next one is read, so a
+        slow output stops the reads and TCP pushes back on the sender.
+
+        :return: False if the client disconnected before the end of the stream.
+        """
+
+        disk_writer = None if self.pipe_output else self._open_disk_writer(name, 0)
+        output = disk_writer or self.pipe_output
+        try:
+            with self.metrics.start(name, 'receive', 0) as transfer:
+                output = self.relay.tee(output, transfer)
+                while chunk_length := codec.read_int(reader):
+                    if reader.recv_into_file(output, chunk_length, metrics=transfer) < chunk_length:
+                        transfer.finish('failed')
+                        return False
+                    if not disk_writer:
+                        # A reader at the other end of the output sees every chunk as soon as it arrives
+                        output.flush()
+            if disk_writer:
+                self._finish_disk_writer(disk_writer)
+            return True
+        finally:
+            if disk_writer:
+                self._abort_disk_writer(disk_writer)
+
+
+    def _offer_reply(self, request: dict) -> dict:
+        """Answer an offer of a file by its size and CATALOG_ALGORITHM hash."""
+
+        name = self.catalog.find(int(request['size']), str(request['hash']))
+        if name:
+            print(f"Already have {request['filename']} as {name}, the client skips it")
+        return {'reply': 'Offer', 'have': name is not None, 'name': name}
+
+
+    def stats(self) -> dict:
+        """In-process stats endpoint: metrics of every transfer this server is receiving or has received."""
+
+        return self.metrics.stats()
+
+
+    def set_rate_limit(self, rate: float = None, transfer_id: int = None):
+        """
+        Change the global receive rate limit, or that of one transfer (ids are in stats()),
+        in bytes per second; None removes it. Transfers in progress slow down or speed up
+        within a block, nobody has to reconnect.
+        """
+
+        self.bandwidth.set_rate(rate, transfer_id)
+
+
+    def set_transfer_weight(self, transfer_id: int, weight: float):
+        """Change the share of the global rate limit a transfer in progress gets relative to the others."""
+
+        self.bandwidth.set_weight(transfer_id, weight)
+
+
+    def _verify_digest(self, filepath: pathlib.Path, digest: str, expected_digest: str) -> bool:
+        """Compare the digest of a received file with the sender's; a file that doesn't match is deleted."""
+
+        if digest == expected_digest:
+            print(f"{filepath.name} verified")
+            return True
+        print(f"{filepath.name} doesn't match the sender's digest, deleting it")
+        filepath.unlink(missing_ok=True)
+        self.catalog.remove(filepath)
+        return False
+
+
+    def _receive_compressed_chunks(self, reader: RecvBuffer, codec: FrameCodec, decompressor: ChunkDecompressor, data_length: int, transfer: TransferMetrics):
+        """
+        Receive chunks until <data_length> original bytes have been restored.
+
+        Every chunk is its original length, its payload length and the payload. Chunks are
+        decompressed and written on a worker thread while the next one is received; waiting
+        for that thread counts as disk time of <transfer>.
+
+        :return: CompressionStats of the receiving side.
+        """
+
+        received = 0
+        pending_write = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as decompressor_thread:
+            while received < data_length:
+                start = time.perf_counter()
+                raw_length = codec.read_int(reader)
+                payload_length = codec.read_int(reader)
+                check_chunk_header(raw_length, payload_length)
+                payload = reader.recv_exact(payload_length)
+                if len(payload) < payload_length:
+                    raise ConnectionError("Client Disconnected")
+                socket_time = time.perf_counter() - start
+                if pending_write:
+                    pending_write.result()
+                pending_write = decompressor_thread.submit(decompressor.write_chunk, raw_length, payload)
+                received += raw_length
+                transfer.add(raw_length, socket_time=socket_time, disk_time=time.perf_counter() - start - socket_time)
+            if pending_write:
+                pending_write.result()
+        return decompressor.stats
+
+
+    def _delta_basis_path(self, filename: str) -> pathlib.Path:
+        if pathlib.PurePath(filename).name != filename or filename.startswith('.'):
+            raise ValueError(f"Invalid file name: {filename}")
+        return self.download_location / filename
+
+
+    def _delta_signature_reply(self, request: dict) -> dict:
+        """
+        Signature of the file in download_location with the requested name, or a block_size
+        of 0 if there is no such file to compute a delta against.
+        """
+
+        basis_path = self._delta_basis_path(request['filename'])
+        if not basis_path.is_file() or not basis_path.stat().st_size:
+            return {'reply': 'Delta', 'block_size': 0}
+        stat = basis_path.stat()
+        block_size = delta_block_size(stat.st_size)
+        signature = file_signature(basis_path, block_size)
+        return {'reply': 'Delta', 'block_size': block_size, 'basis_size': stat.st_size, 'basis_mtime_ns': stat.st_mtime_ns,
+                'signature': base64.b64encode(signature).decode("ascii")}
+
+
+    def _open_delta(self, metadata: dict) -> DeltaWriter:
+        """Check that the basis is still the version the signature was computed from and start the rebuild."""
+
+        basis_path = self._delta_basis_path(metadata['filename'])
+        stat = basis_path.stat()
+        if (stat.st_size, stat.st_mtime_ns) != (metadata['basis_size'], metadata['basis_mtime_ns']):
+            raise ValueError(f"{basis_path.name} changed since its signature was sent")
+        output_path = basis_path.with_name(f".{basis_path.name}.{secrets.token_hex(8)}.delta")
+        return DeltaWriter(basis_path, output_path, metadata['block_size'])
+
+
+    def _finish_delta(self, delta_writer: DeltaWriter, metadata: dict, digest: str, data_length: int) -> pathlib.Path:
+        """
+        Verify the rebuilt file and move it to its final name: over the previous version
+        if the client asked for in place replacement, otherwise next to it.
+        """
+
+        delta_writer.finish(digest)
+        if delta_writer.written != data_length:
+            raise ValueError(f"Rebuilt {delta_writer.written} bytes instead of {data_length}")
+        if metadata.get('in_place'):
+            filepath = self._delta_basis_path(metadata['filename'])
+        else:
+            filepath = self._get_unique_filepath(metadata['filename'])
+        os.replace(delta_writer.output_path, filepath)
+        self.catalog.add(filepath)
+        return filepath
+
+
+    def _abort_delta(self, delta_writer: DeltaWriter):
+        if delta_writer:
+            delta_writer.close()
+            delta_writer.output_path.unlink(missing_ok=True)
+
+
+    def _open_disk_writer(self, filename: str, size: int) -> DiskWriter:
+        """
+        Reserve a unique name for <filename> in download_location and return a DiskWriter for it.
+        The name holds an empty file until the writer finishes; aborting the writer frees it again.
+        """
+
+        with self._create_unique_file(filename) as placeholder:
+            filepath = pathlib.Path(placeholder.name)
+        return DiskWriter(filepath, size, self.fsync_policy, reserved=True)
+
+
+    def _finish_disk_writer(self, disk_writer: DiskWriter, content_hash: str = None):
+        """:param content_hash: CATALOG_ALGORITHM digest of the file if the transfer computed one."""
+
+        self.catalog.add(disk_writer.finish(), content_hash)
+
+
+    def _abort_disk_writer(self, disk_writer: DiskWriter):
+        """Throw away an unfinished DiskWriter and free its name; does nothing once it finished."""
+
+        if not disk_writer.closed:
+            disk_writer.abort()
+            self.catalog.release(disk_writer.filepath)
+
+
+    def _open_udp_receiver(self, request: dict, bind_address: str) -> UdpReceiver:
+        """Reserve a name for the file of a 'Udp' request and open the UDP port on <bind_address> its blocks arrive on."""
+
+        filepath = self._get_unique_filepath(str(request['filename']))
+        try:
+            return UdpReceiver(filepath, int(request['size']), int(request['block_size']), bind_address)
+        except Exception:
+            filepath.unlink(missing_ok=True)
+            self.catalog.release(filepath)
+            raise
+
+
+    def _finish_udp_receiver(self, udp_receiver: UdpReceiver):
+        self.catalog.add(udp_receiver.finish(sync=self.fsync_policy != 'none'))
+
+
+    def _abort_udp_receiver(self, udp_receiver: UdpReceiver):
+        """Throw away an unfinished UDP transfer and free its name; does nothing once it finished."""
+
+        if not udp_receiver.closed:
+            udp_receiver.abort()
+            self.catalog.release(udp_receiver.filepath)
+
+
+    def _get_unique_filepath(self, filename: str) -> pathlib.Path:
+        """
+        Reserve a path in download_location for <filename> that doesn't overwrite an existing file.
+        The name holds an empty file until the finished file is moved over it.
+        """
+
+        return self.catalog.reserve_path(filename)
+
+
+    def _receive_batch(self, reader: RecvBuffer, codec: FrameCodec, transfer: TransferMetrics) -> int:
+        """
+        Receive the entries of a batch until the end marker and recreate them under download_location.
+
+        Every entry is a length prefixed relative path, the file size and the file data;
+        an empty path ends the batch.
+        Files up to <buffer_size> bytes are handed to a pool of writer threads while the
+        next entries are read, larger ones are written directly from the socket.
+
+        :return: Number of files received.
+        """
+
+        pending_writes = threading.BoundedSemaphore(BATCH_PENDING_WRITES)
+        write_errors = []
+
+        def write_done(future):
+            pending_writes.release()
+            if future.exception():
+                write_errors.append(future.exception())
+
+        file_count = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_WRITER_THREADS) as writers:
+            while True:
+                relative_path = codec.read_name(reader)
+                if not relative_path:
+                    break
+                file_size = codec.read_int(reader)
+
+                if file_size <= min(self.buffer_size, MAX_EXACT_SIZE):
+                    start = time.perf_counter()
+                    data = reader.recv_exact(file_size)
+                    if len(data) < file_size:
+                        raise ConnectionError("Client Disconnected")
+                    socket_time = time.perf_counter() - start
+                    pending_writes.acquire()
+                    writers.submit(self._write_batch_file, relative_path, data).add_done_callback(write_done)
+                    transfer.add(file_size, socket_time=socket_time, disk_time=time.perf_counter() - start - socket_time)
+                else:
+                    with self._create_unique_file(relative_path) as file:
+                        if reader.recv_into_file(file, file_size, metrics=transfer) < file_size:
+                            raise ConnectionError("Client Disconnected")
+                    self.catalog.add(pathlib.Path(file.name))
+                file_count += 1
+
+        if write_errors:
+            raise write_errors[0]
+        return file_count
+
+
+    def _write_batch_file(self, relative_path: str, data):
+        with self._create_unique_file(relative_path) as file:
+            file.write(data)
+        self.catalog.add(pathlib.Path(file.name))
+
+
+    def _create_unique_file(self, relative_path: str):
+        """
+        Create a file under download_location, adding a (cN) suffix if the name is taken (see Catalog.reserve).
+
+        :param relative_path: '/' separated path, e.g. of a batch entry; it may not leave download_location.
+        :return: The new file opened for binary writing.
+        """
+
+        return self.catalog.reserve(relative_path)
+
+
+    def handle_stream(self, conn, addr, transfer_id: str, session: dict = None):
+        """
+        Receive byte ranges of a parallel transfer on a stream connection.
+
+        Each frame has the 'Range' data type and is followed by the file offset and the range data.
+
+        :param session: Session of a v5 hello, which is answered instead of a plain status.
+        """
+
+        try:
+            with self.transfers_condition:
+                self.transfers_condition.wait_for(lambda: transfer_id in self.parallel_transfers, timeout=STREAM_ATTACH_TIMEOUT)
+                transfer = self.parallel_transfers.get(transfer_id)
+            if not transfer or not transfer.attach():
+                self._answer_channel(conn, session, 'Unknown Transfer')
+                return
+            try:
+                self._answer_channel(conn, session, 'OK')
+                self._receive_ranges(conn, transfer)
+            finally:
+                transfer.detach()
+                if transfer.is_abandoned():
+                    self._watch_parallel_transfer(transfer)
+        except Exception:
+            print("Stream Receiving Error:", traceback.format_exc())
+        finally:
+            self.codecs.pop(conn, None)
+            self.tuners.pop(conn, None)
+            conn.close()
+
+
+    def _receive_ranges(self, conn, transfer: ParallelTransfer):
+        reader = RecvBuffer(conn, self.buffer_size, self.tuners.get(conn))
+        codec = self._codec(conn)
+        while True:
+            data_type, data_length = codec.read_header(reader)
+            if data_type is None:
+                break
+            if data_type != 'Range':
+                print(f"Unexpected data type on stream connection: {data_type}")
+                break
+            offset = codec.read_int(reader)
+            transfer.check_range(offset, data_length)
+
+            received = reader.recv_into_file(RangeWriter(transfer, offset), data_length, metrics=transfer.metrics)
+            if received < data_length:
+                # The client sends this range again on another stream
+                print("Stream Disconnected")
+                break
+            if transfer.range_received(offset):
+                self._finish_parallel_transfer(transfer)
+
+
+    def _watch_parallel_transfer(self, transfer: ParallelTransfer):
+        """Abort <transfer> if it still has no stream connection STREAM_ATTACH_TIMEOUT seconds from now."""
+
+        timer = threading.Timer(STREAM_ATTACH_TIMEOUT, self._expire_parallel_transfer, args=(transfer,))
+        timer.daemon = True
+        timer.start()
+
+
+    def _expire_parallel_transfer(self, transfer: ParallelTransfer):
+        if transfer.is_abandoned(STREAM_ATTACH_TIMEOUT) and self._abort_parallel_transfer(transfer):
+            print(f"Parallel transfer of {transfer.filepath.name} abandoned, no stream connection for {STREAM_ATTACH_TIMEOUT} seconds")
+            self.notify(transfer.conn, 'Error Receiving File')
+
+
+    def _abort_parallel_transfer(self, transfer: ParallelTransfer) -> bool:
+        """Forget <transfer> and remove its partial file. :return: False if it was already over."""
+
+        with self.transfers_condition:
+            if self.parallel_transfers.get(transfer.transfer_id) is transfer:
+                self.parallel_transfers.pop(transfer.transfer_id)
+        if not transfer.abort():
+            return False
+        if transfer.metrics:
+            transfer.metrics.finish('failed')
+        return True
+
+
+    def _abort_parallel_transfers(self, conn):
+        """Abort the parallel transfers announced on main connection <conn>, which was closed."""
+
+        with self.transfers_condition:
+            transfers = [transfer for transfer in self.parallel_transfers.values() if transfer.conn is conn]
+        for transfer in transfers:
+            if self._abort_parallel_transfer(transfer):
+                print(f"Parallel transfer of {transfer.filepath.name} aborted, its client disconnected")
+
+
+    def _finish_parallel_transfer(self, transfer: ParallelTransfer):
+        with self.transfers_condition:
+            self.parallel_transfers.pop(transfer.transfer_id, None)
+        transfer.finish()
+        self.catalog.add(transfer.filepath)
+        if transfer.metrics:
+            transfer.metrics.finish()
+        print(f"\n{transfer.filepath.name} downloaded over parallel streams")
+        self.notify(transfer.conn, 'File Downloaded')
+
+
+    def _handle_channel(self, conn, addr, hello: str, session: dict = None) -> bool:
+        """
+        Serve <conn> if it is a STREAM, EVENTS or RELAY connection, or pass it to the worker process that owns its
+        transfer or token (see workers).
+
+        :return: False if <conn> is the main connection of a client.
+        """
+
+        if not hello.startswith((STREAM_HELLO, EVENTS_HELLO, RELAY_HELLO)):
+            return False
+        if hello.startswith(RELAY_HELLO):
+            # Subscribers get the uploads of the worker process they reached
+            self.handle_relay(conn, addr, session)
+        elif self.router and self.router.hand_off(conn, hello, session, self._codec(conn).version):
+            self.codecs.pop(conn, None)
+            self.tuners.pop(conn, None)
+            conn.close()
+        elif hello.startswith(STREAM_HELLO):
+            self.handle_stream(conn, addr, hello[len(STREAM_HELLO):].strip(), session)
+        else:
+            self.handle_events(conn, addr, hello[len(EVENTS_HELLO):].strip(), session)
+        return True
+
+
+    def adopt_channel(self, conn, hello: str, session: dict, version: int):
+        """Serve a STREAM or EVENTS connection another worker process accepted and handed over (see workers)."""
+
+        self.codecs[conn] = FrameCodec(version, self.data_header_size, self.filename_header_size)
+        self.tuners[conn] = ConnectionTuner(conn, 'receive', self.buffer_size, enabled=self.autotune)
+        threading.Thread(target=self._handle_channel, args=(conn, conn.getpeername(), hello, session), daemon=True).start()
+
 
     def handle_client(self, conn, addr):
 
 
+        self.tuners[conn] = ConnectionTuner(conn, 'receive', self.buffer_size, enabled=self.autotune)
         # Validate Username provided by client by checking if it already exists in client_dict
         # If username is unique add it to client_dict
         try:
             while True:
-                username = conn.recv(2048).decode('utf-8')
+                username = conn.recv(2048)
+                session = None
+                # v2 clients agree on the protocol version before sending their username, v5 clients send it along
+                if username.startswith(HELLO_MAGIC):
+                    session = self._negotiate_protocol(conn, self._read_hello(conn, username))
+                    if session is None:
+                        continue
+                    username = str(session.get('channel') or session.get('username', ''))
+                else:
+                    username = username.decode('utf-8')
+                # Stream connections of a parallel transfer don't take part in the username handshake
+                if self._handle_channel(conn, addr, username, session):
+                    return
                 print(f"Selected Username: {username}")
                 if len(self.client_dict) > 0:
                     username = None
                     print('Cannot Connet with client/sender. Server/Receiver is already connected with another device')
-                    self.send_data(sender_conn=conn, receiver=None, data='Receiver is already connected with another device')
+                    self._answer_username(conn, session, error='Receiver is already connected with another device')
                     break
                 elif not self.client_dict.get(username):
                     self.client_dict.update({username: conn})
-                    self.send_data(sender_conn=conn, receiver=None, data=username)
+                    self._answer_username(conn, session, username=username)
                     break
                 else:
-                    self.send_data(sender_conn=conn, receiver=None, data='Username already taken')
+                    self._answer_username(conn, session, error='Username already taken')
 
             print("client_dict: ", self.client_dict)
         except Exception:
             print("Error in setting up client 'Username'")
             print(traceback.format_exc())
+            self.codecs.pop(conn, None)
+            self.tuners.pop(conn, None)
             conn.close()
             print(f"Lost Connection with {addr}")
         else:
-            while True:
-                data = self.receive_data(conn)
-                if not data:
-                    break
-                else:
-                    if self.print_received_text:
-                        print(f"Data from {username}:", data.decode("utf-8"))
-                    # data = f"{username}: ".encode("utf-8") + data
-                    # for client_username, receiver_conn in self.client_dict.items():
-                    #     if client_username != username and receiver_conn:
-                    #         print(f"Sending data to {username}")
-                    #         self.send_data(conn, client_username, data)
-
-
-            # conn.sendall(f"{data_length} bytes received".encode("utf-8"))
-            # In case of sender trying to connect to busy receiver, username is set to None
-            # and username is not added to client_dict.
-            if username:
-                self.client_dict.pop(username)
-                print("client dict: ", self.client_dict)
-            conn.close()
-            print(f"Lost Connection with {username if username else addr}")
+            try:
+                reader = RecvBuffer(conn, self.buffer_size, self.tuners.get(conn))
+                while True:
+                    data = self.receive_data(conn, reader)
+                    if not data:
+                        break
+                    else:
+                        if self.print_received_text:
+                            print(f"Data from {username}:", data.decode("utf-8"))
+                        # data = f"{username}: ".encode("utf-8") + data
+                        # for client_username, receiver_conn in self.client_dict.items():
+                        #     if client_username != username and receiver_conn:
+                        #         print(f"Sending data to {username}")
+                        #         self.send_data(conn, client_username, data)
+            except Exception:
+                print(f"Error while serving {username or addr}:", traceback.format_exc())
+            finally:
+                # conn.sendall(f"{data_length} bytes received".encode("utf-8"))
+                # In case of sender trying to connect to busy receiver, username is set to None
+                # and username is not added to client_dict.
+                if username:
+                    self.client_dict.pop(username, None)
+                    print("client dict: ", self.client_dict)
+                self._abort_parallel_transfers(conn)
+                self._close_event_channel(conn)
+                self.codecs.pop(conn, None)
+                self.tuners.pop(conn, None)
+                conn.close()
+                print(f"Lost Connection with {username if username else addr}")
 
-def start_server():
-    s = Server()
+def start_server(s: Server = None):
+    s = s or Server()
     while True:
         try:
             conn, addr = s.server.accept()
@@ -264,6 +1220,7 @@ def start_server():
                 # Sending empty data will force client to close socket from its side
                 s.client_dict[usrname].sendall(b"")
                 # close socket from server side
+                s._close_event_channel(s.client_dict[usrname])
                 s.client_dict[usrname].close()
             s.client_dict.clear()
             print(s.client_dict)
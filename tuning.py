@@ -0,0 +1,178 @@
+import contextlib
+import socket
+import struct
+import time
+
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+CHUNK_TIME = 0.005                  # Seconds of data at the measured rate moved per chunk
+BDP_BUFFER_FACTOR = 2               # Bandwidth-delay products a socket buffer holds, so a full buffer is never the bottleneck
+MAX_SOCKET_BUFFER = 64 * 1024 * 1024
+RETUNE_INTERVAL = 0.5               # Seconds between two adjustments of a connection
+
+# struct tcp_info of Linux: 8 single byte fields, then 32 bit counters; tcpi_rtt and
+# tcpi_rttvar are the 16th and 17th counters, in microseconds
+_TCP_INFO = struct.Struct('8B17I')
+_TCP_INFO_RTT = 15
+# TCP_CORK on Linux, TCP_NOPUSH on the BSDs and macOS
+_CORK_OPTION = getattr(socket, 'TCP_CORK', None) or getattr(socket, 'TCP_NOPUSH', None)
+# Largest buffer an application may ask for, beyond which setsockopt silently caps the value
+_BUFFER_LIMIT_FILES = {socket.SO_SNDBUF: '/proc/sys/net/core/wmem_max', socket.SO_RCVBUF: '/proc/sys/net/core/rmem_max'}
+
+
+def measure_rtt(sock) -> float:
+    """:return: Smoothed round trip time of a TCP connection in seconds, or None where the kernel doesn't report it."""
+
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, _TCP_INFO.size)
+    except OSError:
+        return None
+    if len(info) < _TCP_INFO.size:
+        return None
+    rtt = _TCP_INFO.unpack(info)[8 + _TCP_INFO_RTT]
+    return rtt / 1_000_000 if rtt else None
+
+
+def set_nodelay(sock):
+    """Send small control frames as soon as they are written instead of waiting to fill a segment."""
+
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        # Not a TCP socket, e.g. in tests
+        pass
+
+
+def _buffer_limit(option) -> int:
+    try:
+        with open(_BUFFER_LIMIT_FILES[option], encoding='ascii') as limit_file:
+            return int(limit_file.read())
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def chunk_size_for(rate: float) -> int:
+    """Power of two close to CHUNK_TIME seconds of data at <rate> bytes per second."""
+
+    target = min(max(rate * CHUNK_TIME, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+    return 1 << (int(target) - 1).bit_length()
+
+
+class ConnectionTuner():
+    """
+    Socket options and chunk size of one connection, adjusted to its bandwidth-delay product.
+
+    The round trip time comes from the kernel (TCP_INFO) or from the handshake, and the
+    throughput from the metrics of the transfer running on the connection. Every
+    RETUNE_INTERVAL seconds the socket buffer on the side that moves the data is grown to
+    BDP_BUFFER_FACTOR times the bandwidth-delay product, never shrunk below what the kernel's
+    own autotuning already gave it, and the chunk size follows the throughput.
+
+    Control frames go out at once (TCP_NODELAY); bulk data is corked so headers, data and
+    trailers leave in full segments.
+    """
+
+    def __init__(self, sock, direction: str, chunk_size: int, rtt: float = None, enabled: bool = True):
+        """
+        :param direction: 'send' if bulk data goes out on the connection, 'receive' if it comes in.
+        :param chunk_size: Chunk size until the first measurement.
+        :param rtt: Round trip time in seconds measured by the caller, e.g. during the handshake.
+        :param enabled: Only set TCP_NODELAY and corking; chunk and buffer sizes stay as they are.
+        """
+
+        self.sock = sock
+        self.direction = direction
+        self.buffer_option = socket.SO_SNDBUF if direction == 'send' else socket.SO_RCVBUF
+        self.enabled = enabled
+        self.chunk_size = chunk_size
+        self.rtt = rtt
+        self.rate = None
+        self.bdp = None
+        self.socket_buffer = self._socket_buffer()
+        self.corked = False
+        self.last_update = 0.0
+        set_nodelay(sock)
+
+
+    def _socket_buffer(self) -> int:
+        try:
+            return self.sock.getsockopt(socket.SOL_SOCKET, self.buffer_option)
+        except OSError:
+            return None
+
+
+    @contextlib.contextmanager
+    def bulk(self):
+        """Cork the connection while bulk data is written; leaving flushes what is left right away."""
+
+        if _CORK_OPTION is None or self.corked:
+            yield
+            return
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, _CORK_OPTION, 1)
+        except OSError:
+            yield
+            return
+        self.corked = True
+        try:
+            yield
+        finally:
+            self.corked = False
+            try:
+                self.sock.setsockopt(socket.IPPROTO_TCP, _CORK_OPTION, 0)
+            except OSError:
+                pass
+
+
+    def update(self, transfer) -> int:
+        """
+        Measure the connection while <transfer> runs on it and adjust it, at most every RETUNE_INTERVAL seconds.
+        The chosen parameters are kept in transfer.tuning.
+
+        :param transfer: TransferMetrics of the transfer.
+        :return: Chunk size to use from now on.
+        """
+
+        now = time.monotonic()
+        # The first blocks only fill the socket buffers, their rate says nothing about the path
+        if self.enabled and transfer.elapsed >= RETUNE_INTERVAL and now - self.last_update >= RETUNE_INTERVAL:
+            self.last_update = now
+            self.rtt = measure_rtt(self.sock) or self.rtt
+            self.rate = transfer.rate or None
+            if self.rate:
+                self.chunk_size = chunk_size_for(self.rate)
+                if self.rtt:
+                    self.bdp = int(self.rate * self.rtt)
+                    self._grow_socket_buffer(BDP_BUFFER_FACTOR * self.bdp)
+        transfer.tuning = self.parameters()
+        return self.chunk_size
+
+
+    def _grow_socket_buffer(self, size: int):
+        current = self._socket_buffer()
+        limit = _buffer_limit(self.buffer_option)
+        size = min(size, MAX_SOCKET_BUFFER, limit or MAX_SOCKET_BUFFER)
+        # Asking for less than the kernel already autotuned to would lock the buffer at the smaller size
+        if current is None or size <= current:
+            return
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, self.buffer_option, size)
+        except OSError:
+            return
+        self.socket_buffer = self._socket_buffer()
+
+
+    def parameters(self) -> dict:
+        return {
+            'rtt_ms': self.rtt * 1000 if self.rtt else None,
+            'rate': self.rate,
+            'bdp': self.bdp,
+            'chunk_size': self.chunk_size,
+            'send_buffer' if self.direction == 'send' else 'receive_buffer': self.socket_buffer,
+            'nodelay': True,
+            'cork': self.direction == 'send' and _CORK_OPTION is not None,
+            'autotune': self.enabled,
+        }
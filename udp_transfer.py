@@ -0,0 +1,478 @@
+"""
+UDP bulk transport for links with a long round trip time, where the congestion window of a single
+TCP stream stays far below what the link can carry.
+
+The file body goes out as sequenced datagrams paced at a fixed rate, while the TCP connection of
+the client carries the control messages (see Client.send_file_udp):
+
+1. The client asks for the transfer in a 'Udp' frame: a JSON request with the file name, size and block size.
+2. The server opens a UDP port for it and answers the port and a random token.
+3. The client sends every block once, in order, as a datagram: the token, a sequence number, the
+   block index and the block. The sequence number grows with every datagram, retransmissions included.
+4. The receiver keeps a bitmap of the blocks it has and every REPORT_INTERVAL seconds reports on the
+   TCP connection how many it has, the highest block and sequence number it has seen and the runs of
+   missing blocks below that block: selective negative acknowledgements.
+5. The sender retransmits reported blocks before any new one, except those whose last copy went out
+   after the datagram with the reported sequence number, which may still be on their way. Once every
+   block was sent and nothing was asked for during TAIL_TIMEOUT round trips, it sends the blocks past
+   the highest reported one and the reported ones again.
+6. Once every block is in, the receiver sends a last report and the server notifies 'File Downloaded'
+   as for any other file.
+
+Datagrams are only checked by the UDP checksum; files that need end-to-end verification go over TCP.
+Loss and delay can be injected on the sending side with ImpairedLink to try the transport on loopback.
+"""
+
+import collections
+import mmap
+import os
+import pathlib
+import random
+import re
+import socket
+import struct
+import threading
+import time
+
+
+DEFAULT_BLOCK_SIZE = 1400       # Data per datagram; with the headers a datagram fits a 1500 byte Ethernet MTU
+MAX_BLOCK_SIZE = 65000          # Largest block that fits in one UDP datagram with the headers
+DEFAULT_RATE = 12_500_000       # Bytes per second datagrams are paced at unless told otherwise (100 Mbit/s)
+REPORT_INTERVAL = 0.02          # Seconds between two reports of the receiver
+MAX_REPORT_RANGES = 512         # Runs of missing blocks per report, the others follow in later reports
+IDLE_TIMEOUT = 30               # Seconds either side waits to hear from the other before giving up
+TAIL_TIMEOUT = 2                # Round trips without a retransmission request before the sender resends what is unconfirmed
+PACING_BURST = 0.002            # Seconds of data sent back to back when the sender has fallen behind its schedule
+METRICS_BLOCK = 256 * 1024      # Bytes sent or received between two updates of the transfer metrics
+SOCKET_BUFFER = 8 * 1024 * 1024 # Requested UDP socket buffer size, the kernel caps it at its maximum
+TOKEN_SIZE = 8
+
+_DATAGRAM_HEADER = struct.Struct('!8sQQ')   # token, sequence number, block index
+_MISSING_BYTES = re.compile(rb'[^\xff]+')   # bytes of the bitmap with at least one missing block
+
+
+def _udp_socket(buffer_option) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, buffer_option, SOCKET_BUFFER)
+    except OSError:
+        pass
+    return sock
+
+
+class UdpReceiver():
+    """
+    Receiver side of one file sent over the UDP transport.
+
+    Blocks are copied through a memory map into a '.part' file preallocated next to <filepath>, in
+    whatever order they arrive, and a bitmap with one bit per block records which ones are in.
+    """
+
+    def __init__(self, filepath: pathlib.Path, file_size: int, block_size: int, bind_address: str):
+        """
+        :param filepath: Final path of the file, reserved by the caller; abort() removes it.
+        :param bind_address: Local address of the control connection, the UDP port is opened on it.
+        """
+
+        if not 0 < block_size <= MAX_BLOCK_SIZE:
+            raise ValueError(f"Unsupported block size: {block_size}")
+        if file_size < 0:
+            raise ValueError(f"Invalid file size: {file_size}")
+        self.filepath = pathlib.Path(filepath)
+        self.part_filepath = self.filepath.with_name(self.filepath.name + '.part')
+        self.file_size = file_size
+        self.block_size = block_size
+        self.block_count = -(-file_size // block_size)
+        self.bitmap = bytearray((self.block_count + 7) // 8)
+        if self.block_count % 8:
+            # Bits past the last block count as received, so a complete bitmap is all ones
+            self.bitmap[-1] = (0xff << (self.block_count % 8)) & 0xff
+        self.complete_bytes = 0     # Leading bytes of the bitmap with every block received
+        self.received_blocks = 0
+        self.duplicates = 0
+        self.highest_block = -1
+        self.highest_sequence = -1
+        self.token = os.urandom(TOKEN_SIZE)
+        self.closed = False
+        self.map = None
+        self.fd = os.open(self.part_filepath, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+        self.sock = _udp_socket(socket.SO_RCVBUF)
+        try:
+            os.ftruncate(self.fd, file_size)
+            if file_size:
+                self.map = mmap.mmap(self.fd, file_size)
+            self.sock.bind((bind_address, 0))
+        except Exception:
+            self.abort()
+            raise
+
+
+    @property
+    def port(self) -> int:
+        return self.sock.getsockname()[1]
+
+
+    def run(self, send_report, metrics=None) -> bool:
+        """
+        Receive datagrams until every block is in.
+
+        :param send_report: Called with every report (see report) to send it on the control connection.
+        :param metrics: TransferMetrics credited with the blocks received.
+        :return: False if the sender went quiet for IDLE_TIMEOUT seconds first.
+        """
+
+        header_size = _DATAGRAM_HEADER.size
+        buffer = bytearray(header_size + self.block_size)
+        view = memoryview(buffer)
+        self.sock.settimeout(REPORT_INTERVAL)
+        last_datagram = last_report = time.monotonic()
+        unreported = datagrams = 0
+        while self.received_blocks < self.block_count:
+            try:
+                length = self.sock.recv_into(buffer)
+            except socket.timeout:
+                length = 0
+            now = time.monotonic()
+            if length >= header_size:
+                token, sequence, block = _DATAGRAM_HEADER.unpack_from(buffer)
+                if token == self.token and block < self.block_count:
+                    last_datagram = now
+                    datagrams += 1
+                    self.highest_sequence = max(self.highest_sequence, sequence)
+                    self.highest_block = max(self.highest_block, block)
+                    index, mask = block >> 3, 1 << (block & 7)
+                    offset = block * self.block_size
+                    size = min(self.block_size, self.file_size - offset)
+                    if self.bitmap[index] & mask:
+                        self.duplicates += 1
+                    elif length - header_size == size:
+                        self.map[offset:offset + size] = view[header_size:length]
+                        self.bitmap[index] |= mask
+                        self.received_blocks += 1
+                        unreported += size
+            if metrics and unreported >= METRICS_BLOCK:
+                # Datagrams can't be slowed down by a receive rate limit, waiting would only lose them
+                metrics.add(unreported, datagrams, wait=False)
+                unreported = datagrams = 0
+            if now - last_report >= REPORT_INTERVAL:
+                if now - last_datagram >= IDLE_TIMEOUT:
+                    send_report(self.report('failed'))
+                    return False
+                send_report(self.report())
+                last_report = now
+        if metrics and unreported:
+            metrics.add(unreported, datagrams, wait=False)
+        send_report(self.report('completed'))
+        return True
+
+
+    def report(self, status: str = 'active') -> dict:
+        """Progress of the transfer as sent to the sender; 'missing' lists [first block, count] runs."""
+
+        return {
+            'reply': 'UdpReport',
+            'status': status,
+            'received': self.received_blocks,
+            'highest_block': self.highest_block,
+            'highest_sequence': self.highest_sequence,
+            'missing': self.missing_ranges(self.highest_block) if status == 'active' else [],
+        }
+
+
+    def missing_ranges(self, end: int, limit: int = MAX_REPORT_RANGES) -> list:
+        """:return: Runs of missing blocks before block <end> as [first block, count], at most <limit> of them."""
+
+        while self.complete_bytes < len(self.bitmap) and self.bitmap[self.complete_bytes] == 0xff:
+            self.complete_bytes += 1
+        ranges = []
+        for match in _MISSING_BYTES.finditer(self.bitmap, self.complete_bytes, (end + 7) >> 3):
+            for index in range(match.start(), match.end()):
+                bits = self.bitmap[index]
+                # A byte without any block is one run of 8, the others are taken apart bit by bit
+                for bit in (range(8) if bits else (0,)):
+                    if bits & (1 << bit):
+                        continue
+                    block = index * 8 + bit
+                    if block >= end:
+                        return ranges
+                    count = 1 if bits else min(8, end - block)
+                    if ranges and ranges[-1][0] + ranges[-1][1] == block:
+                        ranges[-1][1] += count
+                    elif len(ranges) == limit:
+                        return ranges
+                    else:
+                        ranges.append([block, count])
+        return ranges
+
+
+    def _close(self):
+        self.closed = True
+        self.sock.close()
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
+
+    def finish(self, sync: bool = False) -> pathlib.Path:
+        """Close the file and move it to its final name; <sync> fsyncs it first."""
+
+        if sync:
+            os.fsync(self.fd)
+        self._close()
+        os.replace(self.part_filepath, self.filepath)
+        return self.filepath
+
+
+    def abort(self):
+        """Throw the partial file and its reserved name away; does nothing once finish() succeeded."""
+
+        if self.closed:
+            return
+        self._close()
+        self.part_filepath.unlink(missing_ok=True)
+        self.filepath.unlink(missing_ok=True)
+
+
+class ImpairedLink():
+    """
+    Sends the datagrams of a UdpSender over a simulated link that drops a fraction <loss> of them at
+    random and delivers the others, in order, <delay> seconds late. Meant to try the transport on loopback.
+    """
+
+    def __init__(self, sock: socket.socket, loss: float = 0.0, delay: float = 0.0, seed=None):
+        if not 0 <= loss < 1:
+            raise ValueError(f"Loss must be a fraction below 1, got {loss}")
+        self.sock = sock
+        self.loss = loss
+        self.delay = delay
+        self.random = random.Random(seed)
+        self.dropped = 0
+        self.line = collections.deque()     # (due time, datagram)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = None
+        if delay:
+            self.thread = threading.Thread(target=self._deliver, daemon=True)
+            self.thread.start()
+
+
+    def send(self, buffers):
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        if not self.delay:
+            self.sock.sendmsg(buffers)
+            return
+        datagram = b"".join(buffers)
+        with self.condition:
+            self.line.append((time.monotonic() + self.delay, datagram))
+            self.condition.notify()
+
+
+    def _deliver(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.line or self.closed)
+                if self.closed:
+                    return
+                due, datagram = self.line.popleft()
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self.sock.send(datagram)
+            except OSError:
+                # Nobody listens on the port any more
+                pass
+
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+
+
+class UdpSender():
+    """
+    Sender side of one file sent over the UDP transport.
+
+    The blocks of the file are read through a memory map and paced out at <rate> bytes per second;
+    blocks the receiver reports missing (see handle_report) go out again before any new block.
+    """
+
+    def __init__(self, file, file_size: int, block_size: int, addr, token: bytes, rate: float = DEFAULT_RATE,
+                 rtt: float = None, loss: float = 0.0, delay: float = 0.0):
+        """
+        :param file: The file to send, opened for binary reading.
+        :param addr: (address, port) of the receiver's UDP port.
+        :param token: Token the receiver gave the transfer.
+        :param rtt: Round trip time of the control connection in seconds, if it was measured.
+        :param loss: Fraction of the datagrams to drop on purpose (see ImpairedLink).
+        :param delay: Seconds to hold every datagram before it is sent (see ImpairedLink).
+        """
+
+        if not 0 < block_size <= MAX_BLOCK_SIZE:
+            raise ValueError(f"Unsupported block size: {block_size}")
+        if rate <= 0:
+            raise ValueError(f"Invalid rate: {rate}")
+        self.file_size = file_size
+        self.block_size = block_size
+        self.block_count = -(-file_size // block_size)
+        self.token = token
+        self.rate = rate
+        self.rtt = max(rtt or 0.0, REPORT_INTERVAL)
+        self.map = mmap.mmap(file.fileno(), file_size, access=mmap.ACCESS_READ) if file_size else None
+        self.view = memoryview(self.map) if self.map is not None else None
+        self.sock = _udp_socket(socket.SO_SNDBUF)
+        self.sock.connect(addr)
+        self.link = ImpairedLink(self.sock, loss, delay) if loss or delay else None
+        self.next_block = 0
+        self.sequence = 0
+        self.retransmissions = collections.deque()
+        self.queued = set()         # blocks waiting in retransmissions
+        self.resent = {}            # block -> sequence number of its last retransmission
+        self.last_report = None
+        self.last_report_time = time.monotonic()
+        self.last_request_time = time.monotonic()
+        self.status = 'active'
+        self.error = None
+        self.condition = threading.Condition()
+        self.stats = {'datagrams': 0, 'retransmitted': 0, 'reports': 0, 'dropped': 0}
+
+
+    def handle_report(self, report: dict):
+        """Queue the blocks a receiver report asks for; called from the thread reading the control connection."""
+
+        with self.condition:
+            self.last_report = report
+            self.last_report_time = time.monotonic()
+            self.stats['reports'] += 1
+            if report['status'] != 'active':
+                self.status = report['status']
+                if self.status == 'failed':
+                    self.error = "The receiver stopped hearing from this sender"
+            for first, count in report['missing']:
+                for block in range(first, first + count):
+                    # A copy sent after the newest datagram the receiver has seen may still arrive
+                    if block in self.queued or self.resent.get(block, -1) > report['highest_sequence']:
+                        continue
+                    self.retransmissions.append(block)
+                    self.queued.add(block)
+                    self.last_request_time = self.last_report_time
+            self.condition.notify()
+
+
+    def fail(self, error: str):
+        """Stop the transfer, e.g. because the control connection was lost."""
+
+        with self.condition:
+            if self.status == 'active':
+                self.status = 'failed'
+                self.error = error
+            self.condition.notify()
+
+
+    def _requeue_unconfirmed(self):
+        """Queue what the receiver hasn't confirmed: the blocks past the highest one it reported and the reported ones."""
+
+        report = self.last_report or {'highest_block': -1, 'missing': []}
+        blocks = [block for first, count in report['missing'] for block in range(first, first + count)]
+        blocks.extend(range(report['highest_block'] + 1, self.block_count))
+        for block in blocks:
+            if block not in self.queued:
+                self.retransmissions.append(block)
+                self.queued.add(block)
+        self.last_request_time = time.monotonic()
+
+
+    def _next_block(self):
+        """:return: (block to send, whether it is a retransmission), or (None, False) if there is nothing to send yet."""
+
+        with self.condition:
+            while self.status == 'active':
+                if self.retransmissions:
+                    block = self.retransmissions.popleft()
+                    self.queued.discard(block)
+                    self.resent[block] = self.sequence
+                    return block, True
+                if self.next_block < self.block_count:
+                    self.next_block += 1
+                    return self.next_block - 1, False
+                now = time.monotonic()
+                if now - self.last_report_time >= IDLE_TIMEOUT:
+                    self.status = 'failed'
+                    self.error = f"No report from the receiver for {IDLE_TIMEOUT} seconds"
+                elif now - self.last_request_time >= TAIL_TIMEOUT * self.rtt + REPORT_INTERVAL:
+                    self._requeue_unconfirmed()
+                else:
+                    self.condition.wait(REPORT_INTERVAL)
+            return None, False
+
+
+    def run(self, metrics=None, progress_callback=None):
+        """
+        Send until the receiver has every block.
+
+        :param metrics: TransferMetrics credited with every block sent for the first time; a rate
+                        limit on it slows the sender down on top of the pacing.
+        :param progress_callback: Called as progress_callback(bytes_sent, file_size) with the metrics.
+        :raises ConnectionError: If the receiver gives up or stops reporting.
+        """
+
+        next_send = time.perf_counter()
+        sent = unreported = datagrams = 0
+        while True:
+            block, retransmission = self._next_block()
+            if block is None:
+                break
+            offset = block * self.block_size
+            size = min(self.block_size, self.file_size - offset)
+            now = time.perf_counter()
+            if next_send > now:
+                time.sleep(next_send - now)
+            elif next_send < now - PACING_BURST:
+                # Don't make up for an idle period with a burst the path can't absorb
+                next_send = now - PACING_BURST
+            next_send += (_DATAGRAM_HEADER.size + size) / self.rate
+            header = _DATAGRAM_HEADER.pack(self.token, self.sequence, block)
+            self.sequence += 1
+            # Released right away, close() can't unmap the file while a slice of it is exported
+            with self.view[offset:offset + size] as data:
+                try:
+                    if self.link:
+                        self.link.send([header, data])
+                    else:
+                        self.sock.sendmsg([header, data])
+                except ConnectionRefusedError:
+                    # The receiver's port is closed once it has everything, its report is on the way
+                    pass
+            datagrams += 1
+            if retransmission:
+                self.stats['retransmitted'] += 1
+            else:
+                unreported += size
+            if metrics and unreported >= METRICS_BLOCK:
+                metrics.add(unreported, datagrams)
+                sent += unreported
+                unreported = datagrams = 0
+                if progress_callback:
+                    progress_callback(sent, self.file_size)
+        if metrics and unreported:
+            metrics.add(unreported, datagrams)
+            if progress_callback:
+                progress_callback(sent + unreported, self.file_size)
+        self.stats['datagrams'] = self.sequence
+        self.stats['dropped'] = self.link.dropped if self.link else 0
+        if self.status != 'completed':
+            raise ConnectionError(self.error or "UDP transfer failed")
+
+
+    def close(self):
+        if self.link:
+            self.link.close()
+        if self.view is not None:
+            self.view.release()
+            self.map.close()
+        self.sock.close()
@@ -0,0 +1,382 @@
+"""
+Multi-process receiver.
+
+A supervisor starts several worker processes that receive on the same port, so that hashing,
+compression and many senders aren't held to a single core by the GIL:
+
+    python workers.py --workers 4 --port 5555 --download-location Downloads
+
+On Linux every worker binds the port with SO_REUSEPORT and the kernel spreads new connections
+over them; elsewhere the supervisor binds the port and the workers accept on the socket they
+inherit. All of them receive into the same download_location through a shared Catalog, which
+also keeps new names unique across the workers.
+
+The stream and event channel connections of a client may be accepted by another worker than
+its main connection. They are passed to the worker serving the client over a Unix socket,
+together with their file descriptor: v5 clients repeat the 'route' of their session reply when
+they open a channel, and event tokens start with the index of the worker that issued them.
+Parallel streams of clients older than v5 only attach when they reach the right worker.
+
+The supervisor restarts workers that exit and prints the combined stats of all of them.
+"""
+
+import argparse
+import collections
+import contextlib
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from metrics import format_bytes
+from protocol import EVENTS_HELLO
+
+
+WORKER_COUNT = os.cpu_count() or 1      # Worker processes started by default
+STATS_INTERVAL = 2.0                    # Seconds between two stats reports of a worker
+RESTART_DELAY = 1.0                     # Seconds before a worker that exited is started again
+MAX_RESTART_DELAY = 60.0                # The delay doubles for a worker that keeps exiting, up to this
+STABLE_UPTIME = 30.0                    # Seconds a worker has to run before its restart delay is reset
+MAX_HANDOVER_SIZE = 64 * 1024           # Largest hello, session and protocol version passed with a connection
+WORKER_STOP_TIMEOUT = 5.0               # Seconds a stopped worker gets to exit before it is killed
+# Only Linux spreads the connections of a port over every socket bound to it with SO_REUSEPORT
+REUSE_PORT = sys.platform.startswith('linux') and hasattr(socket, 'SO_REUSEPORT')
+
+
+class ChannelRouter():
+    """
+    Hands stream and event channel connections to the worker process serving their client.
+
+    Every worker listens on a Unix socket of its own in a directory shared by the workers; a
+    connection is passed as a file descriptor, along with the hello and session already read from it.
+    """
+
+    def __init__(self, index: int, directory: str):
+        """
+        :param index: Index of this worker.
+        :param directory: Directory holding the Unix socket of every worker.
+        """
+
+        self.index = index
+        self.directory = directory
+        path = self._path(index)
+        # Left behind by the worker this one replaces
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+
+
+    def _path(self, index: int) -> str:
+        return os.path.join(self.directory, f"worker-{index}.sock")
+
+
+    def route_token(self, token: str) -> str:
+        """Prefix an event channel token with the index of this worker."""
+
+        return f"{self.index}-{token}"
+
+
+    def owner(self, hello: str, session: dict = None) -> int:
+        """:return: Index of the worker serving the client of a channel connection, or None if it isn't known."""
+
+        if session and isinstance(session.get('route'), int):
+            return session['route']
+        if hello.startswith(EVENTS_HELLO):
+            index, _, _ = hello[len(EVENTS_HELLO):].strip().partition('-')
+            if index.isdigit():
+                return int(index)
+        return None
+
+
+    def hand_off(self, conn, hello: str, session: dict, version: int) -> bool:
+        """
+        Pass <conn> to the worker serving its client, unless that is this one.
+
+        :param version: Protocol version agreed on the connection.
+        :return: True if it was handed over; the caller only closes its own descriptor of it then.
+        """
+
+        owner = self.owner(hello, session)
+        if owner is None or owner == self.index:
+            return False
+        message = json.dumps({'hello': hello, 'session': session, 'version': version}).encode("utf-8")
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as channel:
+                channel.connect(self._path(owner))
+                socket.send_fds(channel, [message], [conn.fileno()])
+        except OSError:
+            # The worker is gone, e.g. while it is restarted; this one refuses the connection instead
+            print(f"Could not hand a connection over to worker {owner}:", traceback.format_exc())
+            return False
+        return True
+
+
+    def serve(self, server):
+        """Give every connection handed over by another worker to <server> (see Server.adopt_channel) until closed."""
+
+        while True:
+            try:
+                channel, _ = self.listener.accept()
+            except OSError:
+                return
+            try:
+                with channel:
+                    message, fds, _, _ = socket.recv_fds(channel, MAX_HANDOVER_SIZE, 1)
+                    while data := channel.recv(MAX_HANDOVER_SIZE):
+                        message += data
+                if not fds:
+                    continue
+                request = json.loads(message)
+                server.adopt_channel(socket.socket(fileno=fds[0]), request['hello'], request['session'], request['version'])
+            except Exception:
+                print("Connection Handover Error:", traceback.format_exc())
+
+
+    def close(self):
+        self.listener.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self._path(self.index))
+
+
+def _report_stats(index: int, server, stats_pipe):
+    while True:
+        time.sleep(STATS_INTERVAL)
+        try:
+            stats_pipe.send((index, server.stats()))
+        except (OSError, ValueError):
+            # The supervisor is gone
+            return
+
+
+def _run_worker(index: int, engine: str, directory: str, listen_socket, stats_pipe, server_options: dict):
+    # Ctrl+C reaches every process of the terminal, the supervisor stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    router = ChannelRouter(index, directory)
+    if engine == 'async':
+        from async_server import AsyncServer, start_async_server
+        server = AsyncServer(listen_socket=listen_socket, reuse_port=listen_socket is None, shared_catalog=True, **server_options)
+    else:
+        from server import Server, start_server
+        server = Server(listen_socket=listen_socket, reuse_port=listen_socket is None, shared_catalog=True, **server_options)
+    server.router = router
+    threading.Thread(target=router.serve, args=(server,), daemon=True).start()
+    threading.Thread(target=_report_stats, args=(index, server, stats_pipe), daemon=True).start()
+    try:
+        if engine == 'async':
+            start_async_server(server)
+        else:
+            start_server(server)
+    finally:
+        router.close()
+
+
+class Supervisor():
+    """
+    Runs <workers> receiver processes on one port, restarts those that exit and combines their stats.
+    """
+
+    def __init__(self, server_ip: str = None, port: int = 5555, workers: int = WORKER_COUNT, engine: str = 'async', **server_options):
+        """
+        :param workers: Number of worker processes.
+        :param engine: 'async' for AsyncServer workers, which take any number of senders each,
+                       or 'threaded' for Server workers, which take one sender each.
+        :param server_options: Further Server arguments, e.g. download_location. A rate_limit is
+                               split evenly between the workers.
+        """
+
+        if not hasattr(socket, 'send_fds'):
+            raise ValueError("Worker processes need Unix sockets that pass file descriptors")
+        if engine not in ('async', 'threaded'):
+            raise ValueError(f"Unknown engine: {engine}")
+        if server_options.get('rate_limit'):
+            server_options['rate_limit'] /= workers
+        if not server_ip:
+            from server import private_ip_address
+            server_ip = private_ip_address()
+            if not server_ip:
+                raise ValueError("You are not connected to any private network")
+        self.server_ip = server_ip
+        self.port = port
+        self.worker_count = workers
+        self.engine = engine
+        self.server_options = server_options
+        self.directory = None
+        self.port_socket = None         # Keeps the port while workers restart, or is the socket they all accept on
+        self.workers = {}               # index -> worker Process
+        self.stats_pipes = {}           # index -> receiving end of the worker's stats reports
+        self.started = {}               # index -> time the worker was started
+        self.restart_delays = {}        # index -> seconds to wait before the worker is started again
+        self.restart_at = {}            # index -> time an exited worker is started again
+        self.restarts = collections.Counter()
+        self.worker_stats = {}          # index -> last stats reported by the worker
+        self.retired_totals = collections.Counter()    # Totals of workers that exited
+
+
+    def start(self):
+        """Bind the port and start every worker."""
+
+        # A temporary directory keeps the paths of the Unix sockets short, they are limited to about a hundred bytes
+        self.directory = tempfile.mkdtemp(prefix='transfer-workers-')
+        self.port_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.port_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if REUSE_PORT:
+            # Bound but never listening, so the kernel gives it no connections
+            self.port_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.port_socket.bind((self.server_ip, self.port))
+        self.port = self.port_socket.getsockname()[1]
+        if not REUSE_PORT:
+            self.port_socket.listen(128)
+        print(f"Supervisor listening on {self.server_ip}, port {self.port} with {self.worker_count} {self.engine} workers")
+        for index in range(self.worker_count):
+            self._start_worker(index)
+
+
+    def _start_worker(self, index: int):
+        receiving_pipe, sending_pipe = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=_run_worker, name=f"receiver-worker-{index}", daemon=True,
+            args=(index, self.engine, self.directory, None if REUSE_PORT else self.port_socket, sending_pipe,
+                  {**self.server_options, 'server_ip': self.server_ip, 'port': self.port}))
+        process.start()
+        sending_pipe.close()
+        self.workers[index] = process
+        self.stats_pipes[index] = receiving_pipe
+        self.started[index] = time.monotonic()
+
+
+    def _receive_stats(self, timeout: float):
+        ready = multiprocessing.connection.wait(list(self.stats_pipes.values()), timeout)
+        for index, pipe in list(self.stats_pipes.items()):
+            if pipe not in ready:
+                continue
+            try:
+                reporter, stats = pipe.recv()
+            except (EOFError, OSError):
+                # The worker exited, _check_workers restarts it
+                pipe.close()
+                del self.stats_pipes[index]
+                continue
+            self.worker_stats[reporter] = stats
+
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for index, process in list(self.workers.items()):
+            if process.is_alive():
+                if now - self.started[index] >= STABLE_UPTIME:
+                    self.restart_delays.pop(index, None)
+                continue
+            if index not in self.restart_at:
+                delay = self.restart_delays.get(index, RESTART_DELAY)
+                print(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, restarting it in {delay:.0f} s")
+                self.restart_at[index] = now + delay
+                self.restart_delays[index] = min(2 * delay, MAX_RESTART_DELAY)
+                # The new worker counts from zero
+                stats = self.worker_stats.pop(index, None)
+                if stats:
+                    self.retired_totals.update(stats['totals'])
+            elif now >= self.restart_at[index]:
+                del self.restart_at[index]
+                self._start_worker(index)
+                self.restarts[index] += 1
+
+
+    def stats(self) -> dict:
+        """
+        Stats of all workers as of their last report: their transfers, tagged with the worker index,
+        the totals summed over all of them and the state of every worker.
+        """
+
+        active = []
+        finished = []
+        totals = collections.Counter(self.retired_totals)
+        for index, stats in sorted(self.worker_stats.items()):
+            active += [{**transfer, 'worker': index} for transfer in stats['active']]
+            finished += [{**transfer, 'worker': index} for transfer in stats['finished']]
+            totals.update(stats['totals'])
+        workers = {index: {'pid': process.pid, 'alive': process.is_alive(), 'restarts': self.restarts[index]}
+                   for index, process in self.workers.items()}
+        return {'active': active, 'finished': finished, 'totals': dict(totals), 'workers': workers}
+
+
+    def summary(self) -> str:
+        stats = self.stats()
+        alive = sum(worker['alive'] for worker in stats['workers'].values())
+        totals = stats['totals']
+        return (f"Workers: {alive} of {self.worker_count} running, {len(stats['active'])} active transfers, "
+                f"{totals.get('transfers_completed', 0)} completed, {format_bytes(totals.get('bytes_receive', 0))} received")
+
+
+    def run(self):
+        """Start the workers and supervise them until interrupted, printing the combined stats when they change."""
+
+        self.start()
+        last_summary = None
+        try:
+            while True:
+                self._receive_stats(STATS_INTERVAL)
+                self._check_workers()
+                summary = self.summary()
+                if summary != last_summary:
+                    print(summary)
+                    last_summary = summary
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+    def stop(self):
+        """Stop every worker; transfers in progress are left as partial files."""
+
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.workers.values():
+            process.join(WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+        for pipe in self.stats_pipes.values():
+            pipe.close()
+        if self.port_socket:
+            self.port_socket.close()
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        print("Shutting down the workers")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Receive files with several worker processes on one port.")
+    parser.add_argument('--ip', help="Address to listen on (default: this host's private network address)")
+    parser.add_argument('-p', '--port', type=int, default=5555, help="(default: %(default)s)")
+    parser.add_argument('-w', '--workers', type=int, default=WORKER_COUNT,
+                        help="Worker processes (default: the number of CPUs, %(default)s)")
+    parser.add_argument('--engine', choices=('async', 'threaded'), default='async',
+                        help="Server engine of the workers; a threaded worker takes one sender at a time (default: %(default)s)")
+    parser.add_argument('-d', '--download-location', help="Directory received files are saved in (default: ./Downloads)")
+    parser.add_argument('--server-options', default='{}',
+                        help='JSON object of extra Server arguments, e.g. \'{"rate_limit": 100000000, "fsync_policy": "end"}\'')
+    args = parser.parse_args(argv)
+
+    try:
+        supervisor = Supervisor(args.ip, args.port, workers=args.workers, engine=args.engine,
+                                download_location=args.download_location, **json.loads(args.server_options))
+        supervisor.run()
+    except (ValueError, OSError) as e:
+        print(e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())